@@ -26,22 +26,35 @@ def get_str_from_csv_dict(csv_dict):
     return output_str.read()
 
 
-def main():
-    #############################################################
-    ###########  Check Filter Script Prerequisites ##############
-    assert len(sys.argv) > 1, "arg1 is required"
+def check_arg1(args):
+    assert len(args) > 0, "arg1 is required"
 
-    arg1 = sys.argv[1]
+    arg1 = args[0]
     assert len(arg1) == 2, "arg1 must be exactly 2 digits"
 
     if not arg1.isdigit():
         raise ValueError("arg1 must be a valid integer")
 
-    #############################################################
+    return arg1
 
-    # Read CSV from STDIN
-    input_csv_string = sys.stdin.read()
 
+def filter_fields(fields, context):
+    """Same filter as main(), as an in-process filter plugin
+
+    sim_csv_script {example.csv} --filter-plugin filter_script.py:filter_fields {arg1}
+
+    fields: dict of FieldName to FieldValue
+    context: CardContext with the card's iccid, imsi and the filter args
+    """
+    arg1 = check_arg1(context.args)
+
+    # Modify SPN Value to change last 2 characters to arg1 reversed
+    fields["SPN"] = f'{fields["SPN"][:-2]}{arg1[::-1]}'
+
+    return fields
+
+
+def filter_csv_string(input_csv_string, arg1):
     # Convert CSV string to dictionary
     csv_dict = get_csv_dict(input_csv_string)
 
@@ -54,7 +67,49 @@ def main():
     #############################################################
 
     # Convert CSV dictionary to string
-    output_csv_string = get_str_from_csv_dict(csv_dict)
+    return get_str_from_csv_dict(csv_dict)
+
+
+def serve_persistent(arg1):
+    """Filters every CSV frame (CSV lines, then a line with a single '.') from STDIN until STDIN is closed
+
+    sim_csv_script {example.csv} --filter python3 filter_script.py {arg1} persistent --filter-persistent
+    """
+    lines = []
+    for line in sys.stdin:
+        line = line.rstrip("\r\n")
+        if line != ".":
+            lines.append(line)
+            continue
+
+        try:
+            output_csv_string = filter_csv_string("\n".join(lines), arg1)
+        except Exception as e:
+            # Report the error for this card, and keep serving the next cards
+            output_csv_string = f"ERROR ({e.__class__.__name__}) {e}\n"
+        lines = []
+
+        sys.stdout.write(output_csv_string)
+        sys.stdout.write(".\n")
+        sys.stdout.flush()
+
+    return 0
+
+
+def main():
+    #############################################################
+    ###########  Check Filter Script Prerequisites ##############
+    arg1 = check_arg1(sys.argv[1:])
+
+    #############################################################
+
+    if sys.argv[2:] == ["persistent"]:
+        return serve_persistent(arg1)
+
+    # Read CSV from STDIN
+    input_csv_string = sys.stdin.read()
+
+    output_csv_string = filter_csv_string(input_csv_string, arg1)
 
     # Write modified CSV to STDOUT
     sys.stdout.write(output_csv_string)
@@ -1,11 +1,32 @@
-from sim_csv_script.app import (
-    check_that_field_is_valid,
-    argparse_add_reader_args,
-    initialize_card_reader_and_commands,
-    get_dataframe_from_csv,
-    check_that_fields_are_valid,
-    check_for_added_fields_after_filter,
-    JSONFileArgType,
-    is_valid_hex,
-    filter_dataframe,
+import sys
+
+# Re-exported from sim_csv_script.app, which imports the pySim card stack.
+# They are imported on first use, so that importing a light submodule (e.g. sim_csv_script.cli for --version) stays fast
+_APP_EXPORTS = (
+    "check_that_field_is_valid",
+    "argparse_add_reader_args",
+    "initialize_card_reader_and_commands",
+    "get_dataframe_from_csv",
+    "check_that_fields_are_valid",
+    "check_for_added_fields_after_filter",
+    "JSONFileArgType",
+    "is_valid_hex",
+    "filter_dataframe",
 )
+
+__all__ = list(_APP_EXPORTS)
+
+if sys.version_info >= (3, 7):
+
+    def __getattr__(name):
+        if name in _APP_EXPORTS:
+            from sim_csv_script import app
+
+            return getattr(app, name)
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+else:
+    # Module __getattr__ (PEP 562) needs Python 3.7, so import them now
+    from sim_csv_script import app as _app
+
+    globals().update({name: getattr(_app, name) for name in _APP_EXPORTS})
@@ -1,3 +1,3 @@
-from sim_csv_script.app import main
+from sim_csv_script.cli import main
 
-main()
\ No newline at end of file
+main()
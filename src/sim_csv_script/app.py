@@ -1,36 +1,187 @@
 #!/usr/bin/env python3
 import argparse
-import os
-import sys
 import logging
-import json
 import subprocess
 from io import StringIO
 import shlex
-import pandas as pd
-from typing import Optional, Union, List
-from pySim.ts_51_011 import EF
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
 from pySim.ts_31_102 import EF_USIM_ADF_map
 from pySim.ts_31_103 import EF_ISIM_ADF_map
 
 from pySim.commands import SimCardCommands
 from pySim.transport import init_reader, argparse_add_reader_args
-from pySim.cards import card_detect, _cards_classes, SimCard, UsimCard, IsimCard
+from pySim.cards import card_detect, SimCard, UsimCard, IsimCard
 from pySim.utils import h2b
 from pySim.utils import sanitize_pin_adm
 
-from sim_csv_script.csv_utils import get_dataframe_from_csv
-
-ALL_FieldName_to_EF = {**EF_ISIM_ADF_map, **EF_USIM_ADF_map, **EF}
-
-FIELDS_THAT_USE_RECORDS = ("SMSP", "PCSCF", "IMPU")
-
-LOG_FORMAT = "[%(levelname)s] %(message)s"
+from sim_csv_script.csv_utils import (
+    FieldTable,
+    read_field_table,
+    get_dataframe_from_csv,
+)
+from sim_csv_script.fields import ALL_FieldName_to_EF
+from sim_csv_script.validation import (
+    is_valid_hex,
+    is_even_number_hex_characters,
+    has_spaces,
+    find_field_problems,
+    format_field_problems,
+)
+from sim_csv_script.exceptions import (
+    InvalidFieldError,
+    InvalidDataframeError,
+    RequiresIsimError,
+    RequiresUsimError,
+    InvalidADMPinError,
+    ReadFieldError,
+    WriteFieldError,
+    VerifyFieldError,
+    FilterCSVError,
+    WriteDeclinedError,
+    BulkInputError,
+    InvalidTemplateError,
+    NoMoreCardsError,
+)
+from sim_csv_script.plan import (
+    ProvisioningPlan,
+    compile_field,
+    compile_plan,
+    filter_plan,
+    update_plan,
+    ADF_ISIM,
+    ADF_USIM,
+)
+from sim_csv_script.filters import (
+    CardContext,
+    FilterPlugin,
+    FilterCoprocess,
+    load_filter_plugin,
+)
+from sim_csv_script.bulk import BulkInput
+from sim_csv_script.journal import JournalState, ProvisioningJournal, journal_card, plan_hash
+from sim_csv_script.templates import (
+    FieldTemplate,
+    SequenceCounter,
+    TemplateContext,
+    compile_field_templates,
+)
+from sim_csv_script.engine import (
+    CardEngine,
+    CardResult,
+    fingerprint_matches,
+    prefetch_field_widths,
+    select_field_adf,
+    check_field_width,
+    read_field,
+    write_field,
+)
+from sim_csv_script.logging_utils import card_log_context, new_card_log_id, set_card_log_fields
+from sim_csv_script.pipeline import Prefetcher, submit_or_defer
+from sim_csv_script.results import ResultSink, open_result_sink, record_card
+from sim_csv_script.readers import (
+    ReaderResult,
+    list_pcsc_reader_numbers,
+    run_reader_workers,
+)
+from sim_csv_script.virtual_card import VirtualCardLink
+from sim_csv_script.transfer import negotiate_transfer_limits
+from sim_csv_script.session import SessionSimCardCommands
+from sim_csv_script.cli import (
+    LOG_FORMAT,
+    setup_logging_basic_config,
+    FileArgType,
+    CSVFileArgType,
+    JSONFileArgType,
+    get_package_version,
+    get_args,
+    main,
+    main_safe,
+)
+from sim_csv_script.tracing import (
+    ApduCostTracer,
+    TraceSink,
+    trace_card,
+    trace_phase,
+    PHASE_INITIAL_DATA,
+    PHASE_ADM,
+    PHASE_WIDTH_CHECK,
+    PHASE_READ,
+    PHASE_WRITE,
+    PHASE_VERIFY,
+)
 
 log = logging.getLogger(__name__)
 
 HexStr = str
 
+__all__ = [
+    "UsimAndIsimCard",
+    "check_that_field_is_valid",
+    "check_that_fields_are_valid",
+    "run_filter_command_on_csv_bytes",
+    "filter_dataframe",
+    "check_for_added_fields_after_filter",
+    "check_isim_field",
+    "check_usim_field",
+    "verify_full_field_width",
+    "check_pin_adm",
+    "read_field_data",
+    "write_field_data",
+    "read_fieldname_simple",
+    "write_fieldname_simple",
+    "read_write_to_fieldname",
+    "initialize_card_reader_and_commands",
+    "set_commands_cla_byte_and_sel_ctrl",
+    "get_card",
+    "read_card_initial_data",
+    "get_filtered_field_table",
+    "get_filtered_dataframe",
+    "CardFilter",
+    "get_card_filtered_plan",
+    "get_bulk_input_plan",
+    "get_plan",
+    "get_plan_and_templates",
+    "get_filtered_plan_and_templates",
+    "get_template_plan",
+    "get_journal_plan",
+    "CardInputs",
+    "get_card_plan",
+    "ask",
+    "get_pin_adm",
+    "process_card",
+    "run_reader",
+    "get_reader_numbers",
+    "run_multiple_readers",
+    "run",
+    "run_cards",
+    # Moved to other modules.  Still imported from here, so code written for earlier versions keeps working
+    "argparse_add_reader_args",
+    "get_dataframe_from_csv",
+    "is_valid_hex",
+    "is_even_number_hex_characters",
+    "has_spaces",
+    "InvalidFieldError",
+    "InvalidDataframeError",
+    "RequiresIsimError",
+    "RequiresUsimError",
+    "InvalidADMPinError",
+    "ReadFieldError",
+    "WriteFieldError",
+    "VerifyFieldError",
+    "FilterCSVError",
+    "LOG_FORMAT",
+    "setup_logging_basic_config",
+    "FileArgType",
+    "CSVFileArgType",
+    "JSONFileArgType",
+    "get_package_version",
+    "get_args",
+    "main",
+    "main_safe",
+]
+
 ############################################################################
 
 
@@ -38,176 +189,45 @@ class UsimAndIsimCard(UsimCard, IsimCard):
     pass
 
 
-####################  CUSTOM EXCEPTIONS ####################################
-
-
-class InvalidFieldError(Exception):
-    pass
-
-
-class InvalidDataframeError(Exception):
-    pass
-
-
-class RequiresIsimError(Exception):
-    pass
-
-
-class RequiresUsimError(Exception):
-    pass
-
-
-class InvalidADMPinError(Exception):
-    pass
-
-
-class ReadFieldError(Exception):
-    pass
-
-
-class WriteFieldError(Exception):
-    pass
-
-
-class VerifyFieldError(Exception):
-    pass
-
-
-class FilterCSVError(Exception):
-    pass
-
-
 ############################################################################
 
 
-def is_valid_hex(test_string: str) -> bool:
-    """
-    Returns True if valid
-    Returns False if invalid
-    """
-    try:
-        int(test_string, 16)
-        return True
-    except ValueError:
-        return False
-
-
-def is_even_number_hex_characters(test_string: str) -> bool:
-    """
-    Returns True if string length is even
-    Returns False if string length is odd
-    """
-    return not (len(test_string) & 1)
-
-
-def has_spaces(test_string: str) -> bool:
-    """
-    Returns True if there are spaces
-    Returns False if there are no spaces
-    """
-    return " " in test_string
-
-
 def check_that_field_is_valid(field_name, field_value):
-    """Validates passed values
-    1. FieldName must match keys (case-sensitive) in Pysim's EF, EF_USIM_ADF_map, or EF_ISIM_ADF_map python dictionaries
-    2. FieldValues must not have spaces
-    3. FieldValues must have even number of hex characters. If odd number of characters and correct, manually add a '0' in front of FieldValue in CSV file
-    4. FieldValues must be valid hex
+    """Validates passed values with the rules of find_field_problems()
 
-    InvalidFieldError: if doesn't meet checks above
+    InvalidFieldError: with every problem of the field
     """
-    log.info(f"Checking that field name {field_name} is valid")
-    if field_name not in ALL_FieldName_to_EF:
-        raise InvalidFieldError(f"Invalid Field Name: {field_name}")
-
-    ############################################################################
-
-    # Checking that there are no spaces
-    log.info("Checking that field value does not have any spaces")
-    if has_spaces(field_value):
-        raise InvalidFieldError(f"Field values can not contain spaces")
-
-    ############################################################################
-
-    # Checking that field value hex strings have even number of characters (since each 2 character represents 1 byte)
-    log.info("Checking that field value has even number of hex characters")
-    if not is_even_number_hex_characters(field_value):
-        raise InvalidFieldError(f"Odd number of hex characters for field: {field_name}")
-
-    ############################################################################
-
-    # Are there any Invalid field values? Checking if they are valid hex
-    log.info("Checking that field value is valid hex")
-    if not is_valid_hex(field_value):
-        raise InvalidFieldError(f"Invalid hex value for field: {field_name}")
-
-    return None
-
-
-def check_that_fields_are_valid(df: pd.DataFrame):
-    """Validates CSV file parsed dataframe
-    1. FieldName must match keys (case-sensitive) in Pysim's EF, EF_USIM_ADF_map, or EF_ISIM_ADF_map python dictionaries
-    2. There can't be FieldName duplicates
-    3. FieldValues must not have spaces
-    4. FieldValues must have even number of hex characters. If odd number of characters and correct, manually add a '0' in front of FieldValue in CSV file
-    5. FieldValues must be valid hex
-
-    InvalidDataframeError: if doesn't meet checks above
-    """
-    # Are there any Invalid field names? Checking if they exist in EF, EF_USIM_ADF_map, or EF_ISIM_ADF_map
-    log.info("Checking that field names are all valid")
-    isValidFieldNameDf = df["FieldName"].apply(lambda x: x in ALL_FieldName_to_EF)
-    if (~isValidFieldNameDf).any():
-        raise InvalidDataframeError(
-            f"Invalid Field Names: {df['FieldName'][~isValidFieldNameDf].to_list()}.  Valid field names are keys in EF, EF_USIM_ADF_map, and EF_ISIM_ADF_map"
-        )
-
-    # Are there are duplicate field names?
-    if not df["FieldName"].is_unique:
-        raise InvalidDataframeError(
-            f"Duplicate Field Names: {df['FieldName'][df['FieldName'].duplicated(keep=False)].to_dict()}"
+    problems = find_field_problems([field_name], [field_value])
+    if problems:
+        raise InvalidFieldError(
+            f"Invalid field {field_name}: " + ".  ".join(problem.message for problem in problems)
         )
+    return None
 
-    ############################################################################
-    
-    # Checking that there are no spaces
-    log.info("Checking that field value does not have any spaces")
-    has_spaces_df = df["FieldValue"].apply(has_spaces)
-    if (has_spaces_df.any()):
-        raise InvalidDataframeError(f"Found spaces in fields: {df['FieldName'][has_spaces_df].to_list()}")
-
-    ############################################################################
 
+def check_that_fields_are_valid(fields: FieldTable, allow_templates: bool = False):
+    """Validates the fields of the CSV file in a single pass (see find_field_problems() for the rules)
 
-    # Checking that field value hex strings have even number of characters (since each 2 character represents 1 byte)
-    log.info("Checking that field values have even number of hex characters")
-    isEvenHexCharactersDf = df["FieldValue"].apply(is_even_number_hex_characters)
-    if (~isEvenHexCharactersDf).any():
-        raise InvalidDataframeError(
-            f"Odd number of hex characters for fields: {df['FieldName'][~isEvenHexCharactersDf].to_list()}"
-        )
+    fields can also be a pandas DataFrame with FieldName and FieldValue columns
+    allow_templates: FieldValues can be templates, that are expanded and validated for each card
 
-    ############################################################################
+    InvalidDataframeError: with every problem of every field, so the CSV file can be fixed at once
+    """
+    if not isinstance(fields, FieldTable):
+        fields = FieldTable.from_dataframe(fields)
 
-    # Are there any Invalid field values? Checking if they are valid hex
-    log.info("Checking that field values are all valid hex")
-    isValidHexDf = df["FieldValue"].apply(is_valid_hex)
-    if (~isValidHexDf).any():
-        # For those FieldValues that are not a valid hex, they might be a format string
-        # right now, just raise Exception if there are any field values that are not valid hex
-        # Are there any that are false
-        raise InvalidDataframeError(
-            f"Invalid hex values for fields: {df['FieldName'][~isValidHexDf].to_list()}"
-        )
+    log.info(f"Validating {len(fields)} fields")
+    problems = find_field_problems(fields.field_names, fields.field_values, allow_templates)
+    if problems:
+        raise InvalidDataframeError(format_field_problems(problems))
     return None
 
 
 def run_filter_command_on_csv_bytes(
     csv_bytes: bytes, filter_command: list
-) -> pd.DataFrame:
+) -> FieldTable:
     """
-    Run filter command on csv filename, and returns dataframe
+    Run filter command on csv filename, and returns the filtered fields
 
     Errors:
         subprocess.run errors
@@ -224,11 +244,11 @@ def run_filter_command_on_csv_bytes(
     else:
         filtered_csv = p.stdout.decode()
         try:
-            df = get_dataframe_from_csv(StringIO(filtered_csv))
+            fields = read_field_table(StringIO(filtered_csv))
         except Exception:
             raise FilterCSVError("Failed to parse filtered csv")
 
-        return df
+        return fields
 
 
 def filter_dataframe(df, filter_command):
@@ -248,7 +268,7 @@ def filter_dataframe(df, filter_command):
     df_bytes = df.to_csv(index=False).encode()
 
     try:
-        df = run_filter_command_on_csv_bytes(df_bytes, filter_command)
+        df = run_filter_command_on_csv_bytes(df_bytes, filter_command).to_dataframe()
     except Exception as e:
         raise FilterCSVError(str(e))
 
@@ -278,23 +298,7 @@ def check_isim_field(card: SimCard, field_name: str) -> None:
     RequiresIsimError: if fails checks
     """
     if field_name in EF_ISIM_ADF_map:
-        # ensure that card is of Isimcard type
-        assert isinstance(card, IsimCard), f"[{field_name}]: SimCard is not ISIM"
-
-        try:
-            _, sw = card.select_adf_by_aid(adf="isim")
-        except Exception as e:
-            raise RequiresIsimError(f"[{field_name}]: Select ISIM adf by aid: {e}")
-
-        if sw != "9000":
-            raise RequiresIsimError(f"[{field_name}]: Select ISIM adf by aid: {sw}")
-        else:
-            ef = ALL_FieldName_to_EF[field_name]
-            if not card.file_exists(ef):
-                raise RequiresIsimError(
-                    f"[{field_name}]: ISIM file {ef} does not exist on card"
-                )
-
+        select_field_adf(card, field_name, ALL_FieldName_to_EF[field_name], ADF_ISIM)
     return None
 
 
@@ -306,55 +310,24 @@ def check_usim_field(card: SimCard, field_name: str) -> None:
     RequiresUsimError: if fails checks
     """
     if field_name in EF_USIM_ADF_map:
-        # ensure that card is of UsimCard type
-        assert isinstance(card, UsimCard), f"[{field_name}]: SimCard is not Usim"
-
-        try:
-            _, sw = card.select_adf_by_aid(adf="usim")
-        except Exception as e:
-            raise RequiresUsimError(f"[{field_name}]: Select USIM adf by aid: {e}")
-
-        if sw != "9000":
-            raise RequiresUsimError(f"[{field_name}]: Select USIM adf by aid: {sw}")
-        else:
-            ef = ALL_FieldName_to_EF[field_name]
-            if not card.file_exists(ef):
-                raise RequiresUsimError(
-                    f"[{field_name}]: USIM file {ef} does not exist on card"
-                )
+        select_field_adf(card, field_name, ALL_FieldName_to_EF[field_name], ADF_USIM)
     return None
 
 
 def verify_full_field_width(card: SimCard, field_name: str, field_value: HexStr):
-    """Used in dataframe.apply function
+    """Checks the width of a single field, for code that used to apply it to each row of a DataFrame.
+    Cards are checked by CardEngine (see engine.check_field_width)
 
     ValueError: if hexStr argument's length of bytes != SimCard read field width
 
     Return Values don't really matter, since the main goal is to raise Error
         Return True if can read binary size of field, and the binary size matches the hexStr's length of bytes
-        Return pd.NA if we can't read binary size of field
+        Return None if we can't read binary size of field
     """
-    field_value_num_bytes = len(field_value) // 2
+    with trace_phase(card, field_name, PHASE_WIDTH_CHECK):
+        field_width = check_field_width(card, compile_field(field_name, field_value))
 
-    check_isim_field(card, field_name)
-    check_usim_field(card, field_name)
-
-    ef = ALL_FieldName_to_EF[field_name]
-
-    try:
-        field_width = card._scc.binary_size(ef)  # in Bytes
-    except Exception:
-        log.warning(f"[{field_name}]: Failed to read binary size")
-        return pd.NA
-
-    if field_width == field_value_num_bytes:
-        log.debug(f"[{field_name}]: Field Width = {field_width} bytes")
-        return True
-    else:
-        raise ValueError(
-            f"[{field_name}]: Hex Str Num Bytes {field_value_num_bytes} != Field Width {field_width}"
-        )
-    return None
+    return None if field_width is None else True
 
 
 ############################################################################
@@ -373,7 +346,11 @@ def check_pin_adm(card: SimCard, pin_adm: Union[str, HexStr]) -> None:
         pin_adm = sanitize_pin_adm(pin_adm)
     key = h2b(pin_adm)
     log.info("Verifying ADM Key")
-    (res, sw) = card._scc.verify_chv(0x0A, key)
+    try:
+        (res, sw) = card._scc.verify_chv(0x0A, key)
+    except Exception as e:
+        # Newer pySim versions raise for a wrong pin, instead of returning its status
+        raise InvalidADMPinError(f"Entered invalid ADM pin: {pin_adm} -- {e}")
     if sw != "9000":
         raise InvalidADMPinError(f"Entered invalid ADM pin: {pin_adm}")
     else:
@@ -389,61 +366,7 @@ def read_field_data(
 
     Returns read_value if successful
     """
-    ef = ALL_FieldName_to_EF[field_name]
-
-    if field_name in FIELDS_THAT_USE_RECORDS:
-        # NOTE: only tested to work on IMPU
-
-        number_of_records = card._scc.record_count(ef)
-        read_value = ""
-
-        if record_number is None:
-            # Read All Records
-            for rec_no in range(1, number_of_records + 1):
-                try:
-                    (res, sw) = card._scc.read_record(ef, rec_no)
-                except Exception as e:
-                    raise ReadFieldError(
-                        f"[{field_name}]: Failed while reading record {rec_no} of {number_of_records} -- {e}"
-                    )
-
-                if sw != "9000":
-                    raise ReadFieldError(
-                        f"[{field_name}]: Failed while reading record {rec_no} of {number_of_records} (Status {sw})"
-                    )
-
-                read_value += res
-        else:
-            # Read only specific record
-            try:
-                (res, sw) = card._scc.read_record(ef, record_number)
-            except Exception as e:
-                raise ReadFieldError(
-                    f"[{field_name}]: Failed while reading binary field -- {e}"
-                )
-
-            if sw != "9000":
-                raise ReadFieldError(
-                    f"[{field_name}]: Failed while reading binary field (Status {sw})"
-                )
-
-            read_value = res
-
-    else:
-        # Default read
-        try:
-            (read_value, sw) = card._scc.read_binary(ef)
-        except Exception as e:
-            raise ReadFieldError(
-                f"[{field_name}]: Failed while reading binary field -- {e}"
-            )
-
-        if sw != "9000":
-            raise ReadFieldError(
-                f"[{field_name}]: Failed while reading binary field (Status {sw})"
-            )
-
-    return read_value
+    return read_field(card, compile_field(field_name), record_number=record_number)
 
 
 def write_field_data(
@@ -455,113 +378,30 @@ def write_field_data(
     dry_run: bool = True,
 ) -> bool:
     """
-    AssertionError: if invalid arguments like:
-        - record_number provided when value_to_write is full field width
-        - value_to_write's number of bytes != full field width when record_number is not provided
-        - record_number is more than max number of records for this field
+    AssertionError: if invalid arguments (see engine.write_field)
 
     WriteFieldError: if problems writing record (for fields with records), or data (for normal fields)
     """
-    ef = ALL_FieldName_to_EF[field_name]
-
-    if field_name in FIELDS_THAT_USE_RECORDS:
-        # NOTE: only tested to work on IMPU
-
-        # TODO: in CSV file have IMPU.{record_number} for record number to read, write, and verify
-        #       and only
-        #       and find other fields that use Records, instead of the default binary read and write
-        #       will have a list of fields that use Records, and for these fields, when reading in the CSV, allow field.record_num syntax to not cause an error
-        # Also will have to change Write function that raises VerifyFieldError (because record verification is different)
-
-        # If value_to_write fills entire field, then record_number must be None
-        number_of_records = card._scc.record_count(ef)  # 10
-        field_width = card._scc.binary_size(ef)  # 750
-        record_size = field_width // number_of_records  # 75
-        value_to_write_size = len(value_to_write) // 2  # bytes
-
-        if value_to_write_size == field_width:
-            assert (
-                record_number is None
-            ), f"[{field_name}]: Value fills entire field ({field_width} bytes), so record_number must be None."
-
-        if record_number is None:
-            assert (
-                value_to_write_size == field_width
-            ), f"[{field_name}]: If didn't provide a record_number, then value must be field's full width ({field_width} bytes)"
-        else:
-            assert (
-                record_number > 0 and record_number <= number_of_records
-            ), f"[{field_name}]: Invalid record number {record_number}. Max record number = {number_of_records}"
-            assert (
-                value_to_write_size == record_size
-            ), f"[{field_name}]: Provided a record number, so value must be each record's width ({record_size} bytes)"
-
-        if record_number is None:
-            log.info(
-                f"[{field_name}]: Overwriting full field width ({number_of_records} records, each with {record_size} bytes)"
-            )
-            # Overwrite Full Field Width (all records)
-            for i in range(number_of_records):
-                rec_no = i + 1
-                # Update Each Record One By One
-                write_record_hex_str = value_to_write[
-                    i * record_size * 2 : (i * record_size + record_size) * 2
-                ]
-                log.info(
-                    f"[{field_name}]: Updating record {rec_no}: '{write_record_hex_str}'"
-                )
-                if not dry_run:
-                    try:
-                        card._scc.update_record(
-                            ef, rec_no, write_record_hex_str, conserve=True
-                        )
-                    except Exception as e:
-                        raise WriteFieldError(
-                            f"[{field_name}]: Failed to update current record {record_number} / {number_of_records} -- {e}"
-                        )
-        else:
-            # Write to Specific Record Number
-            log.info(
-                f"[{field_name}]: Updating single record {record_number}: '{value_to_write}'"
-            )
-            if not dry_run:
-                try:
-                    card._scc.update_record(
-                        ef, record_number, value_to_write, conserve=True
-                    )
-                except Exception as e:
-                    raise WriteFieldError(
-                        f"[{field_name}]: Failed to update single record {record_number} / {number_of_records} -- {e}"
-                    )
-
-    else:
-        # Default write
-        log.info(f"[{field_name}]: Updating data: '{value_to_write}'")
-        if not dry_run:
-            try:
-                (_, sw) = card._scc.update_binary(ef, value_to_write)
-            except Exception as e:
-                raise WriteFieldError(f"[{field_name}]: Failed to update binary -- {e}")
-
-            if sw != "9000":
-                raise WriteFieldError(
-                    f"[{field_name}]: Failed to update binary (Status {sw})"
-                )
-
-    log.info(f"[{field_name}]: Finished Writing")
-    return True
+    return write_field(
+        card,
+        compile_field(field_name),
+        value_to_write,
+        record_number=record_number,
+        dry_run=dry_run,
+    )
 
 
 def read_fieldname_simple(
     card: SimCard,
     field_name: str,
 ) -> str:
-    """This is used in dataframe.apply function to read and return Card's value for field_name"""
-    check_isim_field(card, field_name)
-    check_usim_field(card, field_name)
-    read_value_before_write = read_field_data(card, field_name)
+    """Reads and returns Card's value for field_name, for code that used to apply it to each row of a DataFrame"""
+    with trace_phase(card, field_name, PHASE_READ):
+        check_isim_field(card, field_name)
+        check_usim_field(card, field_name)
+        read_value_before_write = read_field_data(card, field_name)
 
-    log.info(f"[{field_name}]: {read_value_before_write}")
+    log.info("[%s]: %s", field_name, read_value_before_write)
 
     return read_value_before_write
 
@@ -574,27 +414,28 @@ def write_fieldname_simple(
     dry_run: bool = True,
     num_chars_to_display=60,
 ) -> str:
-    """This is used in dataframe.apply function to write and return Card's value for field_name"""
+    """Writes and returns Card's value for field_name, for code that used to apply it to each row of a DataFrame"""
     # Convert field value to lowercase since pysim reads and writes lowercase hex values
     field_value = field_value.lower()
 
-    check_isim_field(card, field_name)
-    check_usim_field(card, field_name)
-    read_value_before_write = read_field_data(card, field_name)
+    with trace_phase(card, field_name, PHASE_READ):
+        check_isim_field(card, field_name)
+        check_usim_field(card, field_name)
+        read_value_before_write = read_field_data(card, field_name)
 
     show_ellipses = "..." if len(read_value_before_write) > num_chars_to_display else ""
     log.info(
-        f"[{field_name}]: {'Read Value':<12}: {read_value_before_write[:num_chars_to_display]}{show_ellipses}"
-    )
-    log.info(
-        f"[{field_name}]: {'Write Value':<12}: {field_value[:num_chars_to_display]}{show_ellipses}"
+        "[%s]: %-12s: %s%s", field_name, "Read Value", read_value_before_write[:num_chars_to_display], show_ellipses
     )
+    log.info("[%s]: %-12s: %s%s", field_name, "Write Value", field_value[:num_chars_to_display], show_ellipses)
 
-    write_field_data(card, field_name, field_value, dry_run=dry_run)
+    with trace_phase(card, field_name, PHASE_WRITE):
+        write_field_data(card, field_name, field_value, dry_run=dry_run)
 
     ####### VERIFY PORTION #######
     # Verify Changed Successfully by reading new value after write
-    read_value_after_write = read_field_data(card, field_name)
+    with trace_phase(card, field_name, PHASE_VERIFY):
+        read_value_after_write = read_field_data(card, field_name)
 
     if field_value != read_value_after_write:
         raise VerifyFieldError(
@@ -602,7 +443,10 @@ def write_fieldname_simple(
         )
     else:
         log.info(
-            f"[{field_name}]: Verified successful write: Before writing ('{read_value_before_write}') => After writing ('{read_value_after_write}')"
+            "[%s]: Verified successful write: Before writing ('%s') => After writing ('%s')",
+            field_name,
+            read_value_before_write,
+            read_value_after_write,
         )
 
     return read_value_after_write
@@ -618,246 +462,24 @@ def read_write_to_fieldname(
     report_differences=True,
 ) -> bool:
     """
-    This is used in dataframe.apply function
+    Runs CardEngine on the single field, for code that used to apply it to each row of a DataFrame
 
     Errors:
-        errors in isim_field_checks
-        errors in usim_field_checks
-
-        errors in read_field_data
-        errors in write_field_data
-
-        VerifyFieldError: if verification error
+        errors in CardEngine.run_field
     """
-    # Convert field value to lowercase since pysim reads and writes lowercase hex values
-    field_value = field_value.lower()
-
-    check_isim_field(card, field_name)
-    check_usim_field(card, field_name)
-
-    read_value_before_write = read_field_data(card, field_name)
-
-    show_ellipses = "..." if len(read_value_before_write) > num_chars_to_display else ""
-    log.info(
-        f"[{field_name}]: {'Read Value':<12}: {read_value_before_write[:num_chars_to_display]}{show_ellipses}"
-    )
-    log.info(
-        f"[{field_name}]: {'Write Value':<12}: {field_value[:num_chars_to_display]}{show_ellipses}"
+    engine = CardEngine(
+        card,
+        ProvisioningPlan((compile_field(field_name, field_value),)),
+        num_chars_to_display=num_chars_to_display,
+        report_differences=report_differences,
     )
-
-    if field_value == read_value_before_write:
-        # Don't Write if Current value on card == Value to Write, but return True immediately
-        log.info(f"[{field_name}]: Skipping Write since unchanged")
-        return True
-    elif report_differences:
-        # Print the index where the differences begin
-        diff_indexes = [
-            i
-            for i in range(len(field_value))
-            if read_value_before_write[i] != field_value[i]
-        ]
-        diff_symbols = list(" " * num_chars_to_display)
-        for i in diff_indexes:
-            if i >= num_chars_to_display:
-                break
-            diff_symbols[i] = "^"
-        log.info(f"[{field_name}]: {'Differences':<12}: " + "".join(diff_symbols))
-        log.info(f"[{field_name}]: Differences indexes: {diff_indexes}")
-
-    ####### WRITE PORTION #######
-    if not dry_run:
-        write_field_data(card, field_name, field_value, dry_run=dry_run)
-
-        ####### VERIFY PORTION #######
-        # Verify Changed Successfully by reading new value after write
-        read_value_after_write = read_field_data(card, field_name)
-
-        if field_value != read_value_after_write:
-            raise VerifyFieldError(
-                f"[{field_name}]: Verification Error. FieldValue argument ('{field_value}') != Card's value after writing ('{read_value_after_write}')"
-            )
-        else:
-            log.info(
-                f"[{field_name}]: Verified successful write: Before writing ('{read_value_before_write}') => After writing ('{read_value_after_write}')"
-            )
-
+    engine.run(dry_run=dry_run)
     return True
 
 
 ############################################################################
 
 
-def setup_logging_basic_config():
-    logging.basicConfig(
-        level=logging.INFO,
-        format=LOG_FORMAT,
-        handlers=[logging.StreamHandler()],
-    )
-
-
-def FileArgType(filename):
-    """
-    Used as argparse type validator
-
-    Checks that file exists
-    """
-    if not os.path.exists(filename):
-        raise argparse.ArgumentTypeError(f"File '{filename}' does not exist")
-    return filename
-
-
-def CSVFileArgType(filename):
-    """
-    Used as argparse type validator
-
-    Checks that file exists, and does basic check for filename ending with ".csv"
-    """
-    filename = FileArgType(filename)
-
-    if not filename.lower().endswith(".csv"):
-        raise argparse.ArgumentTypeError(f"Check that '{filename}' ends with '.csv'")
-
-    return filename
-
-
-def JSONFileArgType(filename):
-    """
-    Used as argparse type validator
-
-    Checks that file exists, and does basic check for filename ending with ".json"
-    """
-    filename = FileArgType(filename)
-
-    if not filename.lower().endswith(".json"):
-        raise argparse.ArgumentTypeError(f"Check that '{filename}' ends with '.json'")
-
-    try:
-        json_dict = json.load(open(filename, "r"))
-    except Exception:
-        raise argparse.ArgumentTypeError(f"Failed to parse JSON file {filename}")
-
-    return json_dict
-
-
-def get_package_version():
-        import pkg_resources
-        return pkg_resources.require("sim_csv_script")[0].version
-
-def get_args():
-    parser = argparse.ArgumentParser(
-        # prog="pySim-read",
-        description="Tool for reading some parts of a SIM card",
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-    )
-
-    parser.add_argument("--version", action="version", version=get_package_version())
-    parser.add_argument(
-        "CSV_FILE",
-        help="Read FieldNames and FieldValues from CSV file",
-        type=CSVFileArgType,
-        nargs="?"
-    )
-    parser.add_argument(
-        "--list-field-names",
-        help="Lists all possible field names",
-        default=False,
-        action="store_true"
-    )
-    parser.add_argument(
-        "--type",
-        dest="card_type",
-        help="SimCard type (use '--type list' to list possible types)",
-        default="auto",
-    )
-    parser.add_argument(
-        "--log-file",
-        type=str,
-        default="sim.log",
-        help="Specify log filename",
-    )
-    parser.add_argument(
-        "--show-diff",
-        help="Show symbols that point to difference in Read and Write values",
-        default=False,
-        action="store_true",
-    )
-    parser.add_argument(
-        "--multiple",
-        action="store_true",
-        help="If multiple, loop and wait for next card once done. Press Ctrl+C to stop",
-    )
-    write_group = parser.add_argument_group("write arguments")
-    write_group.add_argument(
-        "--write",
-        dest="write",
-        default=False,
-        action="store_true",
-        help="Turn on Write Mode.",
-    )
-    write_group.add_argument(
-        "--pin-adm",
-        dest="pin_adm",
-        type=str,
-        help="ADM PIN required for write mode. If it starts with '0x' it will be treated as hex. Otherwise it will be treated as ASCII.",
-    )
-    write_group.add_argument(
-        "--pin-adm-json",
-        dest="pin_adm_json",
-        type=JSONFileArgType,
-        help="JSON file with {key IMSI: value ADM PIN}. If value starts with '0x', it will be treated as hex. Otherwise it will be treated as ASCII",
-    )
-    write_group.add_argument(
-        "--skip-write-prompt",
-        help="Don't show write prompt for each card to speed up writing",
-        default=False,
-        action="store_true",
-    )
-    filter_group = parser.add_argument_group("filter arguments")
-    filter_group.add_argument(
-        "--filter",
-        nargs="+",
-        default=[],
-        help="Supply a command that receives the CSV file from STDIN, modifies it, and outputs the new CSV file to STDOUT.  Unchanging filter arguments can be supplied immediately after the command.  If different arguments are needed per card, then set --ask-filter-args and it will ask for new arguments that will be appended to this --filter command.",
-    )
-    filter_group.add_argument(
-        "--ask-filter-args",
-        action="store_true",
-        help="Only works when --filter is set.  For each card, prompt user for arguments that will be appended to the --filter command.",
-    )
-    parser = argparse_add_reader_args(parser)
-
-    # use PC/SC reader as default
-    parser.set_defaults(pcsc_dev=0)
-
-    args = parser.parse_args()
-
-
-    if args.card_type == "list":
-        print(repr([card_cls.name for card_cls in _cards_classes]))
-        parser.exit()
-
-    if args.list_field_names:
-        print(repr(list(ALL_FieldName_to_EF.keys())))
-        parser.exit()
-
-    if args.CSV_FILE is None:
-        parser.error("the following arguments are required: CSV_FILE")
-
-    if args.write:
-        if args.pin_adm is None and args.pin_adm_json is None:
-            parser.error("--write requires at least one: --pin-adm or --pin-adm-json")
-        elif args.pin_adm is not None and args.pin_adm_json is not None:
-            parser.error(
-                "--pin-adm and pin-adm-json can't be selected at the same time"
-            )
-
-    if args.ask_filter_args:
-        if not args.filter:
-            parser.error("--ask-filter-args requires --filter")
-
-    return args
-
-
 ############################################################################
 # GUI requires Inputs:
 
@@ -875,18 +497,28 @@ def get_args():
 ############################################################################
 
 
-def initialize_card_reader_and_commands(reader_args):
+def initialize_card_reader_and_commands(reader_args, apdu_tracer=None):
     # Init card reader driver
-    log.info("Init card reader driver")
-    sl = init_reader(reader_args)
+    if getattr(reader_args, "virtual_card", None) is not None:
+        log.info(f"Using virtual card from '{reader_args.virtual_card}'")
+        sl = VirtualCardLink.from_spec_file(reader_args.virtual_card)
+    else:
+        log.info("Init card reader driver")
+        sl = init_reader(reader_args)
     if sl is None:
         raise Exception(
             "Failed to init card reader driver. Try unplugging and replugging in card reader."
         )
 
+    if apdu_tracer is not None:
+        sl.apdu_tracer = apdu_tracer
+
     # Create command layer
     log.info("Setting up SimCardCommands")
-    scc = SimCardCommands(transport=sl)
+    if getattr(reader_args, "no_session_cache", False):
+        scc = SimCardCommands(transport=sl)
+    else:
+        scc = SessionSimCardCommands(transport=sl)
     return (sl, scc)
 
 
@@ -932,149 +564,633 @@ def read_card_initial_data(card):
     # EF.ICCID
     (iccid, sw) = card.read_iccid()
     if sw == "9000":
-        log.info(f"[ICCID]: {iccid}")
+        log.info("[ICCID]: %s", iccid)
     else:
-        log.info(f"[ICCID]: Can't read, response code = {sw}")
+        log.info("[ICCID]: Can't read, response code = %s", sw)
 
     # EF.IMSI
     (imsi, sw) = card.read_imsi()
     if sw == "9000":
-        log.info(f"[IMSI]:  {imsi}")
+        log.info("[IMSI]:  %s", imsi)
     else:
-        log.info(f"[IMSI]: Can't read, response code {sw}")
+        log.info("[IMSI]: Can't read, response code %s", sw)
 
     return iccid, imsi
 
 
-def get_filtered_dataframe(csv_filename, filter_command):
+def get_filtered_field_table(csv_filename, filter_command) -> FieldTable:
     csv_bytes = open(csv_filename, "rb").read()
     # Get Previous Keys
-    df = get_dataframe_from_csv(csv_filename)
-    previous_field_names = df["FieldName"].to_list()
+    previous_field_names = read_field_table(csv_filename).field_names
 
-    df = run_filter_command_on_csv_bytes(csv_bytes, filter_command)
-    log.info(df)
+    fields = run_filter_command_on_csv_bytes(csv_bytes, filter_command)
+    log.info("Filtered fields:\n%s", fields)
 
-    after_filter_field_names = df["FieldName"].to_list()
-    check_for_added_fields_after_filter(previous_field_names, after_filter_field_names)
-    check_that_fields_are_valid(df)
+    check_for_added_fields_after_filter(previous_field_names, fields.field_names)
+    check_that_fields_are_valid(fields, allow_templates=True)
 
-    return df
+    return fields
 
 
-def main():
-    setup_logging_basic_config()
-    args = get_args()
+def get_filtered_dataframe(csv_filename, filter_command):
+    """Same as get_filtered_field_table(), but returns a pandas DataFrame (requires pandas)"""
+    return get_filtered_field_table(csv_filename, filter_command).to_dataframe()
 
-    file_handler = logging.FileHandler(args.log_file)
-    formatter = logging.Formatter(LOG_FORMAT)
-    file_handler.setFormatter(formatter)
-    log.addHandler(file_handler)
 
-    ############################################################################
-    if not args.filter:
-        # If no filter script, then parse CSV and validate CSV immediately
-        try:
-            df = get_dataframe_from_csv(args.CSV_FILE)
-            check_that_fields_are_valid(df)
-        except Exception as e:
-            log.error(f"({e.__class__.__name__}) {e}")
-            return 1
-    ############################################################################
+CardFilter = Union[FilterPlugin, FilterCoprocess]
 
-    try:
-        sl, scc = initialize_card_reader_and_commands(args)
-    except Exception as e:
-        log.error(f"({e.__class__.__name__}) {e}")
-        return 1
 
-    while True:
-        # Wait for SIM card
-        log.info("Waiting for new SIM card...")
-        sl.wait_for_card(newcardonly=True)
+def get_card_filtered_plan(
+    plan: ProvisioningPlan, card_filter: CardFilter, context: CardContext
+) -> ProvisioningPlan:
+    """Runs card_filter on the fields of the validated plan, and returns the plan with the filtered values
+
+    Only the values that the filter changed have to be validated again
+    """
+    fields = {field.field_name: field.value for field in plan.fields}
+    filtered_fields = card_filter(fields, context)
 
+    check_for_added_fields_after_filter(list(fields), list(filtered_fields))
+    for field_name, field_value in filtered_fields.items():
+        if field_value.lower() != fields[field_name]:
+            check_that_field_is_valid(field_name, field_value)
+
+    return filter_plan(plan, filtered_fields)
+
+
+def get_bulk_input_plan(
+    plan: ProvisioningPlan, bulk_input: BulkInput, iccid: Optional[str], imsi: Optional[str], args
+) -> ProvisioningPlan:
+    """Returns plan with the card's FieldValues from the bulk input file
+
+    The bulk input file's values were validated while indexing it, so only the combination of
+    its FieldNames with the CSV file's FieldNames has to be checked for this card
+
+    BulkInputError: if the card is not in the bulk input file, or its fields can't be used together with the CSV file's fields
+    """
+    field_values = bulk_input.lookup(iccid, imsi)
+
+    plan_field_values = {field.field_name: field.value for field in plan.fields}
+    plan_field_values.update(field_values)
+    problems = find_field_problems(list(plan_field_values), list(plan_field_values.values()))
+    if problems:
+        # Rows of the merged fields aren't lines of either file, so only the fields are reported
+        raise BulkInputError(
+            f"Fields of {bulk_input.key.upper()} {bulk_input.card_key(iccid, imsi)} in bulk input file can't be used with the CSV file: "
+            + "; ".join(f"{problem.field_name}: {problem.message}" for problem in problems)
+        )
+
+    return update_plan(plan, field_values, reorder=not args.keep_field_order)
+
+
+def get_plan(fields: FieldTable, args) -> ProvisioningPlan:
+    plan = compile_plan(fields, reorder=not args.keep_field_order)
+    if plan.adf_switches_saved:
+        log.info(
+            f"Ordered fields by application: {plan.adf_switches_saved} fewer application switches per pass over the fields"
+        )
+    return plan
+
+
+def get_plan_and_templates(fields: FieldTable, args) -> Tuple[ProvisioningPlan, Dict[str, FieldTemplate]]:
+    """Compiles the validated fields into a plan, and their FieldValue templates
+
+    Fields with a template are compiled without a value, which is set for each card by get_template_plan()
+    """
+    templates = compile_field_templates(fields)
+    if templates:
+        log.info(f"FieldValue templates: {', '.join(templates)}")
+        fields = FieldTable(
+            fields.field_names,
+            [
+                "" if field_name in templates else field_value
+                for field_name, field_value in fields
+            ],
+        )
+    return get_plan(fields, args), templates
+
+
+def get_filtered_plan_and_templates(args, filter_command) -> Tuple[ProvisioningPlan, Dict[str, FieldTemplate]]:
+    """Runs the --filter command on the CSV file, and compiles its output"""
+    log.info("Running Filter: %r", filter_command)
+    return get_plan_and_templates(get_filtered_field_table(args.CSV_FILE, filter_command), args)
+
+
+def get_template_plan(
+    plan: ProvisioningPlan, templates: Dict[str, FieldTemplate], context: TemplateContext, args
+) -> ProvisioningPlan:
+    """Returns plan with the FieldValue templates expanded for the card
+
+    InvalidTemplateError: if a template can't be expanded for the card
+    InvalidFieldError: if an expanded FieldValue is invalid
+    """
+    field_values = {}
+    for field_name, template in templates.items():
+        field_value = template.expand(context)
+        check_that_field_is_valid(field_name, field_value)
+        field_values[field_name] = field_value
+
+    log.info("Expanded FieldValue templates: %s", field_values)
+    return update_plan(plan, field_values, reorder=not args.keep_field_order)
+
+
+def get_journal_plan(plan: ProvisioningPlan, journal_state: JournalState) -> ProvisioningPlan:
+    """Returns the fields of plan that the journal doesn't have on the card already"""
+    fields = tuple(field for field in plan.fields if not journal_state.field_done(field))
+    if len(fields) < len(plan):
+        log.info(
+            "Resuming card: the journal has %d of %d fields already provisioned, remaining fields: %s",
+            len(plan) - len(fields),
+            len(plan),
+            [field.field_name for field in fields],
+        )
+    return ProvisioningPlan(fields, adf_switches_saved=plan.adf_switches_saved)
+
+
+class CardInputs(NamedTuple):
+    """Everything loaded once at startup, and used for every card"""
+
+    # Compiled from the validated CSV fields, or None if it has to be compiled from the filter's output for each card
+    plan: Optional[ProvisioningPlan]
+    # FieldValue templates of plan's fields, that are expanded for each card
+    templates: Dict[str, FieldTemplate]
+    counter: SequenceCounter
+    # Filter plugin or persistent filter command, that filters plan's fields for each card
+    card_filter: Optional[CardFilter] = None
+    # Per-card FieldValues, that are looked up by the card's ICCID or IMSI
+    bulk_input: Optional[BulkInput] = None
+    # Journal of provisioned cards, to skip or resume cards of earlier runs
+    journal: Optional[ProvisioningJournal] = None
+    # With --pipeline: prepares the --filter command's plan ahead of the cards
+    plan_prefetcher: Optional[Prefetcher] = None
+    # With --pipeline: prepares each card's plan and ADM pin in the background
+    executor: Optional[Executor] = None
+    # Result record of each card, with --output
+    results: Optional[ResultSink] = None
+
+
+def get_card_plan(
+    args,
+    inputs: CardInputs,
+    plan: ProvisioningPlan,
+    templates: Dict[str, FieldTemplate],
+    iccid: Optional[str],
+    imsi: Optional[str],
+    counter: Optional[int],
+    filter_args: Optional[List[str]],
+) -> ProvisioningPlan:
+    """Returns plan with the FieldValue templates expanded for the card, then the bulk input FieldValues
+    of the card added, then filtered by the filter plugin or persistent filter command
+
+    Doesn't use the card, so it can run in the background while the card is busy
+
+    Errors: errors raised by any of the steps
+    """
+    if templates:
+        plan = get_template_plan(plan, templates, TemplateContext(iccid, imsi, counter), args)
+
+    if inputs.bulk_input is not None:
+        plan = get_bulk_input_plan(plan, inputs.bulk_input, iccid, imsi, args)
+
+    if inputs.card_filter is not None:
+        log.info("Running Filter: %s %r", inputs.card_filter.name, filter_args)
+
+        plan = get_card_filtered_plan(
+            plan, inputs.card_filter, CardContext(iccid, imsi, tuple(filter_args))
+        )
+
+    return plan
+
+
+# Serializes prompts, so that workers for different readers don't ask at the same time
+_prompt_lock = threading.Lock()
+
+
+def ask(prompt: str) -> str:
+    with _prompt_lock:
+        return input(prompt)
+
+
+def get_pin_adm(args, imsi, iccid=None) -> str:
+    """
+    Returns ADM pin from --pin-adm, or by looking up IMSI (or ICCID) in --pin-adm-index, or IMSI in --pin-adm-json
+
+    InvalidADMPinError: if IMSI is not found in PIN ADM JSON file or index
+    """
+    if args.pin_adm is not None:
+        return args.pin_adm
+
+    if args.pin_adm_index is not None:
+        return args.pin_adm_index.lookup(imsi, iccid)
+
+    pin_adm = args.pin_adm_json.get(imsi, None)
+    if pin_adm is None:
+        raise InvalidADMPinError(f"IMSI {imsi} is not found in PIN ADM JSON file")
+    return pin_adm
+
+
+def process_card(
+    sl,
+    scc,
+    args,
+    inputs: CardInputs,
+    card_result: Optional[CardResult] = None,
+) -> CardResult:
+    """Detects the inserted card, and runs the filter, width check, ADM pin and read/write for it
+
+    The card's fields are the plan's fields (or the --filter command's output), with the FieldValue templates expanded,
+    then the bulk input FieldValues of the card added, then filtered by the filter plugin or persistent filter command
+
+    card_result: filled in as the card is processed, so it has the finished fields even if a later step fails
+
+    Returns card_result (or a new CardResult) with the result of each field
+
+    WriteDeclinedError: if user chose to not write
+    Errors: errors raised by any of the steps
+    """
+    if card_result is None:
+        card_result = CardResult()
+
+    if isinstance(scc, SessionSimCardCommands):
+        # New card, so forget everything about the previous card
+        scc.reset_session()
+
+    with trace_card(scc) as card_trace:
         set_commands_cla_byte_and_sel_ctrl(scc, sl)
 
         card = get_card(args.card_type, scc)
 
-        _, imsi = read_card_initial_data(card)
+        with trace_phase(card, None, PHASE_INITIAL_DATA):
+            iccid, imsi = read_card_initial_data(card)
+
+        set_card_log_fields(iccid=iccid, imsi=imsi)
+        card_result.iccid, card_result.imsi = iccid, imsi
+        if card_trace is not None:
+            card_trace.iccid, card_trace.imsi = iccid, imsi
 
         ############################################################################
         # We Can Modify The Field Values Dynamically Using A filter Script
 
-        if args.filter:
+        plan, templates = inputs.plan, inputs.templates
+        card_filter = inputs.card_filter
+
+        if inputs.plan_prefetcher is not None:
+            # The --filter command's output doesn't depend on the card, so it was prepared while the previous card was written
+            plan, templates = inputs.plan_prefetcher.get()
+        elif args.filter and card_filter is None:
             filter_command = args.filter
 
             if args.ask_filter_args:
-                new_filter_args = input(
+                new_filter_args = ask(
                     f"Enter filter args (if blank use {repr(args.filter)}): "
                 )
                 if new_filter_args != "":
                     new_filter_args = shlex.split(new_filter_args)
                     filter_command = args.filter + new_filter_args
 
-            log.info(f"Running Filter: {repr(filter_command)}")
+            plan, templates = get_filtered_plan_and_templates(args, filter_command)
+
+        filter_args = None
+        if card_filter is not None:
+            # Arguments after a --filter command are part of the persistent command
+            filter_args = args.filter_plugin[1:]
 
+            if args.ask_filter_args:
+                new_filter_args = ask(
+                    f"Enter filter args (if blank use {repr(filter_args)}): "
+                )
+                if new_filter_args != "":
+                    filter_args = filter_args + shlex.split(new_filter_args)
+
+        counter = inputs.counter.next() if templates else None
+
+        # With --pipeline, the card's FieldValues and ADM pin are prepared in the background while its field sizes are read
+        card_plan = submit_or_defer(
+            inputs.executor, get_card_plan, args, inputs, plan, templates, iccid, imsi, counter, filter_args
+        )
+        card_pin_adm = submit_or_defer(inputs.executor, get_pin_adm, args, imsi, iccid) if args.write else None
+        ############################################################################
+
+        limits = negotiate_transfer_limits(
+            sl.get_atr(), extended=args.extended_apdu, max_apdu_data=args.max_apdu_data
+        )
+
+        if inputs.executor is not None:
+            # Only the fingerprint fields are read from cards that already have the FieldValues
+            prefetch_field_widths(
+                card,
+                [field for field in plan.fields if field.field_name in args.fingerprint_fields]
+                if args.fingerprint_fields and args.write
+                else plan.fields,
+            )
+
+        plan = card_plan.result()
+
+        ############################################################################
+        # Skip the card, or the fields, that the journal has as provisioned by an earlier run,
+        # or skip the card if its fingerprint fields already have the FieldValues
+
+        journal = inputs.journal if args.write else None
+        if journal is not None and not iccid:
+            log.warning("Not journaling card, since its ICCID can't be read")
+            journal = None
+        if journal is not None:
+            card_plan_hash = plan_hash(plan)
+            journal_state = journal.lookup(iccid, card_plan_hash)
+
+        if journal is not None and journal_state.completed:
+            log.info("Skipping card, since the journal has ICCID %s as completed with the same fields", iccid)
+            card_result.skipped = "completed in journal"
+            return card_result
+
+        if args.fingerprint_fields and args.write:
+            missing_field_names = [
+                field_name for field_name in args.fingerprint_fields if field_name not in plan.field_names
+            ]
+            if missing_field_names:
+                raise InvalidFieldError(f"Fingerprint fields {missing_field_names} are not fields of the card")
+            if fingerprint_matches(card, plan, args.fingerprint_fields, limits):
+                log.info("Skipping card, since its fingerprint fields already have the FieldValues")
+                if journal is not None:
+                    journal.finish_card(journal.start_card(iccid, imsi, card_plan_hash))
+                card_result.skipped = "fingerprint matches"
+                return card_result
+
+        card_id = None
+        if journal is not None:
+            plan = get_journal_plan(plan, journal_state)
+            card_id = journal.start_card(iccid, imsi, card_plan_hash)
+
+        with journal_card(journal, card_id) as field_done:
+            engine = CardEngine(
+                card,
+                plan,
+                report_differences=args.show_diff,
+                delta_write=args.delta_write,
+                delta_merge_gap=args.delta_merge_gap,
+                limits=limits,
+                verification=args.verification,
+                verify_sample_rate=args.verify_sample_rate,
+            )
+
+            # Checking that FieldValue's length in bytes matches binary size of field (since we want to completely overwrite each field)
+            # if we can read the binary size, but it doesn't match FieldValue's length in bytes, then it will raise a ValueError
+            # and we alert user to fix the input file
+            log.info("Checking that csv field values span full width of field")
+            engine.check_widths()
+
+            ############################################################################
+
+            if args.write:
+                if not args.skip_write_prompt:
+                    ask_write = ask(f"Sure you want to write? [y/N] ")
+                    if ask_write.lower() != "y":
+                        raise WriteDeclinedError("You chose to not write")
+
+                # Need ADM Key if Writing Values to SimCard
+                pin_adm = card_pin_adm.result()
+
+                with trace_phase(card, None, PHASE_ADM):
+                    check_pin_adm(card, pin_adm)
+
+            #############################################################################
+
+            # For each field in the plan, read, write and verify the value
+            card_result = engine.run(
+                dry_run=not args.write, card_result=card_result, field_done=field_done
+            )
+
+        if card_trace is not None:
+            card_trace.adf_switches_saved = engine.adf_switches_saved
+            card_trace.verification = card_result.verification
+            card_trace.verified = card_result.verified
+
+        if isinstance(scc, SessionSimCardCommands):
+            if card_trace is not None:
+                card_trace.session_stats = scc.session_stats()
+            scc.log_session_stats()
+
+    return card_result
+
+
+def run_reader(
+    args,
+    inputs: CardInputs,
+    reader_number: int,
+    result: ReaderResult,
+    trace_sink: Optional[TraceSink] = None,
+):
+    """Worker loop for a single PC/SC reader in multiple reader mode
+
+    Card failures are logged and counted in result, and the worker moves on to the next card
+    """
+    reader_args = argparse.Namespace(**vars(args))
+    reader_args.pcsc_dev = reader_number
+
+    apdu_tracer = ApduCostTracer(trace_sink, reader=reader_number) if trace_sink else None
+    sl, scc = initialize_card_reader_and_commands(reader_args, apdu_tracer)
+
+    while True:
+        log.info("Waiting for new SIM card...")
+        try:
+            sl.wait_for_card(newcardonly=True)
+        except NoMoreCardsError:
+            log.info("No more SIM cards")
+            break
+
+        with card_log_context(new_card_log_id()):
+            card_result = CardResult()
             try:
-                df = get_filtered_dataframe(args.CSV_FILE, filter_command)
+                with record_card(inputs.results, card_result, args, reader_number):
+                    process_card(sl, scc, args, inputs, card_result)
+            except WriteDeclinedError as e:
+                log.info("%s.  Skipping card", e)
+                result.cards_skipped += 1
             except Exception as e:
                 log.error(f"({e.__class__.__name__}) {e}")
-                return 1
-        ############################################################################
+                result.cards_failed += 1
+            else:
+                if card_result.skipped:
+                    result.cards_skipped += 1
+                else:
+                    result.cards_succeeded += 1
+
+        if args.multiple:
+            log.info("Eject the sim card, and plug in another card.")
+        else:
+            log.info("Done!")
+            break
 
-        # Checking that FieldValue's length in bytes matches binary size of field (since we want to completely overwrite each field)
-        # if we can read the binary size, but it doesn't match FieldValue's length in bytes, then it will raise a ValueError
-        # and we alert user to fix the input file
-        log.info("Checking that csv field values span full width of field")
 
-        try:
-            df.apply(
-                lambda row: verify_full_field_width(
-                    card, row["FieldName"], row["FieldValue"]
-                ),
-                axis=1,
+def get_reader_numbers(args) -> Optional[List[int]]:
+    """Returns the PC/SC reader numbers of --readers, or of every connected reader with --all-readers
+
+    Returns None for a single reader (an empty list if --all-readers found no readers)
+    """
+    if args.all_readers:
+        return list_pcsc_reader_numbers()
+    return args.readers
+
+
+def run_multiple_readers(
+    args,
+    inputs: CardInputs,
+    reader_numbers: List[int],
+    trace_sink: Optional[TraceSink] = None,
+) -> int:
+    log.info(f"Starting workers for PC/SC readers: {reader_numbers}")
+    if args.multiple:
+        log.info("Press Ctrl+C to exit.\n")
+
+    results = run_reader_workers(
+        reader_numbers,
+        lambda reader_number, result: run_reader(
+            args, inputs, reader_number, result, trace_sink
+        ),
+    )
+
+    for result in results:
+        if result.error is not None:
+            log.error(
+                f"[Reader {result.reader_number}]: Stopped with ({result.error.__class__.__name__}) {result.error}"
             )
+        log.info(
+            f"[Reader {result.reader_number}]: {result.cards_succeeded} succeeded, {result.cards_failed} failed, {result.cards_skipped} skipped"
+        )
+
+    return 0 if all(result.ok for result in results) else 1
+
+
+def run(args, trace_sink: Optional[TraceSink] = None) -> int:
+    ############################################################################
+    plan = None
+    templates = {}  # type: Dict[str, FieldTemplate]
+    card_filter = None
+    bulk_input = None
+    journal = None
+    if not args.filter or args.filter_persistent:
+        # If no filter script, then parse and validate CSV immediately, and compile it once for all cards.
+        # A filter plugin or persistent filter command filters this plan for each card
+        try:
+            if args.CSV_FILE is not None:
+                fields = read_field_table(args.CSV_FILE)
+                check_that_fields_are_valid(fields, allow_templates=True)
+            else:
+                # Every field comes from the bulk input file
+                fields = FieldTable([], [])
+            plan, templates = get_plan_and_templates(fields, args)
+            if args.filter_plugin:
+                card_filter = load_filter_plugin(args.filter_plugin[0])
+            elif args.filter:
+                card_filter = FilterCoprocess(
+                    args.filter, protocol=args.filter_protocol, timeout=args.filter_timeout
+                )
+            # Indexed last, so its temporary index file is only created if everything else loaded
+            if args.bulk_input:
+                bulk_input = BulkInput(args.bulk_input, key=args.bulk_key)
         except Exception as e:
             log.error(f"({e.__class__.__name__}) {e}")
             return 1
+    ############################################################################
 
-        ############################################################################
+    plan_prefetcher = None
+    executor = None
+    results = None
+    try:
+        reader_numbers = get_reader_numbers(args)
+        if reader_numbers is not None and not reader_numbers:
+            log.error("No PC/SC readers found")
+            return 1
 
-        if args.write:
-            if not args.skip_write_prompt:
-                ask_write = input(f"Sure you want to write? [y/N] ")
-                if ask_write.lower() != "y":
-                    log.info("You chose to not write.  Quitting")
-                    return 0
-
-            # Need ADM Key if Writing Values to SimCard
-            if args.pin_adm is not None:
-                pin_adm = args.pin_adm
-            elif args.pin_adm_json is not None:
-                pin_adm = args.pin_adm_json.get(imsi, None)
-                if pin_adm is None:
-                    log.error(f"IMSI {imsi} is not found in PIN ADM JSON file")
-                    return 1
+        if args.journal:
+            try:
+                journal = ProvisioningJournal(args.journal)
+            except Exception as e:
+                log.error(f"({e.__class__.__name__}) Failed to open journal {args.journal}: {e}")
+                return 1
 
+        if args.output:
             try:
-                check_pin_adm(card, pin_adm)
+                results = open_result_sink(args.output)
             except Exception as e:
-                log.error(f"({e.__class__.__name__}) {e}")
+                log.error(f"({e.__class__.__name__}) Failed to open results file {args.output}: {e}")
                 return 1
 
-        #############################################################################
+        if args.pipeline:
+            executor = ThreadPoolExecutor(thread_name_prefix="prepare-card")
+            if plan is None and not args.ask_filter_args:
+                # Keep the next card's --filter output ready for each reader
+                plan_prefetcher = Prefetcher(
+                    lambda: get_filtered_plan_and_templates(args, args.filter),
+                    depth=len(reader_numbers) if reader_numbers else 1,
+                    name="filter",
+                )
 
-        # For each FieldName, FieldValue pair, write the value
-        df.apply(
-            lambda row: read_write_to_fieldname(
-                card,
-                row["FieldName"],
-                row["FieldValue"],
-                dry_run=not args.write,
-                report_differences=args.show_diff,
-            ),
-            axis=1,
+        inputs = CardInputs(
+            plan,
+            templates,
+            SequenceCounter(args.template_counter_start),
+            card_filter=card_filter,
+            bulk_input=bulk_input,
+            journal=journal,
+            plan_prefetcher=plan_prefetcher,
+            executor=executor,
+            results=results,
         )
+        return run_cards(args, inputs, reader_numbers, trace_sink)
+    finally:
+        if plan_prefetcher is not None:
+            plan_prefetcher.close()
+        if executor is not None:
+            executor.shutdown(wait=True)
+        if results is not None:
+            results.close()
+        if journal is not None:
+            journal.close()
+        if isinstance(card_filter, FilterCoprocess):
+            card_filter.close()
+        if bulk_input is not None:
+            bulk_input.close()
+
+
+def run_cards(
+    args,
+    inputs: CardInputs,
+    reader_numbers: Optional[List[int]] = None,
+    trace_sink: Optional[TraceSink] = None,
+) -> int:
+    """reader_numbers: PC/SC readers to run a worker for each (see get_reader_numbers), or None for a single reader"""
+    if reader_numbers is not None:
+        return run_multiple_readers(args, inputs, reader_numbers, trace_sink)
+
+    apdu_tracer = ApduCostTracer(trace_sink) if trace_sink else None
+    try:
+        sl, scc = initialize_card_reader_and_commands(args, apdu_tracer)
+    except Exception as e:
+        log.error(f"({e.__class__.__name__}) {e}")
+        return 1
+
+    while True:
+        # Wait for SIM card
+        log.info("Waiting for new SIM card...")
+        try:
+            sl.wait_for_card(newcardonly=True)
+        except NoMoreCardsError:
+            # Only --virtual-card runs out of cards.  NoCardError of a real reader is an error
+            log.info("No more SIM cards")
+            break
+
+        with card_log_context(new_card_log_id()):
+            card_result = CardResult()
+            try:
+                with record_card(inputs.results, card_result, args):
+                    process_card(sl, scc, args, inputs, card_result)
+            except WriteDeclinedError:
+                log.info("You chose to not write.  Quitting")
+                return 0
+            except Exception as e:
+                log.error(f"({e.__class__.__name__}) {e}")
+                return 1
 
         if args.multiple:
             log.info(
@@ -1086,14 +1202,3 @@ def main():
 
     return 0
 
-
-def main_safe():
-    try:
-        sys.exit(main())
-    except Exception as e:
-        log.exception(e)
-        sys.exit(1)
-
-
-if __name__ == "__main__":
-    main_safe()
@@ -0,0 +1,282 @@
+import csv
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sim_csv_script.exceptions import BulkInputError
+
+# Field names and values are validated with sim_csv_script.validation, which imports pySim's field maps.
+# It is imported when a file is indexed, since the command line options use the constants of this module
+
+log = logging.getLogger(__name__)
+
+BULK_KEY_ICCID = "iccid"
+BULK_KEY_IMSI = "imsi"
+BULK_KEYS = (BULK_KEY_ICCID, BULK_KEY_IMSI)
+
+# wide: one row per card, with a column for each field (e.g. ICCID,SPN,IMPI)
+# long: one row per field of a card (ICCID,FieldName,FieldValue), the rows of a card don't have to be next to each other
+BULK_FORMAT_WIDE = "wide"
+BULK_FORMAT_LONG = "long"
+
+# Rows parsed, validated and inserted into the index at a time while indexing
+INDEX_BATCH_ROWS = 10000
+
+RULE_EMPTY_KEY = "empty key"
+
+# Indexing stops after this many problems, since they usually repeat for every row
+MAX_PROBLEMS_REPORTED = 50
+
+
+def normalize_key(key: str) -> str:
+    return key.strip().lower()
+
+
+class BulkInput:
+    """Per-card FieldValues from a bulk input CSV file, keyed by ICCID or IMSI
+
+    The file is streamed once at startup, and the byte offset of each row is stored in an SQLite index
+    in a temporary file, so memory use doesn't grow with the number of cards.  For each card,
+    lookup() reads only that card's rows.  Each row must be a single line.
+
+    Safe to share between reader workers.
+    """
+
+    def __init__(self, path: str, *, key: Optional[str] = None):
+        """
+        key: BULK_KEY_ICCID or BULK_KEY_IMSI column to look up cards by.  Defaults to the ICCID column if the file has one
+
+        BulkInputError: if the file's header is invalid, or any row is invalid
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "rb")
+        self._index_path = None  # type: Optional[str]
+        self._db = None  # type: Optional[sqlite3.Connection]
+        try:
+            self._read_header(key)
+            self._build_index()
+        except Exception:
+            self.close()
+            raise
+
+    ############################################################################
+
+    def _read_header(self, key: Optional[str]):
+        from sim_csv_script.fields import is_valid_field_name
+
+        header_line = self._file.readline()
+        self._first_row_offset = self._file.tell()
+        header = next(csv.reader([header_line.decode("utf-8-sig")]), [])
+        columns = {column.strip().lower(): i for i, column in enumerate(header)}
+
+        if key is None:
+            key = BULK_KEY_ICCID if BULK_KEY_ICCID in columns else BULK_KEY_IMSI
+        if key not in columns:
+            raise BulkInputError(f"Bulk input file {self.path} has no {key.upper()} column")
+        self.key = key
+        self._key_index = columns[key]
+
+        if "fieldname" in columns and "fieldvalue" in columns:
+            self.format = BULK_FORMAT_LONG
+            self._name_index = columns["fieldname"]
+            self._value_index = columns["fieldvalue"]
+            self.field_names = []  # type: List[str]
+        else:
+            self.format = BULK_FORMAT_WIDE
+            # Columns other than the ICCID and IMSI columns are fields
+            self._field_columns = [
+                (i, column.strip())
+                for i, column in enumerate(header)
+                if column.strip().lower() not in BULK_KEYS
+            ]
+            self.field_names = [field_name for _, field_name in self._field_columns]
+            invalid_field_names = [
+                field_name for field_name in self.field_names if not is_valid_field_name(field_name)
+            ]
+            if invalid_field_names:
+                raise BulkInputError(
+                    f"Invalid Field Names in bulk input file {self.path} header: {invalid_field_names}"
+                )
+            duplicate_field_names = sorted(
+                {field_name for field_name in self.field_names if self.field_names.count(field_name) > 1}
+            )
+            if duplicate_field_names:
+                raise BulkInputError(
+                    f"Duplicate Field Names in bulk input file {self.path} header: {duplicate_field_names}"
+                )
+
+    def _row_fields(self, row: List[str]) -> List[Tuple[str, str]]:
+        """(FieldName, FieldValue) of a row.  Empty cells of the wide format are left out"""
+        if self.format == BULK_FORMAT_LONG:
+            return [(_cell(row, self._name_index), _cell(row, self._value_index))]
+        return [
+            (field_name, _cell(row, i))
+            for i, field_name in self._field_columns
+            if _cell(row, i) != ""
+        ]
+
+    def _build_index(self):
+        from sim_csv_script.validation import format_field_problems
+
+        start = time.perf_counter()
+        fd, self._index_path = tempfile.mkstemp(prefix="sim_csv_script_bulk_", suffix=".sqlite3")
+        os.close(fd)
+        self._db = sqlite3.connect(self._index_path, check_same_thread=False)
+        # The index is rebuilt on every run, so it doesn't need to survive a crash
+        self._db.execute("PRAGMA journal_mode = OFF")
+        self._db.execute("PRAGMA synchronous = OFF")
+        self._db.execute("CREATE TABLE rows (key TEXT NOT NULL, offset INTEGER NOT NULL)")
+
+        problems = []  # type: List
+        num_rows = 0
+        offset = self._first_row_offset
+        line_number = 2
+        batch = []  # type: List[Tuple[int, int, str]]
+        for line in self._file:
+            if line.strip():
+                batch.append((line_number, offset, line.decode("utf-8")))
+            offset += len(line)
+            line_number += 1
+            if len(batch) >= INDEX_BATCH_ROWS:
+                num_rows += self._index_batch(batch, problems)
+                batch = []
+            if len(problems) >= MAX_PROBLEMS_REPORTED:
+                break
+        num_rows += self._index_batch(batch, problems)
+
+        if problems:
+            raise BulkInputError(
+                f"Bulk input file {self.path}: "
+                + format_field_problems(sorted(problems, key=lambda problem: problem.row)[:MAX_PROBLEMS_REPORTED])
+            )
+
+        if self.format == BULK_FORMAT_WIDE:
+            try:
+                self._db.execute("CREATE UNIQUE INDEX rows_key ON rows (key)")
+            except sqlite3.IntegrityError:
+                duplicates = [
+                    key
+                    for key, in self._db.execute(
+                        "SELECT key FROM rows GROUP BY key HAVING COUNT(*) > 1 LIMIT 10"
+                    )
+                ]
+                raise BulkInputError(
+                    f"Duplicate {self.key.upper()}s in bulk input file {self.path}: {duplicates}"
+                )
+        else:
+            self._db.execute("CREATE INDEX rows_key ON rows (key)")
+        self._db.commit()
+
+        self.num_cards = self._db.execute("SELECT COUNT(DISTINCT key) FROM rows").fetchone()[0]
+        log.info(
+            f"Indexed {self.num_cards} cards ({num_rows} rows) of bulk input file {self.path} by {self.key.upper()} "
+            f"in {time.perf_counter() - start:.2f} seconds"
+        )
+
+    def _index_batch(self, batch: Sequence[Tuple[int, int, str]], problems: List) -> int:
+        """Validates a batch of (line number, offset, line), and inserts the rows into the index.  Problems found are appended to problems"""
+        from sim_csv_script.fields import is_valid_field_name
+        from sim_csv_script.validation import (
+            FieldProblem,
+            RULE_INVALID_NAME,
+            all_field_values_valid,
+            find_value_problems,
+        )
+
+        if not batch:
+            return 0
+        rows = list(csv.reader([line for _, _, line in batch]))
+        if len(rows) != len(batch):
+            raise BulkInputError(f"Bulk input file {self.path} has a row that spans more than one line")
+
+        index_rows = []
+        field_names = []
+        field_values = []
+        for (line_number, offset, _), row in zip(batch, rows):
+            key = normalize_key(_cell(row, self._key_index))
+            if not key:
+                problems.append(
+                    FieldProblem(line_number - 2, self.key.upper(), RULE_EMPTY_KEY, f"{self.key.upper()} is empty")
+                )
+            index_rows.append((key, offset))
+            for field_name, field_value in self._row_fields(row):
+                field_names.append((line_number, field_name))
+                field_values.append(field_value)
+
+        # Most batches are valid, and only cost one check of all their values
+        if self.format == BULK_FORMAT_LONG:
+            for line_number, field_name in field_names:
+                if not is_valid_field_name(field_name):
+                    problems.append(FieldProblem(line_number - 2, field_name, RULE_INVALID_NAME, "Invalid Field Name"))
+        if not all_field_values_valid(field_values):
+            for (line_number, field_name), field_value in zip(field_names, field_values):
+                problems.extend(find_value_problems(line_number - 2, field_name, field_value))
+
+        self._db.executemany("INSERT INTO rows VALUES (?, ?)", index_rows)
+        return len(index_rows)
+
+    ############################################################################
+
+    def __len__(self):
+        return self.num_cards
+
+    def card_key(self, iccid: Optional[str], imsi: Optional[str]) -> Optional[str]:
+        """Returns the ICCID or IMSI that the card is looked up by"""
+        return iccid if self.key == BULK_KEY_ICCID else imsi
+
+    def lookup(self, iccid: Optional[str], imsi: Optional[str]) -> Dict[str, str]:
+        """Returns FieldName => FieldValue of the card
+
+        BulkInputError: if the card is not in the bulk input file
+        """
+        key = self.card_key(iccid, imsi)
+        if not key:
+            raise BulkInputError(f"Can't look up card in bulk input file, since its {self.key.upper()} can't be read")
+
+        fields = {}  # type: Dict[str, str]
+        with self._lock:
+            offsets = [
+                offset
+                for offset, in self._db.execute(
+                    "SELECT offset FROM rows WHERE key = ? ORDER BY offset", (normalize_key(key),)
+                )
+            ]
+            lines = []
+            for offset in offsets:
+                self._file.seek(offset)
+                lines.append(self._file.readline().decode("utf-8"))
+
+        if not lines:
+            raise BulkInputError(f"{self.key.upper()} {key} is not in bulk input file {self.path}")
+        for row in csv.reader(lines):
+            for field_name, field_value in self._row_fields(row):
+                if field_name in fields:
+                    raise BulkInputError(
+                        f"Duplicate Field Name {field_name} for {self.key.upper()} {key} in bulk input file {self.path}"
+                    )
+                fields[field_name] = field_value
+        return fields
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        if self._index_path is not None:
+            try:
+                os.remove(self._index_path)
+            except OSError:
+                pass
+            self._index_path = None
+        self._file.close()
+
+    def __repr__(self):
+        return f"BulkInput({self.path}, {self.format}, key={self.key})"
+
+
+def _cell(row: List[str], i: int) -> str:
+    return row[i].strip() if i < len(row) else ""
@@ -0,0 +1,596 @@
+import argparse
+import json
+import logging
+import os
+import sys
+
+from sim_csv_script.bulk import BULK_KEYS
+from sim_csv_script.logging_utils import (
+    LOG_FORMATS,
+    LOG_FORMAT_JSONL,
+    LOG_FORMAT_TEXT,
+    CardLogFilter,
+    JsonLinesFormatter,
+    QueuedFileHandler,
+)
+from sim_csv_script.pin_store import PIN_ADM_KEYS, PIN_ADM_KEY_IMSI, PinAdmStore
+from sim_csv_script.filters import (
+    DEFAULT_FILTER_TIMEOUT,
+    FILTER_PROTOCOLS,
+    FILTER_PROTOCOL_CSV,
+)
+from sim_csv_script.policies import (
+    DEFAULT_DELTA_MERGE_GAP,
+    DEFAULT_VERIFY_SAMPLE_RATE,
+    VERIFICATION_POLICIES,
+    VERIFY_FULL,
+)
+from sim_csv_script.readers import ReaderListArgType
+from sim_csv_script.results import get_result_format
+from sim_csv_script.templates import DEFAULT_TEMPLATE_COUNTER_START
+
+# Command line entry point.  Only light modules are imported here, so that --version, --help and the
+# option errors don't pay for importing the pySim card stack (see tools/benchmark_startup.py).
+# The modules that read and write cards are imported once the arguments are parsed.
+
+LOG_FORMAT = "[%(levelname)s] %(message)s"
+MULTI_READER_LOG_FORMAT = "[%(levelname)s] [%(threadName)s] %(message)s"
+
+# Console script that builds an ADM pin index for --pin-adm-index (see index_main)
+INDEX_PROG = "sim_csv_script_index"
+
+log = logging.getLogger(__name__)
+
+# Logger of the whole package, so the log file gets the messages of every module
+package_log = logging.getLogger("sim_csv_script")
+
+
+############################################################################
+
+
+def setup_logging_basic_config():
+    # Log records don't need the process, which is the same for every record
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    logging.basicConfig(
+        level=logging.INFO,
+        format=LOG_FORMAT,
+        handlers=[logging.StreamHandler()],
+    )
+
+
+def FileArgType(filename):
+    """
+    Used as argparse type validator
+
+    Checks that file exists
+    """
+    if not os.path.exists(filename):
+        raise argparse.ArgumentTypeError(f"File '{filename}' does not exist")
+    return filename
+
+
+def CSVFileArgType(filename):
+    """
+    Used as argparse type validator
+
+    Checks that file exists, and does basic check for filename ending with ".csv"
+    """
+    filename = FileArgType(filename)
+
+    if not filename.lower().endswith(".csv"):
+        raise argparse.ArgumentTypeError(f"Check that '{filename}' ends with '.csv'")
+
+    return filename
+
+
+def JSONFileArgType(filename):
+    """
+    Used as argparse type validator
+
+    Checks that file exists, and does basic check for filename ending with ".json"
+    """
+    filename = FileArgType(filename)
+
+    if not filename.lower().endswith(".json"):
+        raise argparse.ArgumentTypeError(f"Check that '{filename}' ends with '.json'")
+
+    try:
+        json_dict = json.load(open(filename, "r"))
+    except Exception:
+        raise argparse.ArgumentTypeError(f"Failed to parse JSON file {filename}")
+
+    return json_dict
+
+
+def PinAdmIndexArgType(filename):
+    """
+    Used as argparse type validator
+
+    Checks that file exists, and opens it as an ADM pin index.  Pins are only read when they are looked up
+    """
+    filename = FileArgType(filename)
+
+    try:
+        return PinAdmStore(filename)
+    except Exception as e:
+        raise argparse.ArgumentTypeError(f"Failed to open ADM pin index {filename}: {e}")
+
+
+def ResultFileArgType(filename):
+    """
+    Used as argparse type validator
+
+    Checks that filename ends with the extension of a results format
+    """
+    try:
+        get_result_format(filename)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return filename
+
+
+def FieldNameListArgType(value):
+    """
+    Used as argparse type validator
+
+    Parses comma separated FieldNames (e.g. "SPN,IMPI").  They are checked to be valid field names after parsing
+    """
+    field_names = [field_name.strip() for field_name in value.split(",") if field_name.strip() != ""]
+    if not field_names:
+        raise argparse.ArgumentTypeError("At least one FieldName is required")
+    return field_names
+
+
+def get_package_version() -> str:
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:
+        # Python < 3.8
+        import pkg_resources
+
+        try:
+            return pkg_resources.require("sim_csv_script")[0].version
+        except pkg_resources.DistributionNotFound:
+            return "unknown"
+
+    try:
+        return version("sim_csv_script")
+    except PackageNotFoundError:
+        return "unknown"
+
+
+class VersionAction(argparse.Action):
+    """Same as argparse's "version" action, but only looks up the package version when --version is used"""
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS, help="show program's version number and exit"):
+        super().__init__(option_strings=option_strings, dest=dest, default=default, nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        print(get_package_version())
+        parser.exit()
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        # prog="pySim-read",
+        description="Tool for reading some parts of a SIM card",
+        epilog=f"To build an ADM pin index for --pin-adm-index, run {INDEX_PROG} (see {INDEX_PROG} --help)",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument("--version", action=VersionAction)
+    parser.add_argument(
+        "CSV_FILE",
+        help="Read FieldNames and FieldValues from CSV file",
+        type=CSVFileArgType,
+        nargs="?"
+    )
+    parser.add_argument(
+        "--list-field-names",
+        help="Lists all possible field names",
+        default=False,
+        action="store_true"
+    )
+    parser.add_argument(
+        "--type",
+        dest="card_type",
+        help="SimCard type (use '--type list' to list possible types)",
+        default="auto",
+    )
+    parser.add_argument(
+        "--log-file",
+        type=str,
+        default="sim.log",
+        help="Specify log filename",
+    )
+    parser.add_argument(
+        "--log-format",
+        choices=LOG_FORMATS,
+        default=LOG_FORMAT_TEXT,
+        help="Format of --log-file.  text: same as the console.  jsonl: one JSON object per line, with the time, level, message, and the log id, ICCID and IMSI of the card it is about",
+    )
+    parser.add_argument(
+        "--show-diff",
+        help="Show symbols that point to difference in Read and Write values",
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--apdu-trace",
+        type=str,
+        default=None,
+        metavar="JSONL_FILE",
+        help="Count and time every APDU per field and phase.  Writes a JSON summary line for each card, followed by a summary line for the whole run",
+    )
+    parser.add_argument(
+        "--output",
+        type=ResultFileArgType,
+        default=None,
+        metavar="RESULTS_FILE",
+        help="Write a result record for each card (in read and write mode): its status, ICCID, IMSI, timings, and each field's status and values before and after.  "
+        "The format is chosen by the extension.  .jsonl: one JSON object per card.  .csv or .parquet (requires pyarrow): one row per field of each card.  "
+        "The file is replaced if it exists, and written in the background",
+    )
+    parser.add_argument(
+        "--no-session-cache",
+        default=False,
+        action="store_true",
+        help="Send every SELECT to the card, instead of skipping SELECTs of files that are already selected, and read file sizes and record counts from the card every time they are needed",
+    )
+    parser.add_argument(
+        "--extended-apdu",
+        default=False,
+        action="store_true",
+        help="Use extended length APDUs to read and write large fields, if the card's ATR advertises them.  The card reader must support extended length APDUs too",
+    )
+    parser.add_argument(
+        "--max-apdu-data",
+        type=int,
+        default=None,
+        metavar="BYTES",
+        help="Max data bytes of a single READ BINARY or UPDATE BINARY APDU (default: 255 bytes per UPDATE BINARY and 256 bytes per READ BINARY, or 65535 with --extended-apdu)",
+    )
+    parser.add_argument(
+        "--keep-field-order",
+        default=False,
+        action="store_true",
+        help="Process fields in CSV order, instead of grouping them by application (ADF) and DF so that each application is selected once per card",
+    )
+    parser.add_argument(
+        "--multiple",
+        action="store_true",
+        help="If multiple, loop and wait for next card once done. Press Ctrl+C to stop",
+    )
+    parser.add_argument(
+        "--pipeline",
+        default=False,
+        action="store_true",
+        help="Prepare the fields in the background, so that the card doesn't wait for them.  "
+        "Each card's FieldValue templates, bulk input FieldValues, filter plugin or persistent filter, and ADM pin are prepared while the sizes of its fields are read.  "
+        "The output of a --filter command (without --ask-filter-args) is prepared for the next card while the current card is written, so the command runs once more than the number of cards",
+    )
+    write_group = parser.add_argument_group("write arguments")
+    write_group.add_argument(
+        "--write",
+        dest="write",
+        default=False,
+        action="store_true",
+        help="Turn on Write Mode.",
+    )
+    write_group.add_argument(
+        "--pin-adm",
+        dest="pin_adm",
+        type=str,
+        help="ADM PIN required for write mode. If it starts with '0x' it will be treated as hex. Otherwise it will be treated as ASCII.",
+    )
+    write_group.add_argument(
+        "--pin-adm-json",
+        dest="pin_adm_json",
+        type=JSONFileArgType,
+        help="JSON file with {key IMSI: value ADM PIN}. If value starts with '0x', it will be treated as hex. Otherwise it will be treated as ASCII",
+    )
+    write_group.add_argument(
+        "--pin-adm-index",
+        dest="pin_adm_index",
+        type=PinAdmIndexArgType,
+        metavar="PIN_ADM_INDEX",
+        help="ADM pin index built from a --pin-adm-json file with sim_csv_script_index.  Each card's ADM pin is looked up by its IMSI (or ICCID) in the index, instead of loading the whole JSON file at startup",
+    )
+    write_group.add_argument(
+        "--delta-write",
+        default=False,
+        action="store_true",
+        help="Only write the changed byte ranges of transparent fields (instead of the whole field), and only read back those ranges to verify",
+    )
+    write_group.add_argument(
+        "--delta-merge-gap",
+        type=int,
+        default=DEFAULT_DELTA_MERGE_GAP,
+        metavar="BYTES",
+        help=f"With --delta-write, changed ranges at most this many bytes apart are written with a single UPDATE BINARY (default {DEFAULT_DELTA_MERGE_GAP})",
+    )
+    write_group.add_argument(
+        "--verify",
+        dest="verification",
+        choices=VERIFICATION_POLICIES,
+        default=VERIFY_FULL,
+        help="How written fields are verified.  full: read back the whole field after writing it.  "
+        "The other policies read back less, trading verification for speed.  "
+        "ranged: read back only the written byte ranges or records (same as full, unless --delta-write or fields that use records).  "
+        "deferred: same as ranged, but all fields are read back together after the card's last field was written.  "
+        "sampled: same as ranged, but only for a random sample of cards (see --verify-sample-rate).  "
+        f"(default {VERIFY_FULL})",
+    )
+    write_group.add_argument(
+        "--verify-sample-rate",
+        type=float,
+        default=DEFAULT_VERIFY_SAMPLE_RATE,
+        metavar="RATE",
+        help=f"With --verify sampled, fraction of cards (0 to 1) that are verified (default {DEFAULT_VERIFY_SAMPLE_RATE})",
+    )
+    write_group.add_argument(
+        "--skip-write-prompt",
+        help="Don't show write prompt for each card to speed up writing",
+        default=False,
+        action="store_true",
+    )
+    write_group.add_argument(
+        "--journal",
+        default=None,
+        metavar="JOURNAL_FILE",
+        help="SQLite file that records each card written (by ICCID), and the outcome of each of its fields.  It is created if it doesn't exist.  Cards that the journal has as completed with the same FieldValues are skipped, and cards that were not completed only get their remaining fields written",
+    )
+    write_group.add_argument(
+        "--fingerprint-fields",
+        type=FieldNameListArgType,
+        default=None,
+        metavar="FIELDS",
+        help="Comma separated FieldNames (e.g. SPN,IMPI) that are read first from each card.  If the card already has all their FieldValues, it is skipped without reading the rest of the fields.  Pick fields that are different for each card",
+    )
+    filter_group = parser.add_argument_group("filter arguments")
+    filter_group.add_argument(
+        "--filter",
+        nargs="+",
+        default=[],
+        help="Supply a command that receives the CSV file from STDIN, modifies it, and outputs the new CSV file to STDOUT.  Unchanging filter arguments can be supplied immediately after the command.  If different arguments are needed per card, then set --ask-filter-args and it will ask for new arguments that will be appended to this --filter command.",
+    )
+    filter_group.add_argument(
+        "--filter-persistent",
+        default=False,
+        action="store_true",
+        help="Start the --filter command once, and send it the fields of every card over its STDIN instead of running it for each card.  The command must keep reading requests and writing responses in the --filter-protocol until its STDIN is closed.",
+    )
+    filter_group.add_argument(
+        "--filter-protocol",
+        choices=FILTER_PROTOCOLS,
+        default=FILTER_PROTOCOL_CSV,
+        help="Framing of requests and responses with --filter-persistent.  csv: the CSV file followed by a line with a single '.'.  jsonl: one JSON object per line, which also has the card's ICCID, IMSI and filter arguments (default csv)",
+    )
+    filter_group.add_argument(
+        "--filter-timeout",
+        type=float,
+        default=DEFAULT_FILTER_TIMEOUT,
+        metavar="SECONDS",
+        help=f"With --filter-persistent, seconds to wait for the response for each card before the command is restarted (default {DEFAULT_FILTER_TIMEOUT})",
+    )
+    filter_group.add_argument(
+        "--filter-plugin",
+        nargs="+",
+        default=[],
+        metavar=("PLUGIN", "ARGS"),
+        help="Supply a Python filter function as module:function, path/to/file.py:function, or the name of a sim_csv_script.filters entry point.  It is loaded once, and called in-process for each card with the fields and the card's ICCID, IMSI and filter arguments, instead of running a --filter command per card.  Unchanging filter arguments can be supplied immediately after the plugin.",
+    )
+    filter_group.add_argument(
+        "--ask-filter-args",
+        action="store_true",
+        help="Only works when --filter or --filter-plugin is set.  For each card, prompt user for arguments that will be appended to the --filter command, or passed to the --filter-plugin.",
+    )
+    template_group = parser.add_argument_group("FieldValue template arguments")
+    template_group.add_argument(
+        "--template-counter-start",
+        type=int,
+        default=DEFAULT_TEMPLATE_COUNTER_START,
+        metavar="N",
+        help=f"Value of the {{counter}} placeholder in FieldValue templates for the first card.  It is incremented for each card (default {DEFAULT_TEMPLATE_COUNTER_START})",
+    )
+    bulk_input_group = parser.add_argument_group("bulk input arguments")
+    bulk_input_group.add_argument(
+        "--bulk-input",
+        type=FileArgType,
+        default=None,
+        metavar="BULK_CSV_FILE",
+        help="CSV file with the FieldValues of each card, looked up by the card's ICCID or IMSI and added to the fields of CSV_FILE (which is then optional).  Either one row per card with an ICCID or IMSI column and a column for each FieldName, or one row per field with ICCID or IMSI, FieldName and FieldValue columns.  The file is indexed once at startup, and isn't loaded into memory.",
+    )
+    bulk_input_group.add_argument(
+        "--bulk-key",
+        choices=BULK_KEYS,
+        default=None,
+        help="Column of --bulk-input to look up cards by (default iccid if the file has an ICCID column, otherwise imsi)",
+    )
+    readers_group = parser.add_argument_group("multiple reader arguments")
+    readers_group.add_argument(
+        "--readers",
+        type=ReaderListArgType,
+        default=None,
+        help="Comma separated PC/SC reader numbers (e.g. 0,1,2,3).  Runs an independent worker for each reader, so cards in different readers are processed at the same time.",
+    )
+    readers_group.add_argument(
+        "--all-readers",
+        default=False,
+        action="store_true",
+        help="Same as --readers, but uses every connected PC/SC reader",
+    )
+    from pySim.transport import argparse_add_reader_args
+
+    parser = argparse_add_reader_args(parser)
+    virtual_card_group = parser.add_argument_group("Virtual Card")
+    virtual_card_group.add_argument(
+        "--virtual-card",
+        dest="virtual_card",
+        type=FileArgType,
+        default=None,
+        metavar="SPEC_JSON",
+        help="Use simulated cards described by a JSON file instead of a card reader (for testing and benchmarking without hardware)",
+    )
+
+    # use PC/SC reader as default
+    parser.set_defaults(pcsc_dev=0)
+
+    args = parser.parse_args()
+
+
+    if args.card_type == "list":
+        from pySim.cards import _cards_classes
+
+        print(repr([card_cls.name for card_cls in _cards_classes]))
+        parser.exit()
+
+    if args.list_field_names:
+        from sim_csv_script.fields import ALL_FieldName_to_EF
+
+        print(repr(list(ALL_FieldName_to_EF.keys())))
+        parser.exit()
+
+    if args.CSV_FILE is None and args.bulk_input is None:
+        parser.error("the following arguments are required: CSV_FILE")
+
+    if args.write:
+        pin_adm_sources = [args.pin_adm, args.pin_adm_json, args.pin_adm_index]
+        if all(pin_adm_source is None for pin_adm_source in pin_adm_sources):
+            parser.error("--write requires at least one: --pin-adm, --pin-adm-json or --pin-adm-index")
+        elif sum(pin_adm_source is not None for pin_adm_source in pin_adm_sources) > 1:
+            parser.error(
+                "Only one of --pin-adm, --pin-adm-json and --pin-adm-index can be selected at the same time"
+            )
+
+    if args.journal is not None and not args.write:
+        parser.error("--journal requires --write")
+
+    if args.fingerprint_fields is not None:
+        if not args.write:
+            parser.error("--fingerprint-fields requires --write")
+
+        from sim_csv_script.fields import is_valid_field_name
+
+        invalid_field_names = [
+            field_name for field_name in args.fingerprint_fields if not is_valid_field_name(field_name)
+        ]
+        if invalid_field_names:
+            parser.error(f"Invalid --fingerprint-fields: {invalid_field_names}")
+
+    if args.filter and args.filter_plugin:
+        parser.error("--filter and --filter-plugin can't be selected at the same time")
+
+    if args.ask_filter_args:
+        if not args.filter and not args.filter_plugin:
+            parser.error("--ask-filter-args requires --filter or --filter-plugin")
+        if args.filter_persistent and args.filter_protocol == FILTER_PROTOCOL_CSV:
+            parser.error("--ask-filter-args with --filter-persistent requires --filter-protocol jsonl, which sends the filter arguments with each card")
+
+    if args.filter_persistent and not args.filter:
+        parser.error("--filter-persistent requires --filter")
+
+    if args.bulk_input is not None and args.filter and not args.filter_persistent:
+        parser.error("--bulk-input requires --filter-persistent with --filter, since the filter has to receive each card's fields")
+
+    if args.bulk_key is not None and args.bulk_input is None:
+        parser.error("--bulk-key requires --bulk-input")
+
+    if args.template_counter_start < 0:
+        parser.error("--template-counter-start must not be negative")
+
+    if args.filter_timeout <= 0:
+        parser.error("--filter-timeout must be positive")
+
+    if not 0 <= args.verify_sample_rate <= 1:
+        parser.error("--verify-sample-rate must be between 0 and 1")
+
+    if args.max_apdu_data is not None and args.max_apdu_data < 1:
+        parser.error("--max-apdu-data must be at least 1")
+
+    if args.delta_merge_gap < 0:
+        parser.error("--delta-merge-gap must not be negative")
+
+    if args.readers is not None and args.all_readers:
+        parser.error("--readers and --all-readers can't be selected at the same time")
+
+    return args
+
+
+def get_index_args(argv=None):
+    """Arguments of sim_csv_script_index, that builds an ADM pin index"""
+    parser = argparse.ArgumentParser(
+        prog=INDEX_PROG,
+        description="Builds an ADM pin index for --pin-adm-index from a JSON file with {key IMSI (or ICCID): value ADM PIN}.  The JSON file is streamed, so it doesn't have to fit in memory",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("PIN_ADM_JSON", type=FileArgType, help="JSON file with {key IMSI: value ADM PIN}")
+    parser.add_argument("PIN_ADM_INDEX", help="ADM pin index file to write.  It is replaced if it exists")
+    parser.add_argument(
+        "--key",
+        choices=PIN_ADM_KEYS,
+        default=PIN_ADM_KEY_IMSI,
+        help="Whether the keys of the JSON file are IMSIs or ICCIDs",
+    )
+    return parser.parse_args(argv)
+
+
+def index_main(argv=None) -> int:
+    from sim_csv_script.pin_store import build_pin_adm_index
+
+    setup_logging_basic_config()
+    args = get_index_args(argv)
+    try:
+        build_pin_adm_index(args.PIN_ADM_JSON, args.PIN_ADM_INDEX, key=args.key)
+    except Exception as e:
+        log.error(f"({e.__class__.__name__}) Failed to index {args.PIN_ADM_JSON}: {e}")
+        return 1
+    return 0
+
+
+def set_log_format(log_format: str):
+    formatter = logging.Formatter(log_format)
+    for handler in logging.getLogger().handlers + package_log.handlers:
+        handler.setFormatter(formatter)
+
+
+def main():
+    setup_logging_basic_config()
+    args = get_args()
+
+    multiple_readers = args.readers is not None or args.all_readers
+    if multiple_readers:
+        set_log_format(MULTI_READER_LOG_FORMAT)
+
+    # Written by a background thread, so that cards don't wait for the log file
+    file_handler = QueuedFileHandler(args.log_file)
+    file_handler.addFilter(CardLogFilter())
+    if args.log_format == LOG_FORMAT_JSONL:
+        file_handler.setFormatter(JsonLinesFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter(MULTI_READER_LOG_FORMAT if multiple_readers else LOG_FORMAT))
+    package_log.addHandler(file_handler)
+
+    from sim_csv_script.app import run
+    from sim_csv_script.tracing import TraceSink
+
+    trace_sink = TraceSink(args.apdu_trace) if args.apdu_trace else None
+    try:
+        return run(args, trace_sink)
+    finally:
+        if trace_sink is not None:
+            trace_sink.close()
+        file_handler.flush()
+
+
+def main_safe():
+    try:
+        sys.exit(main())
+    except Exception as e:
+        log.exception(e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_safe()
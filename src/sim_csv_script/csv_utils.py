@@ -1,14 +1,106 @@
+import csv
 import os
-from typing import Union, IO
-import pandas as pd
+from io import StringIO
+from typing import Dict, IO, Iterator, List, Tuple, Union
 
+from sim_csv_script.exceptions import InvalidDataframeError
 
-def get_dataframe_from_csv(filename_or_buffer: Union[str, IO]):
-    # When reading in csv file into Pandas Dataframe, strip all the spaces, and get back a string
+FIELD_TABLE_COLUMNS = ("FieldName", "FieldValue")
+
+
+class FieldTable:
+    """FieldNames and FieldValues of a CSV file in CSV order, as two plain lists of strings
+
+    Used instead of a pandas DataFrame, which is much larger and slower for a few dozen rows per card.
+    to_dataframe() and from_dataframe() convert from and to pandas, if it is installed
+    """
+
+    __slots__ = ("field_names", "field_values")
+
+    def __init__(self, field_names: List[str], field_values: List[str]):
+        self.field_names = field_names
+        self.field_values = field_values
+
+    def __len__(self):
+        return len(self.field_names)
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        return zip(self.field_names, self.field_values)
+
+    def to_dict(self) -> Dict[str, str]:
+        return dict(zip(self.field_names, self.field_values))
+
+    def to_csv(self) -> str:
+        output = StringIO()
+        writer = csv.writer(output, lineterminator="\n")
+        writer.writerow(FIELD_TABLE_COLUMNS)
+        writer.writerows(self)
+        return output.getvalue()
+
+    def to_dataframe(self):
+        import pandas as pd
+
+        return pd.DataFrame(
+            {"FieldName": self.field_names, "FieldValue": self.field_values}, dtype=str
+        )
+
+    @classmethod
+    def from_dataframe(cls, df) -> "FieldTable":
+        """
+        InvalidDataframeError: if df doesn't have FieldName and FieldValue columns
+        """
+        check_field_table_columns(list(df.columns))
+        return cls(
+            [str(field_name) for field_name in df["FieldName"].to_list()],
+            [str(field_value) for field_value in df["FieldValue"].to_list()],
+        )
+
+    def __repr__(self):
+        return f"FieldTable({self.to_dict()})"
+
+    def __str__(self):
+        return self.to_csv()
+
+
+def check_field_table_columns(columns: List[str]):
+    """
+    InvalidDataframeError: if columns don't have FieldName and FieldValue
+    """
+    missing_columns = [column for column in FIELD_TABLE_COLUMNS if column not in columns]
+    if missing_columns:
+        raise InvalidDataframeError(f"CSV file is missing columns: {missing_columns}")
+
+
+def read_field_table(filename_or_buffer: Union[str, IO]) -> FieldTable:
+    """Reads FieldNames and FieldValues of a CSV file with the csv module.  Values are kept as strings
+
+    InvalidDataframeError: if the CSV file doesn't have FieldName and FieldValue columns
+    """
     if isinstance(filename_or_buffer, str):
         if not os.path.exists(filename_or_buffer):
             raise Exception(f"CSV file '{filename_or_buffer}' does not exist")
 
-    df = pd.read_csv(filename_or_buffer)
+        # utf-8-sig skips the byte order mark that some spreadsheet programs write
+        with open(filename_or_buffer, "r", newline="", encoding="utf-8-sig") as f:
+            return read_field_table(f)
+
+    reader = csv.reader(filename_or_buffer)
+    header = next(reader, [])
+    check_field_table_columns(header)
+    name_index = header.index("FieldName")
+    value_index = header.index("FieldValue")
 
-    return df
+    field_names = []
+    field_values = []
+    for row in reader:
+        if not row:
+            # Skip blank lines, same as pandas
+            continue
+        field_names.append(row[name_index] if name_index < len(row) else "")
+        field_values.append(row[value_index] if value_index < len(row) else "")
+    return FieldTable(field_names, field_values)
+
+
+def get_dataframe_from_csv(filename_or_buffer: Union[str, IO]):
+    """Same as read_field_table(), but returns a pandas DataFrame (requires pandas)"""
+    return read_field_table(filename_or_buffer).to_dataframe()
@@ -0,0 +1,780 @@
+import logging
+import random
+import time
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple
+
+from pySim.cards import SimCard, UsimCard, IsimCard
+
+from sim_csv_script.exceptions import (
+    RequiresIsimError,
+    RequiresUsimError,
+    ReadFieldError,
+    WriteFieldError,
+    VerifyFieldError,
+)
+from sim_csv_script.plan import FieldPlan, ProvisioningPlan, ADF_ISIM, ADF_USIM
+from sim_csv_script.policies import (
+    DEFAULT_DELTA_MERGE_GAP,
+    DEFAULT_VERIFY_SAMPLE_RATE,
+    VERIFICATION_POLICIES,
+    VERIFY_FULL,
+    VERIFY_DEFERRED,
+    VERIFY_SAMPLED,
+)
+from sim_csv_script.session import SessionSimCardCommands
+from sim_csv_script.transfer import TransferLimits, read_binary, update_binary
+from sim_csv_script.tracing import (
+    trace_phase,
+    PHASE_WIDTH_CHECK,
+    PHASE_READ,
+    PHASE_WRITE,
+    PHASE_VERIFY,
+    PHASE_FINGERPRINT,
+)
+
+log = logging.getLogger(__name__)
+
+HexStr = str
+
+# (offset, length) in bytes
+ByteRange = Tuple[int, int]
+
+# ADF name => (required card class, error raised if ADF or EF is missing)
+ADF_REQUIREMENTS = {
+    ADF_ISIM: (IsimCard, RequiresIsimError),
+    ADF_USIM: (UsimCard, RequiresUsimError),
+}
+
+
+############################################################################
+
+
+def file_exists(card: SimCard, ef) -> bool:
+    """Uses the card session's cached file existence when available"""
+    if isinstance(card._scc, SessionSimCardCommands):
+        return card._scc.file_exists(ef)
+    return card.file_exists(ef)
+
+
+def select_field_adf(card: SimCard, field_name: str, ef, adf: str) -> None:
+    """
+    Selects adf, and checks that ef exists in it
+
+    AssertionError: if card is not of the card class required for adf
+    RequiresIsimError / RequiresUsimError: if selecting adf fails, or ef does not exist
+    """
+    card_class, error_class = ADF_REQUIREMENTS[adf]
+    adf_label = adf.upper()
+
+    assert isinstance(card, card_class), f"[{field_name}]: SimCard is not {adf_label}"
+
+    try:
+        _, sw = card.select_adf_by_aid(adf=adf)
+    except Exception as e:
+        raise error_class(f"[{field_name}]: Select {adf_label} adf by aid: {e}")
+
+    if sw != "9000":
+        raise error_class(f"[{field_name}]: Select {adf_label} adf by aid: {sw}")
+
+    if not file_exists(card, ef):
+        raise error_class(f"[{field_name}]: {adf_label} file {ef} does not exist on card")
+
+
+def select_field(card: SimCard, field: FieldPlan) -> None:
+    """Selects the ADFs of field (if any), and checks that its EF exists"""
+    for adf in field.adfs:
+        select_field_adf(card, field.field_name, field.ef, adf)
+
+
+def read_field_width(card: SimCard, field: FieldPlan) -> Optional[int]:
+    """Returns field's size in bytes, or None if it can't be read"""
+    try:
+        return card._scc.binary_size(field.ef)
+    except Exception:
+        log.warning("[%s]: Failed to read binary size", field.field_name)
+        return None
+
+
+def read_record_width(card: SimCard, field: FieldPlan) -> Optional[int]:
+    """
+    ValueError: if field's record number is more than the number of records in the field
+
+    Returns field's record size in bytes, or None if it can't be read
+    """
+    try:
+        record_size = card._scc.record_size(field.ef)
+        number_of_records = card._scc.record_count(field.ef)
+    except Exception:
+        log.warning("[%s]: Failed to read record size", field.field_name)
+        return None
+
+    if field.record_number > number_of_records:
+        raise ValueError(
+            f"[{field.field_name}]: Invalid record number {field.record_number}. Max record number = {number_of_records}"
+        )
+    return record_size
+
+
+def check_field_width(card: SimCard, field: FieldPlan) -> Optional[int]:
+    """
+    ValueError: if field's value length in bytes != SimCard field width (or record size, for FIELD.N)
+
+    Returns field width in bytes, or None if it can't be read
+    """
+    select_field(card, field)
+    if field.record_number is not None:
+        field_width = read_record_width(card, field)
+    else:
+        field_width = read_field_width(card, field)
+    if field_width is None:
+        return None
+
+    if field_width != field.num_bytes:
+        raise ValueError(
+            f"[{field.field_name}]: Hex Str Num Bytes {field.num_bytes} != Field Width {field_width}"
+        )
+
+    log.debug("[%s]: Field Width = %d bytes", field.field_name, field_width)
+    return field_width
+
+
+def prefetch_field_widths(card: SimCard, fields: Iterable[FieldPlan]) -> None:
+    """Reads the size of each field into the card session's cache, before the FieldValues are known
+
+    Best effort: failures are left for check_field_width() to report, when it reads the size again
+    """
+    if not isinstance(card._scc, SessionSimCardCommands):
+        # Nothing would be cached
+        return
+
+    for field in fields:
+        with trace_phase(card, field.field_name, PHASE_WIDTH_CHECK):
+            try:
+                select_field(card, field)
+                if field.record_number is not None:
+                    card._scc.record_size(field.ef)
+                    card._scc.record_count(field.ef)
+                else:
+                    card._scc.binary_size(field.ef)
+            except Exception as e:
+                log.debug("[%s]: Failed to prefetch field width: %s", field.field_name, e)
+
+
+############################################################################
+
+
+def read_field(
+    card: SimCard,
+    field: FieldPlan,
+    *,
+    record_number: Optional[int] = None,
+    limits: Optional[TransferLimits] = None,
+) -> HexStr:
+    """
+    record_number: record to read, defaults to the record addressed by field (FIELD.N).  If None, all records are read
+    limits: APDU size limits of the card (short APDUs if None)
+
+    ReadFieldError: if problems reading record (for fields with records), or data (for normal fields)
+
+    Returns read_value if successful
+    """
+    field_name, ef = field.field_name, field.ef
+    if record_number is None:
+        record_number = field.record_number
+
+    if field.uses_records:
+        # NOTE: only tested to work on IMPU
+
+        if record_number is not None:
+            # Read only specific record
+            try:
+                (res, sw) = card._scc.read_record(ef, record_number)
+            except Exception as e:
+                raise ReadFieldError(
+                    f"[{field_name}]: Failed while reading binary field -- {e}"
+                )
+
+            if sw != "9000":
+                raise ReadFieldError(
+                    f"[{field_name}]: Failed while reading binary field (Status {sw})"
+                )
+
+            return res
+
+        # Read All Records
+        number_of_records = card._scc.record_count(ef)
+        records = []
+        for rec_no in range(1, number_of_records + 1):
+            try:
+                (res, sw) = card._scc.read_record(ef, rec_no)
+            except Exception as e:
+                raise ReadFieldError(
+                    f"[{field_name}]: Failed while reading record {rec_no} of {number_of_records} -- {e}"
+                )
+
+            if sw != "9000":
+                raise ReadFieldError(
+                    f"[{field_name}]: Failed while reading record {rec_no} of {number_of_records} (Status {sw})"
+                )
+
+            records.append(res)
+        return "".join(records)
+
+    # Default read
+    try:
+        read_value = read_binary(card._scc, ef, limits or TransferLimits())
+    except Exception as e:
+        raise ReadFieldError(f"[{field_name}]: Failed while reading binary field -- {e}")
+
+    return read_value
+
+
+def write_field(
+    card: SimCard,
+    field: FieldPlan,
+    value_to_write: HexStr,
+    *,
+    record_number: Optional[int] = None,
+    dry_run: bool = True,
+    limits: Optional[TransferLimits] = None,
+) -> bool:
+    """
+    record_number: record to write, defaults to the record addressed by field (FIELD.N).  If None, all records are written
+    limits: APDU size limits of the card (short APDUs if None)
+
+    AssertionError: if invalid arguments like:
+        - record_number provided when value_to_write is full field width
+        - value_to_write's number of bytes != full field width when record_number is not provided
+        - record_number is more than max number of records for this field
+
+    WriteFieldError: if problems writing record (for fields with records), or data (for normal fields)
+    """
+    field_name, ef = field.field_name, field.ef
+    if record_number is None:
+        record_number = field.record_number
+
+    if field.uses_records:
+        # NOTE: only tested to work on IMPU
+
+        # If value_to_write fills entire field, then record_number must be None
+        number_of_records = card._scc.record_count(ef)  # 10
+        field_width = card._scc.binary_size(ef)  # 750
+        record_size = field_width // number_of_records  # 75
+        value_to_write_size = len(value_to_write) // 2  # bytes
+
+        if value_to_write_size == field_width:
+            assert (
+                record_number is None
+            ), f"[{field_name}]: Value fills entire field ({field_width} bytes), so record_number must be None."
+
+        if record_number is None:
+            assert (
+                value_to_write_size == field_width
+            ), f"[{field_name}]: If didn't provide a record_number, then value must be field's full width ({field_width} bytes)"
+        else:
+            assert (
+                record_number > 0 and record_number <= number_of_records
+            ), f"[{field_name}]: Invalid record number {record_number}. Max record number = {number_of_records}"
+            assert (
+                value_to_write_size == record_size
+            ), f"[{field_name}]: Provided a record number, so value must be each record's width ({record_size} bytes)"
+
+        if record_number is None:
+            log.info(
+                "[%s]: Overwriting full field width (%d records, each with %d bytes)",
+                field_name,
+                number_of_records,
+                record_size,
+            )
+            # Overwrite Full Field Width (all records)
+            for i in range(number_of_records):
+                rec_no = i + 1
+                # Update Each Record One By One
+                write_record_hex_str = value_to_write[
+                    i * record_size * 2 : (i * record_size + record_size) * 2
+                ]
+                log.info("[%s]: Updating record %d: '%s'", field_name, rec_no, write_record_hex_str)
+                if not dry_run:
+                    try:
+                        card._scc.update_record(
+                            ef, rec_no, write_record_hex_str, conserve=True
+                        )
+                    except Exception as e:
+                        raise WriteFieldError(
+                            f"[{field_name}]: Failed to update current record {rec_no} / {number_of_records} -- {e}"
+                        )
+        else:
+            # Write to Specific Record Number
+            log.info("[%s]: Updating single record %d: '%s'", field_name, record_number, value_to_write)
+            if not dry_run:
+                try:
+                    card._scc.update_record(
+                        ef, record_number, value_to_write, conserve=True
+                    )
+                except Exception as e:
+                    raise WriteFieldError(
+                        f"[{field_name}]: Failed to update single record {record_number} / {number_of_records} -- {e}"
+                    )
+
+    else:
+        # Default write
+        log.info("[%s]: Updating data: '%s'", field_name, value_to_write)
+        if not dry_run:
+            try:
+                update_binary(card._scc, ef, value_to_write, limits or TransferLimits())
+            except Exception as e:
+                raise WriteFieldError(f"[{field_name}]: Failed to update binary -- {e}")
+
+    log.info("[%s]: Finished Writing", field_name)
+    return True
+
+
+############################################################################
+
+
+def diff_byte_ranges(current: HexStr, target: HexStr, merge_gap: int = 0) -> List[ByteRange]:
+    """Returns the (offset, length) byte ranges where target differs from current
+
+    Changed ranges separated by at most merge_gap unchanged bytes are merged into one range
+    """
+    current_bytes, target_bytes = bytes.fromhex(current), bytes.fromhex(target)
+    ranges = []  # type: List[List[int]]
+    for offset, (a, b) in enumerate(zip(current_bytes, target_bytes)):
+        if a == b:
+            continue
+        if ranges and offset - (ranges[-1][0] + ranges[-1][1]) <= merge_gap:
+            ranges[-1][1] = offset - ranges[-1][0] + 1
+        else:
+            ranges.append([offset, 1])
+    return [(offset, length) for offset, length in ranges]
+
+
+def write_binary_ranges(
+    card: SimCard, field: FieldPlan, ranges: List[ByteRange], limits: TransferLimits
+) -> None:
+    """
+    WriteFieldError: if problems writing any of the ranges
+    """
+    field_name = field.field_name
+    log.info("[%s]: Updating %d changed byte ranges (offset, length): %s", field_name, len(ranges), ranges)
+    for offset, length in ranges:
+        try:
+            update_binary(
+                card._scc, field.ef, field.value[offset * 2 : (offset + length) * 2], limits, offset
+            )
+        except Exception as e:
+            raise WriteFieldError(
+                f"[{field_name}]: Failed to update binary at offset {offset} ({length} bytes) -- {e}"
+            )
+    log.info("[%s]: Finished Writing", field_name)
+
+
+def verify_binary_ranges(
+    card: SimCard, field: FieldPlan, ranges: List[ByteRange], limits: TransferLimits
+) -> None:
+    """
+    ReadFieldError: if problems reading any of the ranges
+    VerifyFieldError: if any of the ranges doesn't match field's value after writing
+    """
+    field_name = field.field_name
+    for offset, length in ranges:
+        try:
+            read_value = read_binary(card._scc, field.ef, limits, offset, length)
+        except Exception as e:
+            raise ReadFieldError(
+                f"[{field_name}]: Failed while reading binary at offset {offset} ({length} bytes) -- {e}"
+            )
+
+        expected_value = field.value[offset * 2 : (offset + length) * 2]
+        if read_value != expected_value:
+            raise VerifyFieldError(
+                f"[{field_name}]: Verification Error at offset {offset}. FieldValue argument ('{expected_value}') != Card's value after writing ('{read_value}')"
+            )
+
+
+def diff_records(
+    current: HexStr, target: HexStr, record_size: int, first_record: int = 1
+) -> List[int]:
+    """Returns the record numbers of the records that differ between current and target
+
+    current and target are consecutive records, starting at record number first_record
+    """
+    record_chars = record_size * 2
+    return [
+        i // record_chars + first_record
+        for i in range(0, len(target), record_chars)
+        if current[i : i + record_chars] != target[i : i + record_chars]
+    ]
+
+
+def record_value(field: FieldPlan, record_size: int, record_number: int) -> HexStr:
+    """Returns the part of field's value for record_number"""
+    start = (record_number - field.first_record) * record_size * 2
+    return field.value[start : start + record_size * 2]
+
+
+def write_records(
+    card: SimCard, field: FieldPlan, record_numbers: List[int], record_size: int
+) -> None:
+    """
+    WriteFieldError: if problems writing any of the records
+    """
+    field_name = field.field_name
+    for rec_no in record_numbers:
+        write_record_hex_str = record_value(field, record_size, rec_no)
+        log.info("[%s]: Updating record %d: '%s'", field_name, rec_no, write_record_hex_str)
+        try:
+            # Record is known to differ, so no need for pySim to read it first (conserve)
+            card._scc.update_record(field.ef, rec_no, write_record_hex_str)
+        except Exception as e:
+            raise WriteFieldError(f"[{field_name}]: Failed to update record {rec_no} -- {e}")
+    log.info("[%s]: Finished Writing", field_name)
+
+
+def verify_records(
+    card: SimCard, field: FieldPlan, record_numbers: List[int], record_size: int
+) -> None:
+    """
+    ReadFieldError: if problems reading any of the records
+    VerifyFieldError: if any of the records doesn't match field's value after writing
+    """
+    field_name = field.field_name
+    for rec_no in record_numbers:
+        read_value = read_field(card, field, record_number=rec_no)
+        expected_value = record_value(field, record_size, rec_no)
+        if read_value != expected_value:
+            raise VerifyFieldError(
+                f"[{field_name}]: Verification Error in record {rec_no}. FieldValue argument ('{expected_value}') != Card's value after writing ('{read_value}')"
+            )
+
+
+def fingerprint_matches(
+    card: SimCard,
+    plan: ProvisioningPlan,
+    field_names: Sequence[str],
+    limits: Optional[TransferLimits] = None,
+) -> bool:
+    """Reads only the fingerprint fields of plan, and returns True if the card already has all their FieldValues
+
+    Stops reading at the first field that differs.  field_names must be fields of plan
+
+    Errors: errors in select_field and read_field
+    """
+    fields = {field.field_name: field for field in plan.fields}
+    for field_name in field_names:
+        field = fields[field_name]
+        with trace_phase(card, field_name, PHASE_FINGERPRINT):
+            select_field(card, field)
+            read_value = read_field(card, field, limits=limits)
+        if read_value != field.value:
+            log.info("[%s]: Fingerprint field differs, so the card is not skipped", field_name)
+            return False
+        log.info("[%s]: Fingerprint field matches", field_name)
+    return True
+
+
+############################################################################
+
+
+class FieldResult:
+    """What happened to one field of the plan on one card"""
+
+    def __init__(self, field_name: str, value: Optional[HexStr] = None):
+        self.field_name = field_name
+        # FieldValue of the plan, and the value read from the card before writing
+        self.value = value
+        self.read_value = None  # type: Optional[HexStr]
+        # Card's value read back after writing, once the written field is verified
+        self.verified_value = None  # type: Optional[HexStr]
+        self.changed = False
+        self.written = False
+        self.verified = False
+        # Byte ranges written with delta writes, or None if the whole field was written
+        self.written_ranges = None  # type: Optional[List[ByteRange]]
+        # Record numbers written, for fields that use records
+        self.written_records = None  # type: Optional[List[int]]
+        # Seconds spent on the field (reading, writing and verifying)
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return (
+            f"FieldResult({self.field_name}, changed={self.changed}, "
+            f"written={self.written}, verified={self.verified})"
+        )
+
+
+class CardResult:
+    """What happened to one card"""
+
+    def __init__(self, iccid: Optional[str] = None, imsi: Optional[str] = None):
+        self.iccid = iccid
+        self.imsi = imsi
+        # Verification policy used for this card (VERIFY_*), and whether written fields were read back
+        self.verification = None  # type: Optional[str]
+        self.verified = False
+        self.fields = []  # type: List[FieldResult]
+        # Why the card was skipped without running the plan, or None
+        self.skipped = None  # type: Optional[str]
+
+    @property
+    def fields_written(self) -> int:
+        return sum(1 for field in self.fields if field.written)
+
+    def __repr__(self):
+        return (
+            f"CardResult(iccid={self.iccid}, verification={self.verification}, verified={self.verified}, "
+            f"fields={len(self.fields)}, written={self.fields_written})"
+        )
+
+
+############################################################################
+
+
+class CardEngine:
+    """Runs a ProvisioningPlan against one card
+
+    check_widths() does the metadata-only pass over the whole plan, so that a bad field aborts
+    before anything is written.  run() then does a single traversal that reads, diffs, writes
+    and verifies each field.
+
+    Fields that use records only get the records that differ from the card written.
+
+    With delta_write, transparent fields only get the changed byte ranges written (ranges at most
+    delta_merge_gap bytes apart are merged).
+
+    verification is one of VERIFICATION_POLICIES.  With VERIFY_SAMPLED, each card is verified
+    with a probability of verify_sample_rate.
+    """
+
+    def __init__(
+        self,
+        card: SimCard,
+        plan: ProvisioningPlan,
+        *,
+        num_chars_to_display: int = 50,
+        report_differences: bool = True,
+        delta_write: bool = False,
+        delta_merge_gap: int = DEFAULT_DELTA_MERGE_GAP,
+        limits: Optional[TransferLimits] = None,
+        verification: str = VERIFY_FULL,
+        verify_sample_rate: float = DEFAULT_VERIFY_SAMPLE_RATE,
+    ):
+        if verification not in VERIFICATION_POLICIES:
+            raise ValueError(
+                f"Invalid verification policy '{verification}'. Valid policies are {list(VERIFICATION_POLICIES)}"
+            )
+
+        self.card = card
+        self.plan = plan
+        self.num_chars_to_display = num_chars_to_display
+        self.report_differences = report_differences
+        self.delta_write = delta_write
+        self.delta_merge_gap = delta_merge_gap
+        self.limits = limits if limits is not None else TransferLimits()
+        self.verification = verification
+        if verification == VERIFY_SAMPLED:
+            self.verify_card = random.random() < verify_sample_rate
+        else:
+            self.verify_card = True
+        # Application switches saved by the plan's field order, over all passes run so far
+        self.adf_switches_saved = 0
+
+    def check_widths(self) -> None:
+        """
+        Checks that each field's value spans the full width of the field
+
+        ValueError: if the field width can be read, but doesn't match the value's length in bytes
+        """
+        for field in self.plan.fields:
+            with trace_phase(self.card, field.field_name, PHASE_WIDTH_CHECK):
+                check_field_width(self.card, field)
+        self.adf_switches_saved += self.plan.adf_switches_saved
+
+    def run(
+        self,
+        *,
+        dry_run: bool = True,
+        card_result: Optional[CardResult] = None,
+        field_done: Optional[Callable[[FieldPlan, FieldResult], None]] = None,
+    ) -> CardResult:
+        """
+        field_done: called with each field and its result, once the field is finished (written fields are verified first)
+
+        Errors: errors in run_field, and in verify_field for deferred verification
+
+        Returns card_result (or a new CardResult) with the result of each field
+        """
+        if card_result is None:
+            card_result = CardResult()
+        card_result.verification = self.verification
+
+        verify_now = self.verify_card and self.verification != VERIFY_DEFERRED
+        for field in self.plan.fields:
+            started = time.perf_counter()
+            result = self.run_field(field, dry_run=dry_run, verify=verify_now)
+            result.seconds = time.perf_counter() - started
+            card_result.fields.append(result)
+            if field_done is not None and (verify_now or not result.written):
+                field_done(field, result)
+        self.adf_switches_saved += self.plan.adf_switches_saved
+
+        if not self.verify_card:
+            log.info("Not verifying this card (not in the verification sample)")
+        elif not verify_now:
+            log.info("Verifying all written fields")
+
+        if not verify_now:
+            # Written fields are finished once they are verified, or right away if the card isn't verified
+            for field, result in zip(self.plan.fields, card_result.fields):
+                if not result.written:
+                    continue
+                if self.verify_card:
+                    started = time.perf_counter()
+                    self.verify_field(field, result)
+                    result.seconds += time.perf_counter() - started
+                if field_done is not None:
+                    field_done(field, result)
+
+        written = [result for result in card_result.fields if result.written]
+        card_result.verified = bool(written) and all(result.verified for result in written)
+        return card_result
+
+    def run_field(self, field: FieldPlan, *, dry_run: bool = True, verify: bool = True) -> FieldResult:
+        """
+        verify: read back the written value (otherwise verify_field() has to be called later)
+
+        Errors:
+            errors in select_field
+            errors in read_field
+            errors in write_field
+
+            VerifyFieldError: if verification error
+        """
+        card, field_name, field_value = self.card, field.field_name, field.value
+        result = FieldResult(field_name, field_value)
+
+        with trace_phase(card, field_name, PHASE_READ):
+            select_field(card, field)
+            read_value_before_write = read_field(card, field, limits=self.limits)
+        result.read_value = read_value_before_write
+
+        self.log_values(field, read_value_before_write)
+
+        if field_value == read_value_before_write:
+            # Don't Write if Current value on card == Value to Write
+            log.info("[%s]: Skipping Write since unchanged", field_name)
+            return result
+
+        result.changed = True
+        if self.report_differences:
+            self.log_differences(field, read_value_before_write)
+
+        if dry_run:
+            return result
+
+        ####### WRITE PORTION #######
+        with trace_phase(card, field_name, PHASE_WRITE):
+            if field.uses_records:
+                self.write_changed_records(field, result)
+            elif self.delta_write:
+                self.write_changed_ranges(field, result)
+            else:
+                write_field(card, field, field_value, dry_run=False, limits=self.limits)
+        result.written = True
+
+        ####### VERIFY PORTION #######
+        if verify:
+            self.verify_field(field, result)
+        return result
+
+    def write_changed_ranges(self, field: FieldPlan, result: FieldResult) -> None:
+        ranges = diff_byte_ranges(result.read_value, field.value, self.delta_merge_gap)
+        write_binary_ranges(self.card, field, ranges, self.limits)
+        result.written_ranges = ranges
+
+    def write_changed_records(self, field: FieldPlan, result: FieldResult) -> None:
+        field_name = field.field_name
+        record_size = self.record_size(field)
+        record_numbers = diff_records(
+            result.read_value, field.value, record_size, field.first_record
+        )
+        log.info(
+            "[%s]: %d of %d records changed: %s",
+            field_name,
+            len(record_numbers),
+            len(field.value) // (record_size * 2),
+            record_numbers,
+        )
+        write_records(self.card, field, record_numbers, record_size)
+        result.written_records = record_numbers
+
+    def record_size(self, field: FieldPlan) -> int:
+        try:
+            return self.card._scc.record_size(field.ef)
+        except Exception as e:
+            raise WriteFieldError(f"[{field.field_name}]: Failed to read record size -- {e}")
+
+    def verify_field(self, field: FieldPlan, result: FieldResult) -> None:
+        """
+        Verify Changed Successfully by reading back the written field (or only the written ranges or records)
+
+        ReadFieldError: if problems reading
+        VerifyFieldError: if verification error
+        """
+        card, field_name, field_value = self.card, field.field_name, field.value
+
+        with trace_phase(card, field_name, PHASE_VERIFY):
+            # Other fields may have been selected since this field was written (deferred verification)
+            select_field(card, field)
+            if self.verification != VERIFY_FULL and result.written_records is not None:
+                verify_records(card, field, result.written_records, self.record_size(field))
+                log.info("[%s]: Verified successful write of records %s", field_name, result.written_records)
+                # The written records were read back, and the other records already had their values before writing
+                result.verified_value = field_value
+            elif self.verification != VERIFY_FULL and result.written_ranges is not None:
+                verify_binary_ranges(card, field, result.written_ranges, self.limits)
+                log.info(
+                    "[%s]: Verified successful write of %d changed bytes",
+                    field_name,
+                    sum(length for _, length in result.written_ranges),
+                )
+                # The written ranges were read back, and the other bytes already had their values before writing
+                result.verified_value = field_value
+            else:
+                read_value_after_write = read_field(card, field, limits=self.limits)
+                if field_value != read_value_after_write:
+                    raise VerifyFieldError(
+                        f"[{field_name}]: Verification Error. FieldValue argument ('{field_value}') != Card's value after writing ('{read_value_after_write}')"
+                    )
+                log.info(
+                    "[%s]: Verified successful write: Before writing ('%s') => After writing ('%s')",
+                    field_name,
+                    result.read_value,
+                    read_value_after_write,
+                )
+                result.verified_value = read_value_after_write
+
+        result.verified = True
+
+    def log_values(self, field: FieldPlan, read_value: HexStr) -> None:
+        n = self.num_chars_to_display
+        show_ellipses = "..." if len(read_value) > n else ""
+        log.info("[%s]: %-12s: %s%s", field.field_name, "Read Value", read_value[:n], show_ellipses)
+        log.info("[%s]: %-12s: %s%s", field.field_name, "Write Value", field.value[:n], show_ellipses)
+
+    def log_differences(self, field: FieldPlan, read_value: HexStr) -> None:
+        if not log.isEnabledFor(logging.INFO):
+            return
+
+        # Print the index where the differences begin
+        n = self.num_chars_to_display
+        diff_indexes = [
+            i for i, (a, b) in enumerate(zip(read_value, field.value)) if a != b
+        ]
+        diff_symbols = list(" " * n)
+        for i in diff_indexes:
+            if i >= n:
+                break
+            diff_symbols[i] = "^"
+        log.info("[%s]: %-12s: %s", field.field_name, "Differences", "".join(diff_symbols))
+        log.info("[%s]: Differences indexes: %s", field.field_name, diff_indexes)
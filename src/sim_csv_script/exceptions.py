@@ -0,0 +1,53 @@
+####################  CUSTOM EXCEPTIONS ####################################
+
+
+class InvalidFieldError(Exception):
+    pass
+
+
+class InvalidDataframeError(Exception):
+    pass
+
+
+class RequiresIsimError(Exception):
+    pass
+
+
+class RequiresUsimError(Exception):
+    pass
+
+
+class InvalidADMPinError(Exception):
+    pass
+
+
+class ReadFieldError(Exception):
+    pass
+
+
+class WriteFieldError(Exception):
+    pass
+
+
+class VerifyFieldError(Exception):
+    pass
+
+
+class FilterCSVError(Exception):
+    pass
+
+
+class WriteDeclinedError(Exception):
+    pass
+
+
+class BulkInputError(Exception):
+    pass
+
+
+class InvalidTemplateError(Exception):
+    pass
+
+
+class NoMoreCardsError(Exception):
+    pass
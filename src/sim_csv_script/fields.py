@@ -0,0 +1,29 @@
+import re
+from typing import Optional, Tuple
+
+from pySim.ts_51_011 import EF
+from pySim.ts_31_102 import EF_USIM_ADF_map
+from pySim.ts_31_103 import EF_ISIM_ADF_map
+
+ALL_FieldName_to_EF = {**EF_ISIM_ADF_map, **EF_USIM_ADF_map, **EF}
+
+FIELDS_THAT_USE_RECORDS = ("SMSP", "PCSCF", "IMPU")
+
+# FIELD.N addresses record N (starting at 1) of a field that uses records (e.g. IMPU.2)
+RECORD_FIELD_NAME_REGEX = re.compile(r"(\w+)\.([1-9][0-9]*)", re.ASCII)
+
+
+def parse_field_name(field_name: str) -> Tuple[str, Optional[int]]:
+    """Splits FIELD.N into (FIELD, N)
+
+    Returns (field_name, None) if field_name doesn't address a record of a field that uses records
+    """
+    match = RECORD_FIELD_NAME_REGEX.fullmatch(field_name)
+    if match is not None and match.group(1) in FIELDS_THAT_USE_RECORDS:
+        return match.group(1), int(match.group(2))
+    return field_name, None
+
+
+def is_valid_field_name(field_name: str) -> bool:
+    base_field_name, _ = parse_field_name(field_name)
+    return base_field_name in ALL_FieldName_to_EF
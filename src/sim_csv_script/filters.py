@@ -0,0 +1,353 @@
+import csv
+import importlib
+import importlib.util
+import json
+import logging
+import os
+import queue
+import subprocess
+import threading
+import time
+from collections import deque
+from io import StringIO
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from sim_csv_script.exceptions import FilterCSVError
+
+log = logging.getLogger(__name__)
+
+HexStr = str
+
+# Installed packages can register filter plugins under this entry point group, e.g. in setup.cfg:
+#   [options.entry_points]
+#   sim_csv_script.filters =
+#       spn_suffix = my_package.filters:spn_suffix
+FILTER_PLUGIN_ENTRY_POINT_GROUP = "sim_csv_script.filters"
+
+
+class CardContext(NamedTuple):
+    """What a filter plugin knows about the card it is filtering the fields for"""
+
+    iccid: Optional[str]
+    imsi: Optional[str]
+    # Filter arguments (after the plugin in --filter-plugin, or entered with --ask-filter-args)
+    args: Tuple[str, ...] = ()
+
+
+class FilterPlugin:
+    """Python function that modifies the fields for each card, called in-process instead of spawning a filter command
+
+    The function is called as function(fields, context), where fields is a new dict of FieldName to FieldValue
+    (lowercase hex) and context is a CardContext.  It returns the filtered dict, or None if it modified fields in place.
+    Same as a --filter command, it can change values or remove fields, but not add new fields.
+    """
+
+    def __init__(self, function: Callable, name: str):
+        self.function = function
+        self.name = name
+
+    def __call__(self, fields: Dict[str, HexStr], context: CardContext) -> Dict[str, HexStr]:
+        """
+        FilterCSVError: if the function raises, or doesn't return a dict of strings
+        """
+        fields = dict(fields)
+        try:
+            filtered_fields = self.function(fields, context)
+        except Exception as e:
+            raise FilterCSVError(f"Filter plugin {self.name} failed: ({e.__class__.__name__}) {e}")
+
+        if filtered_fields is None:
+            filtered_fields = fields
+        if not isinstance(filtered_fields, dict):
+            raise FilterCSVError(
+                f"Filter plugin {self.name} must return a dict of FieldName to FieldValue, not {type(filtered_fields).__name__}"
+            )
+        for field_name, field_value in filtered_fields.items():
+            if not isinstance(field_name, str) or not isinstance(field_value, str):
+                raise FilterCSVError(
+                    f"Filter plugin {self.name} returned a non string FieldName or FieldValue: {field_name!r}: {field_value!r}"
+                )
+        return filtered_fields
+
+    def __repr__(self):
+        return f"FilterPlugin({self.name})"
+
+
+############################################################################
+
+
+def _load_module_from_file(path: str):
+    module_name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    if spec is None:
+        raise ImportError(f"Can't import {path}")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _get_entry_points(group: str) -> List:
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        # Python < 3.8
+        import pkg_resources
+
+        return list(pkg_resources.iter_entry_points(group))
+
+    all_entry_points = entry_points()
+    if hasattr(all_entry_points, "select"):
+        return list(all_entry_points.select(group=group))
+    return list(all_entry_points.get(group, []))
+
+
+def load_filter_plugin(spec: str) -> FilterPlugin:
+    """Loads a filter plugin once, before any card is processed
+
+    spec is one of:
+        module:function (e.g. my_package.filters:spn_suffix), where module is installed or on PYTHONPATH
+        path/to/file.py:function
+        name of an entry point in the sim_csv_script.filters group
+
+    FilterCSVError: if the plugin can't be loaded, or isn't callable
+    """
+    module_name, _, function_name = spec.rpartition(":")
+    try:
+        if module_name:
+            if module_name.endswith(".py"):
+                module = _load_module_from_file(module_name)
+            else:
+                module = importlib.import_module(module_name)
+
+            function = module
+            for attribute in function_name.split("."):
+                function = getattr(function, attribute)
+        else:
+            matching_entry_points = [
+                entry_point
+                for entry_point in _get_entry_points(FILTER_PLUGIN_ENTRY_POINT_GROUP)
+                if entry_point.name == spec
+            ]
+            if not matching_entry_points:
+                raise FilterCSVError(
+                    f"No filter plugin named {spec!r} in entry point group {FILTER_PLUGIN_ENTRY_POINT_GROUP}.  Use module:function to load a plugin that isn't installed"
+                )
+            function = matching_entry_points[0].load()
+    except FilterCSVError:
+        raise
+    except Exception as e:
+        raise FilterCSVError(f"Failed to load filter plugin {spec}: ({e.__class__.__name__}) {e}")
+
+    if not callable(function):
+        raise FilterCSVError(f"Filter plugin {spec} is not callable")
+
+    log.info(f"Loaded filter plugin {spec}")
+    return FilterPlugin(function, spec)
+
+
+############################################################################
+
+FILTER_PROTOCOL_CSV = "csv"
+FILTER_PROTOCOL_JSONL = "jsonl"
+FILTER_PROTOCOLS = (FILTER_PROTOCOL_CSV, FILTER_PROTOCOL_JSONL)
+
+DEFAULT_FILTER_TIMEOUT = 10.0
+
+# Line that ends each CSV request and response frame.  CSV lines always have a comma, so they can't be mistaken for it
+CSV_FRAME_END = "."
+# First line of a CSV response frame that reports an error instead of the filtered CSV
+CSV_FRAME_ERROR_PREFIX = "ERROR"
+
+# Lines of the filter command's STDERR kept for error messages
+STDERR_LINES_KEPT = 20
+
+
+def _fields_to_csv_lines(fields: Dict[str, HexStr]) -> List[str]:
+    output = StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow(["FieldName", "FieldValue"])
+    writer.writerows(fields.items())
+    return output.getvalue().splitlines()
+
+
+def _csv_lines_to_fields(lines: List[str]) -> Dict[str, HexStr]:
+    return {row["FieldName"]: row["FieldValue"] for row in csv.DictReader(lines)}
+
+
+class FilterCoprocess:
+    """--filter command that is started once, and filters the fields of every card over its STDIN and STDOUT
+
+    Each request and response is a frame:
+        csv: the CSV file (FieldName,FieldValue header and rows), then a line with a single '.'.
+            The filter can respond with a line 'ERROR {message}' and a '.' line instead of the CSV
+        jsonl: one JSON object per line.  Requests are {"iccid", "imsi", "args", "fields"},
+            responses are {"fields": {FieldName: FieldValue}} or {"error": message}
+
+    The command is restarted for the next request if it exits, or doesn't respond within timeout seconds.
+    Safe to share between reader workers, since requests are serialized.
+    """
+
+    def __init__(
+        self,
+        command: List[str],
+        protocol: str = FILTER_PROTOCOL_CSV,
+        timeout: float = DEFAULT_FILTER_TIMEOUT,
+    ):
+        if protocol not in FILTER_PROTOCOLS:
+            raise ValueError(f"Unknown filter protocol {protocol}, must be one of {FILTER_PROTOCOLS}")
+        self.command = command
+        self.protocol = protocol
+        self.timeout = timeout
+        self.name = " ".join(command)
+        self.starts = 0
+        self._process = None  # type: Optional[subprocess.Popen]
+        self._stdout_lines = None  # type: Optional[queue.Queue]
+        self._stderr_thread = None  # type: Optional[threading.Thread]
+        self._stderr_lines = deque(maxlen=STDERR_LINES_KEPT)
+        self._lock = threading.Lock()
+
+    ############################################################################
+
+    def _start(self):
+        if self.starts:
+            log.warning(f"Restarting filter command {self.name}")
+        else:
+            log.info(f"Starting filter command {self.name}")
+        try:
+            process = subprocess.Popen(
+                self.command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+                bufsize=1,
+            )
+        except OSError as e:
+            raise FilterCSVError(f"Failed to start filter command {self.name}: {e}")
+
+        self.starts += 1
+        self._process = process
+        self._stdout_lines = queue.Queue()
+        self._stderr_lines.clear()
+        # Reading STDOUT in a thread allows a timeout on every platform, and draining STDERR keeps the filter from blocking on it
+        threading.Thread(target=self._read_stdout, args=(process.stdout, self._stdout_lines), daemon=True).start()
+        self._stderr_thread = threading.Thread(
+            target=self._read_stderr, args=(process.stderr, self._stderr_lines), daemon=True
+        )
+        self._stderr_thread.start()
+
+    @staticmethod
+    def _read_stdout(stream, lines: queue.Queue):
+        for line in stream:
+            lines.put(line.rstrip("\r\n"))
+        # End of file
+        lines.put(None)
+
+    @staticmethod
+    def _read_stderr(stream, lines: deque):
+        for line in stream:
+            lines.append(line.rstrip("\r\n"))
+
+    def _stop(self):
+        process, self._process = self._process, None
+        if process is None:
+            return
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        try:
+            process.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        self._stderr_thread.join(timeout=1)
+
+    def _failed(self, reason: str) -> FilterCSVError:
+        """Stops the command, so the next request restarts it, and returns the error to raise"""
+        self._stop()
+        stderr = "\n".join(self._stderr_lines)
+        return FilterCSVError(f"Filter command {self.name} {reason}" + (f": {stderr}" if stderr else ""))
+
+    def _read_line(self, deadline: float) -> str:
+        try:
+            line = self._stdout_lines.get(timeout=max(0, deadline - time.monotonic()))
+        except queue.Empty:
+            raise self._failed(f"did not respond within {self.timeout} seconds")
+        if line is None:
+            raise self._failed(f"exited with return code {self._process.wait()}")
+        return line
+
+    ############################################################################
+
+    def _request_lines(self, fields: Dict[str, HexStr], context: CardContext) -> List[str]:
+        if self.protocol == FILTER_PROTOCOL_JSONL:
+            request = {
+                "iccid": context.iccid,
+                "imsi": context.imsi,
+                "args": list(context.args),
+                "fields": fields,
+            }
+            return [json.dumps(request)]
+        return _fields_to_csv_lines(fields) + [CSV_FRAME_END]
+
+    def _read_response(self, deadline: float) -> Dict[str, HexStr]:
+        if self.protocol == FILTER_PROTOCOL_JSONL:
+            line = self._read_line(deadline)
+            try:
+                response = json.loads(line)
+            except ValueError:
+                raise self._failed(f"returned invalid JSON: {line!r}")
+            if not isinstance(response, dict):
+                raise self._failed(f"returned invalid response: {line!r}")
+            if "error" in response:
+                raise FilterCSVError(f"Filter command {self.name} failed: {response['error']}")
+            filtered_fields = response.get("fields")
+        else:
+            lines = []
+            while True:
+                line = self._read_line(deadline)
+                if line == CSV_FRAME_END:
+                    break
+                lines.append(line)
+            if lines and lines[0].startswith(CSV_FRAME_ERROR_PREFIX):
+                raise FilterCSVError(
+                    f"Filter command {self.name} failed: {lines[0][len(CSV_FRAME_ERROR_PREFIX):].strip()}"
+                )
+            try:
+                filtered_fields = _csv_lines_to_fields(lines)
+            except (KeyError, csv.Error):
+                raise FilterCSVError("Failed to parse filtered csv")
+
+        if not isinstance(filtered_fields, dict) or not all(
+            isinstance(field_name, str) and isinstance(field_value, str)
+            for field_name, field_value in filtered_fields.items()
+        ):
+            raise FilterCSVError(f"Filter command {self.name} must return FieldNames and FieldValues as strings")
+        return filtered_fields
+
+    def __call__(self, fields: Dict[str, HexStr], context: CardContext) -> Dict[str, HexStr]:
+        """
+        FilterCSVError: if the command fails to start, exits, times out, or returns an error or an invalid response
+        """
+        with self._lock:
+            if self._process is None or self._process.poll() is not None:
+                self._stop()
+                self._start()
+
+            deadline = time.monotonic() + self.timeout
+            try:
+                for line in self._request_lines(fields, context):
+                    self._process.stdin.write(line + "\n")
+                self._process.stdin.flush()
+            except OSError:
+                raise self._failed("exited before reading the request")
+
+            return self._read_response(deadline)
+
+    def close(self):
+        with self._lock:
+            self._stop()
+
+    def __repr__(self):
+        return f"FilterCoprocess({self.name}, {self.protocol})"
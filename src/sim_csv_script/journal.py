@@ -0,0 +1,219 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, NamedTuple, Optional
+
+from sim_csv_script.engine import FieldResult
+from sim_csv_script.plan import FieldPlan, ProvisioningPlan
+
+log = logging.getLogger(__name__)
+
+HexStr = str
+
+# Status of a card in the journal
+CARD_STARTED = "started"
+CARD_COMPLETED = "completed"
+CARD_FAILED = "failed"
+
+# Outcome of a field in the journal
+FIELD_UNCHANGED = "unchanged"
+FIELD_WRITTEN = "written"
+FIELD_VERIFIED = "verified"
+# Fields with these outcomes have the plan's value on the card, so a resumed card doesn't need them again
+FIELD_DONE_OUTCOMES = (FIELD_UNCHANGED, FIELD_WRITTEN, FIELD_VERIFIED)
+
+# Journal records are committed in groups: when a card finishes, or when a new record finds this many pending
+# or this many seconds passed since the last commit.  Records lost in a crash only cause fields to be read and compared again
+DEFAULT_JOURNAL_COMMIT_RECORDS = 200
+DEFAULT_JOURNAL_COMMIT_SECONDS = 1.0
+
+JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cards (
+    id INTEGER PRIMARY KEY,
+    iccid TEXT NOT NULL,
+    imsi TEXT,
+    plan_hash TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS cards_iccid ON cards (iccid);
+CREATE TABLE IF NOT EXISTS fields (
+    card_id INTEGER NOT NULL REFERENCES cards (id),
+    field_name TEXT NOT NULL,
+    value_hash TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    finished REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fields_card_id ON fields (card_id);
+"""
+
+
+def value_hash(field_value: HexStr) -> str:
+    """The journal keeps hashes instead of FieldValues, which can be keys"""
+    return hashlib.sha256(field_value.lower().encode()).hexdigest()[:32]
+
+
+def plan_hash(plan: ProvisioningPlan) -> str:
+    """Hash of the plan's FieldNames and FieldValues, independent of the field order"""
+    digest = hashlib.sha256()
+    for field_name, field_value in sorted((field.field_name, field.value) for field in plan.fields):
+        digest.update(f"{field_name}={field_value}\n".encode())
+    return digest.hexdigest()[:32]
+
+
+def field_outcome(result: FieldResult) -> str:
+    if result.verified:
+        return FIELD_VERIFIED
+    if result.written:
+        return FIELD_WRITTEN
+    return FIELD_UNCHANGED
+
+
+class JournalState(NamedTuple):
+    """What the journal knows about a card from previous runs"""
+
+    # The last run of the card completed with the same plan
+    completed: bool
+    # FieldName => value hash of the fields that have that value on the card, by their last record
+    done_fields: Dict[str, str]
+
+    def field_done(self, field: FieldPlan) -> bool:
+        return self.done_fields.get(field.field_name) == value_hash(field.value)
+
+
+class ProvisioningJournal:
+    """SQLite journal of the cards provisioned, and the outcome of each of their fields, by ICCID
+
+    A restarted run uses it to skip cards that were completed with the same plan,
+    and to only provision the remaining fields of cards that were not completed.
+
+    Safe to share between reader workers.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        commit_records: int = DEFAULT_JOURNAL_COMMIT_RECORDS,
+        commit_seconds: float = DEFAULT_JOURNAL_COMMIT_SECONDS,
+    ):
+        self.path = path
+        self.commit_records = commit_records
+        self.commit_seconds = commit_seconds
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # WAL with synchronous NORMAL keeps committed records after a crash of the process,
+        # and only syncs to disk at checkpoints
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+        self._db.executescript(JOURNAL_SCHEMA)
+        self._db.commit()
+        self._pending_records = 0
+        self._last_commit = time.monotonic()
+
+    ############################################################################
+
+    def _record(self, sql: str, parameters: tuple) -> sqlite3.Cursor:
+        """Executes sql, and commits the pending records as a group if enough are pending.  Requires _lock"""
+        cursor = self._db.execute(sql, parameters)
+        self._pending_records += 1
+        if (
+            self._pending_records >= self.commit_records
+            or time.monotonic() - self._last_commit >= self.commit_seconds
+        ):
+            self._commit()
+        return cursor
+
+    def _commit(self):
+        self._db.commit()
+        self._pending_records = 0
+        self._last_commit = time.monotonic()
+
+    ############################################################################
+
+    def lookup(self, iccid: str, card_plan_hash: str) -> JournalState:
+        with self._lock:
+            last_card = self._db.execute(
+                "SELECT plan_hash, status FROM cards WHERE iccid = ? ORDER BY id DESC LIMIT 1", (iccid,)
+            ).fetchone()
+            if last_card is None:
+                return JournalState(False, {})
+
+            done_fields = {}  # type: Dict[str, str]
+            rows = self._db.execute(
+                "SELECT fields.field_name, fields.value_hash, fields.outcome FROM fields "
+                "JOIN cards ON cards.id = fields.card_id WHERE cards.iccid = ? ORDER BY fields.rowid",
+                (iccid,),
+            )
+            for field_name, field_value_hash, outcome in rows:
+                if outcome in FIELD_DONE_OUTCOMES:
+                    done_fields[field_name] = field_value_hash
+                else:
+                    done_fields.pop(field_name, None)
+
+        completed = last_card == (card_plan_hash, CARD_COMPLETED)
+        return JournalState(completed, done_fields)
+
+    def start_card(self, iccid: str, imsi: Optional[str], card_plan_hash: str) -> int:
+        """Returns the journal id of this run of the card"""
+        with self._lock:
+            return self._record(
+                "INSERT INTO cards (iccid, imsi, plan_hash, status, started) VALUES (?, ?, ?, ?, ?)",
+                (iccid, imsi, card_plan_hash, CARD_STARTED, time.time()),
+            ).lastrowid
+
+    def record_field(self, card_id: int, field: FieldPlan, result: FieldResult):
+        with self._lock:
+            self._record(
+                "INSERT INTO fields VALUES (?, ?, ?, ?, ?)",
+                (card_id, field.field_name, value_hash(field.value), field_outcome(result), time.time()),
+            )
+
+    def finish_card(self, card_id: int, error: Optional[Exception] = None):
+        with self._lock:
+            self._record(
+                "UPDATE cards SET status = ?, finished = ?, error = ? WHERE id = ?",
+                (
+                    CARD_COMPLETED if error is None else CARD_FAILED,
+                    time.time(),
+                    None if error is None else f"({error.__class__.__name__}) {error}",
+                    card_id,
+                ),
+            )
+            # Committed now, since the next record may only come when the next card is inserted
+            self._commit()
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._db.close()
+
+    def __repr__(self):
+        return f"ProvisioningJournal({self.path})"
+
+
+@contextmanager
+def journal_card(journal: Optional[ProvisioningJournal], card_id: Optional[int]):
+    """Records whether the card completed or failed when the block exits (no-op if not journaling the card)
+
+    Yields the field_done callback for CardEngine.run(), or None
+    """
+    if journal is None or card_id is None:
+        yield None
+        return
+
+    def field_done(field: FieldPlan, result: FieldResult):
+        journal.record_field(card_id, field, result)
+
+    try:
+        yield field_done
+    except Exception as e:
+        journal.finish_card(card_id, e)
+        raise
+    else:
+        journal.finish_card(card_id)
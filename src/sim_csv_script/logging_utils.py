@@ -0,0 +1,197 @@
+import datetime
+import itertools
+import json
+import logging
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Deque, Optional
+
+LOG_FORMAT_TEXT = "text"
+LOG_FORMAT_JSONL = "jsonl"
+LOG_FORMATS = (LOG_FORMAT_TEXT, LOG_FORMAT_JSONL)
+
+# Card log ids are RUN-N: RUN is random for each run, and N counts the cards of the run (over all readers),
+# so the log lines, APDU trace and results of a card can be matched up
+_run_log_id = os.urandom(4).hex()
+_card_numbers = itertools.count(1)
+_card_numbers_lock = threading.Lock()
+
+# Log fields of the card that the current thread is working on
+_card_log_context = threading.local()
+
+# Queued log records are written in batches, when this many are queued or this many seconds passed since the last write
+DEFAULT_LOG_BATCH_RECORDS = 500
+DEFAULT_LOG_FLUSH_SECONDS = 0.2
+
+# Log call arguments of these types can't change before a queued record is formatted
+IMMUTABLE_LOG_ARG_TYPES = (str, bytes, int, float, bool, type(None))
+
+
+def new_card_log_id() -> str:
+    with _card_numbers_lock:
+        return f"{_run_log_id}-{next(_card_numbers)}"
+
+
+def get_card_log_fields() -> dict:
+    """Returns the log fields of the current thread's card (card_log_id, iccid and imsi), or {} outside of a card"""
+    return getattr(_card_log_context, "fields", {})
+
+
+def get_card_log_id() -> Optional[str]:
+    return get_card_log_fields().get("card_log_id")
+
+
+@contextmanager
+def card_log_context(card_log_id: str, **fields):
+    """Adds card_log_id and fields to the records logged by this thread inside this block"""
+    previous = get_card_log_fields()
+    _card_log_context.fields = {"card_log_id": card_log_id, **fields}
+    try:
+        yield
+    finally:
+        _card_log_context.fields = previous
+
+
+def set_card_log_fields(**fields):
+    """Adds fields (e.g. the card's iccid, once it is read) to the current card's log fields"""
+    card_log_fields = get_card_log_fields()
+    if card_log_fields:
+        _card_log_context.fields = {**card_log_fields, **fields}
+
+
+def with_card_log_context(function: Callable) -> Callable:
+    """Returns function, but called with the current thread's card log fields in the thread that calls it"""
+    fields = get_card_log_fields()
+    if not fields:
+        return function
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with card_log_context(**fields):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+############################################################################
+
+
+class CardLogFilter(logging.Filter):
+    """Adds the log fields of the card that the logging thread is working on to each record
+
+    Must be on a handler, which runs in the logging thread.  The fields are per thread
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        fields = get_card_log_fields()
+        record.card_log_id = fields.get("card_log_id")
+        record.iccid = fields.get("iccid")
+        record.imsi = fields.get("imsi")
+        return True
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Formats each record as a JSON object on a single line, with the log fields of its card"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "card_log_id": getattr(record, "card_log_id", None),
+            "iccid": getattr(record, "iccid", None),
+            "imsi": getattr(record, "imsi", None),
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+
+class QueuedFileHandler(logging.Handler):
+    """Log file handler that only queues the records in the logging thread
+
+    A background thread formats the queued records, and writes them to the file in batches:
+    when batch_records are queued, or flush_seconds after the last write.  flush() and close()
+    write the queued records right away.
+
+    Messages are formatted in the background thread, so their arguments must not change after
+    the logging call.  Messages with arguments that may change, and tracebacks, are formatted when queued
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        *,
+        batch_records: int = DEFAULT_LOG_BATCH_RECORDS,
+        flush_seconds: float = DEFAULT_LOG_FLUSH_SECONDS,
+    ):
+        super().__init__()
+        self.filename = filename
+        self.batch_records = batch_records
+        self.flush_seconds = flush_seconds
+        self._stream = open(filename, "a", encoding="utf-8")
+        self._records = deque()  # type: Deque[logging.LogRecord]
+        # Serializes writes of the background thread and flush()
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closing = False
+        self._writer = threading.Thread(target=self._write_loop, name="log-writer", daemon=True)
+        self._writer.start()
+
+    def emit(self, record: logging.LogRecord):
+        self._records.append(self.prepare(record))
+        if len(self._records) >= self.batch_records:
+            self._wakeup.set()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The record is shared with the other handlers, which format it the same way after these changes
+        args = record.args.values() if isinstance(record.args, dict) else record.args
+        if args and not all(isinstance(arg, IMMUTABLE_LOG_ARG_TYPES) for arg in args):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            # The frames of the traceback don't outlive the logging call
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def _write_loop(self):
+        while not self._closing:
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Writes the queued records"""
+        with self._write_lock:
+            lines = []
+            while self._records:
+                record = self._records.popleft()
+                try:
+                    lines.append(self.format(record))
+                except Exception:
+                    self.handleError(record)
+            if lines and not self._stream.closed:
+                self._stream.write("\n".join(lines) + "\n")
+                self._stream.flush()
+
+    def close(self):
+        if not self._closing:
+            self._closing = True
+            self._wakeup.set()
+            self._writer.join()
+            self.flush()
+            self._stream.close()
+        super().close()
+
+    def __repr__(self):
+        return f"QueuedFileHandler({self.filename}, {logging.getLevelName(self.level)})"
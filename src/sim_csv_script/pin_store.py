@@ -0,0 +1,226 @@
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from collections import Counter
+from typing import IO, Iterator, Optional, Tuple
+
+from sim_csv_script.exceptions import InvalidADMPinError
+
+log = logging.getLogger(__name__)
+
+PIN_ADM_KEY_IMSI = "imsi"
+PIN_ADM_KEY_ICCID = "iccid"
+PIN_ADM_KEYS = (PIN_ADM_KEY_IMSI, PIN_ADM_KEY_ICCID)
+
+# Characters of the JSON file read at a time while indexing it
+JSON_READ_CHUNK_SIZE = 1 << 20
+# ADM pins inserted into the index at a time
+INDEX_BATCH_PINS = 10000
+
+PIN_ADM_INDEX_SCHEMA = """
+CREATE TABLE metadata (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE pins (key TEXT PRIMARY KEY, pin_adm TEXT NOT NULL) WITHOUT ROWID;
+"""
+
+
+def iter_json_object_items(f: IO[str]) -> Iterator[Tuple[str, object]]:
+    """Yields the (key, value) pairs of the JSON object in f, without loading the whole file
+
+    ValueError: if f isn't a JSON object
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    end_of_file = False
+
+    def fill() -> bool:
+        """Reads the next chunk into buffer.  Returns False at the end of the file"""
+        nonlocal buffer, position, end_of_file
+        if end_of_file:
+            return False
+        chunk = f.read(JSON_READ_CHUNK_SIZE)
+        if chunk == "":
+            end_of_file = True
+            return False
+        buffer = buffer[position:] + chunk
+        position = 0
+        return True
+
+    def next_character() -> str:
+        """Skips whitespace, and returns the next character without consuming it ("" at the end of the file)"""
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position < len(buffer):
+                return buffer[position]
+            if not fill():
+                return ""
+
+    def decode() -> object:
+        nonlocal position
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # Either invalid, or cut off at the end of the buffer
+                if not fill():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(buffer) and not end_of_file and fill():
+                continue
+            position = end
+            return value
+
+    def expect(character: str):
+        nonlocal position
+        if next_character() != character:
+            raise ValueError(f"Expected {character!r} at character {position} of the JSON chunk")
+        position += 1
+
+    expect("{")
+    if next_character() == "}":
+        return
+    while True:
+        key = decode()
+        if not isinstance(key, str):
+            raise ValueError("JSON object keys must be strings")
+        expect(":")
+        next_character()
+        yield key, decode()
+        if next_character() == ",":
+            position += 1
+            next_character()
+            continue
+        expect("}")
+        return
+
+
+def build_pin_adm_index(json_filename: str, index_filename: str, key: str = PIN_ADM_KEY_IMSI) -> int:
+    """Builds the ADM pin index from a JSON file with {key IMSI (or ICCID): value ADM PIN}
+
+    The JSON file is streamed, so it doesn't have to fit in memory.
+    index_filename is replaced once the index is complete
+
+    ValueError: if the JSON file isn't an object of IMSIs (or ICCIDs) to ADM pins, or has duplicate keys
+
+    Returns the number of ADM pins indexed
+    """
+    if key not in PIN_ADM_KEYS:
+        raise ValueError(f"Invalid key {key}, must be one of {PIN_ADM_KEYS}")
+
+    start = time.perf_counter()
+    temporary_filename = f"{index_filename}.tmp"
+    if os.path.exists(temporary_filename):
+        os.remove(temporary_filename)
+
+    db = sqlite3.connect(temporary_filename)
+    try:
+        db.execute("PRAGMA journal_mode = OFF")
+        db.execute("PRAGMA synchronous = OFF")
+        db.executescript(PIN_ADM_INDEX_SCHEMA)
+        db.execute("INSERT INTO metadata VALUES ('key', ?)", (key,))
+
+        num_pins = 0
+        batch = []
+        with open(json_filename, "r", encoding="utf-8-sig") as f:
+            for pin_key, pin_adm in iter_json_object_items(f):
+                if not isinstance(pin_adm, (str, int)) or isinstance(pin_adm, bool):
+                    raise ValueError(f"ADM pin of {key.upper()} {pin_key} must be a string")
+                batch.append((pin_key.strip(), str(pin_adm)))
+                if len(batch) >= INDEX_BATCH_PINS:
+                    num_pins += _insert_pins(db, batch, key)
+                    batch = []
+        num_pins += _insert_pins(db, batch, key)
+        db.commit()
+    except Exception:
+        db.close()
+        os.remove(temporary_filename)
+        raise
+    db.close()
+
+    os.replace(temporary_filename, index_filename)
+    log.info(
+        f"Indexed {num_pins} ADM pins of {json_filename} by {key.upper()} into {index_filename} "
+        f"in {time.perf_counter() - start:.2f} seconds"
+    )
+    return num_pins
+
+
+def _insert_pins(db: sqlite3.Connection, batch, key: str) -> int:
+    # Keys of the batch in the order they are inserted, since the pins before a duplicate are already inserted
+    inserted_keys = []
+
+    def pins():
+        for pin_key, pin_adm in batch:
+            inserted_keys.append(pin_key)
+            yield pin_key, pin_adm
+
+    try:
+        db.executemany("INSERT INTO pins VALUES (?, ?)", pins())
+    except sqlite3.IntegrityError:
+        keys = [pin_key for pin_key, _ in batch]
+        duplicates = sorted(pin_key for pin_key, count in Counter(keys).items() if count > 1)
+        if not duplicates:
+            # Duplicate of an earlier batch
+            duplicates = inserted_keys[-1:]
+        raise ValueError(f"Duplicate {key.upper()}s: {duplicates[:10]}")
+    return len(batch)
+
+
+class PinAdmStore:
+    """ADM pins looked up by IMSI (or ICCID) in an index built by build_pin_adm_index()
+
+    Only the index is opened, and each lookup reads only its pin from disk.
+    Safe to share between reader workers.
+    """
+
+    def __init__(self, index_filename: str):
+        """
+        ValueError: if index_filename isn't an ADM pin index
+        """
+        self.index_filename = index_filename
+        self._lock = threading.Lock()
+        # Read only, so a missing file isn't created
+        try:
+            self._db = sqlite3.connect(
+                pathlib.Path(index_filename).resolve().as_uri() + "?mode=ro", uri=True, check_same_thread=False
+            )
+        except sqlite3.OperationalError as e:
+            raise ValueError(f"Failed to open {index_filename}: {e}")
+        try:
+            row = self._db.execute("SELECT value FROM metadata WHERE name = 'key'").fetchone()
+        except sqlite3.DatabaseError:
+            row = None
+        if row is None or row[0] not in PIN_ADM_KEYS:
+            self._db.close()
+            raise ValueError(f"{index_filename} is not an ADM pin index (build it with sim_csv_script_index)")
+        self.key = row[0]
+
+    def lookup(self, imsi: Optional[str], iccid: Optional[str] = None) -> str:
+        """
+        InvalidADMPinError: if the card's IMSI (or ICCID) is not in the index
+        """
+        pin_key = imsi if self.key == PIN_ADM_KEY_IMSI else iccid
+        if not pin_key:
+            raise InvalidADMPinError(
+                f"Can't look up ADM pin, since the card's {self.key.upper()} can't be read"
+            )
+
+        with self._lock:
+            row = self._db.execute("SELECT pin_adm FROM pins WHERE key = ?", (pin_key,)).fetchone()
+        if row is None:
+            raise InvalidADMPinError(f"{self.key.upper()} {pin_key} is not found in ADM pin index {self.index_filename}")
+        return row[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __repr__(self):
+        return f"PinAdmStore({self.index_filename}, key={self.key})"
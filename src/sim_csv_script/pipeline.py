@@ -0,0 +1,84 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Callable, Deque, Generic, Optional, TypeVar
+
+from sim_csv_script.logging_utils import with_card_log_context
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class DeferredCall(Generic[T]):
+    """Same result() as a Future, but function is only called when its result is first needed"""
+
+    def __init__(self, function: Callable[..., T], *args):
+        self._function = function
+        self._args = args
+        self._future = None  # type: Optional[Future]
+
+    def result(self) -> T:
+        if self._future is None:
+            self._future = Future()
+            try:
+                self._future.set_result(self._function(*self._args))
+            except Exception as e:
+                self._future.set_exception(e)
+        return self._future.result()
+
+
+def submit_or_defer(executor: Optional[Executor], function: Callable[..., T], *args):
+    """Starts function(*args) in executor, or defers it until its result() is needed if executor is None
+
+    Either way, result() returns function's result, or raises its error
+    """
+    if executor is None:
+        return DeferredCall(function, *args)
+    # Log records of function are about the same card as the caller's
+    return executor.submit(with_card_log_context(function), *args)
+
+
+class Prefetcher(Generic[T]):
+    """Calls prepare() in a background thread, ahead of the calls to get()
+
+    depth results are kept prepared.  prepare() is never called concurrently, so results are
+    prepared one at a time in the same order as they are taken by get().
+    Safe to share between reader workers.
+    """
+
+    def __init__(self, prepare: Callable[[], T], *, depth: int = 1, name: str = "prefetch"):
+        if depth < 1:
+            raise ValueError(f"Invalid prefetch depth {depth}, must be at least 1")
+
+        self.name = name
+        self._prepare = prepare
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self._futures = deque(
+            self._executor.submit(prepare) for _ in range(depth)
+        )  # type: Deque[Future]
+
+    def get(self) -> T:
+        """Returns the next prepared result, and starts preparing another one
+
+        Errors: errors raised by prepare() for this result
+        """
+        with self._lock:
+            future = self._futures.popleft()
+            self._futures.append(self._executor.submit(self._prepare))
+        return future.result()
+
+    def close(self):
+        """Waits for the result being prepared, and discards the prepared results that weren't taken"""
+        with self._lock:
+            not_started = sum(future.cancel() for future in self._futures)
+            discarded = len(self._futures) - not_started
+            self._futures.clear()
+        self._executor.shutdown(wait=True)
+        if discarded:
+            log.info(f"Discarded {discarded} prepared {self.name} result(s) that no card used")
+
+    def __repr__(self):
+        return f"Prefetcher({self.name}, depth={len(self._futures)})"
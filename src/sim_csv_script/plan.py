@@ -0,0 +1,215 @@
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+from pySim.ts_31_102 import EF_USIM_ADF_map
+from pySim.ts_31_103 import EF_ISIM_ADF_map
+
+from sim_csv_script.fields import (
+    ALL_FieldName_to_EF,
+    FIELDS_THAT_USE_RECORDS,
+    parse_field_name,
+)
+
+HexStr = str
+
+ADF_ISIM = "isim"
+ADF_USIM = "usim"
+
+
+class FieldPlan(NamedTuple):
+    """Everything needed to read, write and verify one field, resolved once from the CSV row"""
+
+    field_name: str
+    # EF as pySim expects it (FID for ADF files, or list of FIDs from the MF)
+    ef: Union[HexStr, List[HexStr]]
+    # ADFs that must be selected before the EF, in the order they are selected
+    adfs: Tuple[str, ...]
+    uses_records: bool
+    # Lowercase, since pySim reads and writes lowercase hex values
+    value: HexStr
+    num_bytes: int
+    # Record addressed with FIELD.N, or None for the whole field
+    record_number: Optional[int] = None
+
+    @property
+    def first_record(self) -> int:
+        """Record number of the first record in value"""
+        return self.record_number or 1
+
+
+class ProvisioningPlan(NamedTuple):
+    """Immutable list of FieldPlans, compiled once and reused for every card"""
+
+    fields: Tuple[FieldPlan, ...]
+    # Application (ADF) switches saved per pass over the fields, by schedule_fields()
+    adf_switches_saved: int = 0
+
+    @property
+    def field_names(self) -> List[str]:
+        return [field.field_name for field in self.fields]
+
+    def __len__(self):
+        return len(self.fields)
+
+
+def field_adfs(field_name: str) -> Tuple[str, ...]:
+    """Returns ADFs to select before field_name's EF, in the order they are selected
+
+    Fields that are also in EF (e.g. SPN) are mapped to a path from the MF by ALL_FieldName_to_EF,
+    so they don't need an ADF
+    """
+    if isinstance(ALL_FieldName_to_EF[field_name], list):
+        return ()
+
+    adfs = []
+    if field_name in EF_ISIM_ADF_map:
+        adfs.append(ADF_ISIM)
+    if field_name in EF_USIM_ADF_map:
+        adfs.append(ADF_USIM)
+    return tuple(adfs)
+
+
+def compile_field(field_name: str, field_value: HexStr = "") -> FieldPlan:
+    """
+    field_name must be a valid field name (see check_that_field_is_valid), and can address a single record (FIELD.N)
+
+    KeyError: if field_name is not a valid field name
+    """
+    base_field_name, record_number = parse_field_name(field_name)
+    return FieldPlan(
+        field_name=field_name,
+        ef=ALL_FieldName_to_EF[base_field_name],
+        adfs=field_adfs(base_field_name),
+        uses_records=base_field_name in FIELDS_THAT_USE_RECORDS,
+        value=field_value.lower(),
+        num_bytes=len(field_value) // 2,
+        record_number=record_number,
+    )
+
+
+############################################################################
+
+# Order of the groups of fields with the same ADFs.  Fields in both the ISIM and USIM
+# ADFs select ISIM then USIM, so they go between the ISIM only and USIM only fields
+ADF_GROUP_ORDER = {
+    (): 0,
+    (ADF_ISIM,): 1,
+    (ADF_ISIM, ADF_USIM): 2,
+    (ADF_USIM,): 3,
+}
+
+
+def count_adf_switches(fields: Iterable[FieldPlan]) -> int:
+    """Returns how many times an ADF has to be selected to process fields in this order
+
+    Selecting a file by path from the MF leaves the current ADF, so the next ADF field has to select its ADF again
+    """
+    current_adf = None
+    switches = 0
+    for field in fields:
+        if not field.adfs:
+            current_adf = None
+            continue
+        for adf in field.adfs:
+            if adf != current_adf:
+                switches += 1
+                current_adf = adf
+    return switches
+
+
+def schedule_fields(fields: Iterable[FieldPlan]) -> Tuple[FieldPlan, ...]:
+    """Groups fields by ADF, and fields outside ADFs by DF path, so that each application is selected once
+
+    The sort is stable, so fields of the same group keep their CSV order
+    """
+    fields = tuple(fields)
+    df_groups = {}  # type: Dict[tuple, int]
+
+    def group_key(field: FieldPlan):
+        if field.adfs:
+            df_group = 0
+        else:
+            df_path = tuple(field.ef[:-1]) if isinstance(field.ef, list) else ()
+            df_group = df_groups.setdefault(df_path, len(df_groups))
+        return (ADF_GROUP_ORDER.get(field.adfs, len(ADF_GROUP_ORDER)), df_group)
+
+    return tuple(sorted(fields, key=group_key))
+
+
+def compile_fields(
+    field_names: Iterable[str],
+    field_values: Iterable[HexStr],
+    *,
+    reorder: bool = True,
+) -> ProvisioningPlan:
+    """
+    reorder: group fields by ADF/DF with schedule_fields(), instead of keeping them in CSV order
+    """
+    fields = tuple(
+        compile_field(field_name, field_value)
+        for field_name, field_value in zip(field_names, field_values)
+    )
+    if not reorder:
+        return ProvisioningPlan(fields)
+
+    scheduled_fields = schedule_fields(fields)
+    return ProvisioningPlan(
+        scheduled_fields,
+        adf_switches_saved=count_adf_switches(fields) - count_adf_switches(scheduled_fields),
+    )
+
+
+def compile_plan(fields, *, reorder: bool = True) -> ProvisioningPlan:
+    """Compiles a validated FieldTable (see check_that_fields_are_valid) into a ProvisioningPlan"""
+    return compile_fields(fields.field_names, fields.field_values, reorder=reorder)
+
+
+def filter_plan(plan: ProvisioningPlan, field_values: Dict[str, HexStr]) -> ProvisioningPlan:
+    """Returns plan with only the fields in field_values, with their values from field_values
+
+    The plan's order is kept, and only fields whose value changed are compiled again.
+    field_values must not add fields to the plan (see check_for_added_fields_after_filter),
+    and changed values must be valid (see check_that_field_is_valid)
+    """
+    fields = []
+    for field in plan.fields:
+        if field.field_name not in field_values:
+            continue
+        field_value = field_values[field.field_name]
+        if field_value.lower() != field.value:
+            field = compile_field(field.field_name, field_value)
+        fields.append(field)
+    return ProvisioningPlan(tuple(fields), adf_switches_saved=plan.adf_switches_saved)
+
+
+def update_plan(
+    plan: ProvisioningPlan, field_values: Dict[str, HexStr], *, reorder: bool = True
+) -> ProvisioningPlan:
+    """Returns plan with the values from field_values, and the fields of field_values that aren't in plan added
+
+    Only fields whose value changed and new fields are compiled.  field_values must be valid
+    (see find_field_problems), and new fields are scheduled with the plan's fields if reorder is set
+    """
+    fields = []
+    for field in plan.fields:
+        field_value = field_values.get(field.field_name)
+        if field_value is not None and field_value.lower() != field.value:
+            field = compile_field(field.field_name, field_value)
+        fields.append(field)
+
+    plan_field_names = set(plan.field_names)
+    new_fields = [
+        compile_field(field_name, field_value)
+        for field_name, field_value in field_values.items()
+        if field_name not in plan_field_names
+    ]
+    if not new_fields:
+        return ProvisioningPlan(tuple(fields), adf_switches_saved=plan.adf_switches_saved)
+
+    fields.extend(new_fields)
+    if not reorder:
+        return ProvisioningPlan(tuple(fields))
+    scheduled_fields = schedule_fields(fields)
+    return ProvisioningPlan(
+        scheduled_fields,
+        adf_switches_saved=count_adf_switches(fields) - count_adf_switches(scheduled_fields),
+    )
@@ -0,0 +1,19 @@
+# Write and verify policies of the engine.  Kept free of pySim imports, since the command line options use them
+
+# Default for --delta-merge-gap.  Sending unchanged bytes is cheaper than the header and
+# round trip of another UPDATE BINARY, so changed ranges this close together are merged
+DEFAULT_DELTA_MERGE_GAP = 8
+
+# Verification policies
+# Read back the whole field after writing it
+VERIFY_FULL = "full"
+# Read back only the byte ranges or records that were written
+VERIFY_RANGED = "ranged"
+# Same as ranged, but all fields are read back together after the last field of the card was written
+VERIFY_DEFERRED = "deferred"
+# Same as ranged, but only for a random sample of the cards
+VERIFY_SAMPLED = "sampled"
+
+VERIFICATION_POLICIES = (VERIFY_FULL, VERIFY_RANGED, VERIFY_DEFERRED, VERIFY_SAMPLED)
+
+DEFAULT_VERIFY_SAMPLE_RATE = 0.1
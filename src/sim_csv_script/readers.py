@@ -0,0 +1,99 @@
+import argparse
+import logging
+import threading
+from typing import Callable, List
+
+log = logging.getLogger(__name__)
+
+
+class ReaderResult:
+    """Per-reader counters, so that one reader's failures don't affect the others"""
+
+    def __init__(self, reader_number: int):
+        self.reader_number = reader_number
+        self.cards_succeeded = 0
+        self.cards_failed = 0
+        self.cards_skipped = 0
+        self.error = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.cards_failed == 0
+
+    def __repr__(self):
+        return (
+            f"ReaderResult(reader={self.reader_number}, succeeded={self.cards_succeeded}, "
+            f"failed={self.cards_failed}, skipped={self.cards_skipped}, error={self.error!r})"
+        )
+
+
+def ReaderListArgType(value):
+    """
+    Used as argparse type validator
+
+    Parses comma separated PC/SC reader numbers (e.g. "0,1,2,3")
+    """
+    try:
+        reader_numbers = [int(x) for x in value.split(",") if x.strip() != ""]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Readers must be comma separated PC/SC reader numbers: '{value}'"
+        )
+
+    if not reader_numbers:
+        raise argparse.ArgumentTypeError("At least one PC/SC reader number is required")
+
+    if any(x < 0 for x in reader_numbers):
+        raise argparse.ArgumentTypeError(f"Invalid PC/SC reader number in '{value}'")
+
+    if len(set(reader_numbers)) != len(reader_numbers):
+        raise argparse.ArgumentTypeError(f"Duplicate PC/SC reader numbers in '{value}'")
+
+    return reader_numbers
+
+
+def list_pcsc_reader_numbers() -> List[int]:
+    """Returns reader numbers of all PC/SC readers connected to this computer"""
+    from smartcard.System import readers
+
+    return list(range(len(readers())))
+
+
+def run_reader_workers(
+    reader_numbers: List[int], reader_loop: Callable[[int, ReaderResult], None]
+) -> List[ReaderResult]:
+    """Runs reader_loop(reader_number, result) in its own thread for each reader
+
+    Any exception that escapes reader_loop is stored in that reader's result,
+    and the other readers keep running.
+
+    Returns list of ReaderResult in the same order as reader_numbers
+    """
+    results = [ReaderResult(reader_number) for reader_number in reader_numbers]
+
+    def worker(result: ReaderResult):
+        try:
+            reader_loop(result.reader_number, result)
+        except Exception as e:
+            log.error(f"({e.__class__.__name__}) {e}")
+            result.error = e
+
+    threads = [
+        threading.Thread(
+            target=worker,
+            args=(result,),
+            name=f"reader-{result.reader_number}",
+            daemon=True,
+        )
+        for result in results
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    # Join with a timeout, so that Ctrl+C is still handled by the main thread
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.5)
+
+    return results
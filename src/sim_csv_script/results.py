@@ -0,0 +1,379 @@
+import abc
+import csv
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Deque, Dict, List, Optional
+
+from sim_csv_script.exceptions import WriteDeclinedError
+from sim_csv_script.logging_utils import get_card_log_id
+
+if TYPE_CHECKING:
+    # Not imported at runtime, so the command line can check --output without importing the pySim card stack
+    from sim_csv_script.engine import CardResult, FieldResult
+
+log = logging.getLogger(__name__)
+
+RESULT_FORMAT_CSV = "csv"
+RESULT_FORMAT_JSONL = "jsonl"
+RESULT_FORMAT_PARQUET = "parquet"
+# File extension => result format
+RESULT_FORMATS = {
+    ".csv": RESULT_FORMAT_CSV,
+    ".jsonl": RESULT_FORMAT_JSONL,
+    ".parquet": RESULT_FORMAT_PARQUET,
+}
+
+# Status of a card
+CARD_SUCCEEDED = "succeeded"
+CARD_FAILED = "failed"
+CARD_SKIPPED = "skipped"
+CARD_DECLINED = "declined"
+
+# Status of a field
+FIELD_UNCHANGED = "unchanged"
+# Read mode: the card's value differs from the FieldValue
+FIELD_DIFFERS = "differs"
+FIELD_WRITTEN = "written"
+FIELD_VERIFIED = "verified"
+
+# Card results are written in batches, when this many are queued or this many seconds passed since the last write
+DEFAULT_RESULT_BATCH_CARDS = 100
+DEFAULT_RESULT_FLUSH_SECONDS = 1.0
+# Rows of each row group of a Parquet file
+DEFAULT_PARQUET_ROW_GROUP_ROWS = 10000
+
+# Columns of each card, and of each field of the card
+CARD_COLUMNS = (
+    "card_log_id",
+    "reader",
+    "mode",
+    "status",
+    "skipped",
+    "error",
+    "iccid",
+    "imsi",
+    "started",
+    "seconds",
+    "verification",
+    "verified",
+)
+FIELD_COLUMNS = ("field_name", "field_status", "before", "value", "after", "field_seconds")
+
+
+def get_result_format(filename: str) -> str:
+    """
+    ValueError: if filename's extension isn't one of RESULT_FORMATS
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in RESULT_FORMATS:
+        raise ValueError(f"Results file '{filename}' must end with one of {tuple(RESULT_FORMATS)}")
+    return RESULT_FORMATS[extension]
+
+
+def field_status(result: "FieldResult") -> str:
+    if result.verified:
+        return FIELD_VERIFIED
+    if result.written:
+        return FIELD_WRITTEN
+    if result.changed:
+        return FIELD_DIFFERS
+    return FIELD_UNCHANGED
+
+
+def field_record(result: "FieldResult") -> dict:
+    return {
+        "field_name": result.field_name,
+        "status": field_status(result),
+        "before": result.read_value,
+        "value": result.value,
+        # Card's value after writing, as read back to verify it.  Unknown (None) for written fields that weren't verified
+        "after": result.verified_value if result.written else result.read_value,
+        "seconds": result.seconds,
+        "written_ranges": result.written_ranges,
+        "written_records": result.written_records,
+    }
+
+
+def card_record(
+    card_result: "CardResult",
+    *,
+    mode: str,
+    started: float,
+    seconds: float,
+    error: Optional[Exception] = None,
+    reader: Optional[int] = None,
+) -> dict:
+    """Returns the result record of a card, with the fields that were finished (even if the card failed later)"""
+    if isinstance(error, WriteDeclinedError):
+        status = CARD_DECLINED
+    elif error is not None:
+        status = CARD_FAILED
+    elif card_result.skipped:
+        status = CARD_SKIPPED
+    else:
+        status = CARD_SUCCEEDED
+
+    return {
+        "card_log_id": get_card_log_id(),
+        "reader": reader,
+        "mode": mode,
+        "status": status,
+        "skipped": card_result.skipped,
+        "error": None if error is None else f"({error.__class__.__name__}) {error}",
+        "iccid": card_result.iccid,
+        "imsi": card_result.imsi,
+        "started": datetime.datetime.fromtimestamp(started, datetime.timezone.utc).isoformat(
+            timespec="milliseconds"
+        ),
+        "seconds": seconds,
+        "verification": card_result.verification,
+        "verified": card_result.verified,
+        "fields": [field_record(result) for result in card_result.fields],
+    }
+
+
+def card_record_rows(record: dict) -> List[dict]:
+    """Flattens a card record into one row per field (or a single row without field columns if it has no fields)"""
+    card_row = {column: record[column] for column in CARD_COLUMNS}
+    if not record["fields"]:
+        return [{**card_row, **{column: None for column in FIELD_COLUMNS}}]
+
+    return [
+        {
+            **card_row,
+            "field_name": field["field_name"],
+            "field_status": field["status"],
+            "before": field["before"],
+            "value": field["value"],
+            "after": field["after"],
+            "field_seconds": field["seconds"],
+        }
+        for field in record["fields"]
+    ]
+
+
+############################################################################
+
+
+class ResultSink(abc.ABC):
+    """Writes a result record for each card to a file, in a background thread
+
+    write_card() only queues the record, so the card loop never waits for the file.
+    Queued records are written in batches: when batch_cards are queued, or flush_seconds
+    after the last write.  close() writes the remaining records.
+
+    Safe to share between reader workers.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        *,
+        batch_cards: int = DEFAULT_RESULT_BATCH_CARDS,
+        flush_seconds: float = DEFAULT_RESULT_FLUSH_SECONDS,
+    ):
+        self.filename = filename
+        self.batch_cards = batch_cards
+        self.flush_seconds = flush_seconds
+        self.cards_written = 0
+        self._records = deque()  # type: Deque[dict]
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closing = False
+        self._open()
+        self._writer = threading.Thread(target=self._write_loop, name="result-writer", daemon=True)
+        self._writer.start()
+
+    def write_card(self, record: dict):
+        self._records.append(record)
+        if len(self._records) >= self.batch_cards:
+            self._wakeup.set()
+
+    def _write_loop(self):
+        while not self._closing:
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.error(f"({e.__class__.__name__}) Failed to write results to {self.filename}: {e}")
+
+    def flush(self):
+        """Writes the queued records"""
+        with self._write_lock:
+            records = []
+            while self._records:
+                records.append(self._records.popleft())
+            if records:
+                self._write_records(records)
+                self.cards_written += len(records)
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self._wakeup.set()
+        self._writer.join()
+        try:
+            self.flush()
+        finally:
+            self._close()
+        log.info(f"Wrote results of {self.cards_written} cards to {self.filename}")
+
+    @abc.abstractmethod
+    def _open(self):
+        """Opens the file.  Called once, before the writer thread starts"""
+
+    @abc.abstractmethod
+    def _write_records(self, records: List[dict]):
+        """Writes a batch of card records.  Called with the write lock held"""
+
+    @abc.abstractmethod
+    def _close(self):
+        """Writes anything still buffered, and closes the file"""
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.filename})"
+
+
+class JsonLinesResultSink(ResultSink):
+    """One JSON object per card, with a list of its fields"""
+
+    def _open(self):
+        self._file = open(self.filename, "w", encoding="utf-8")
+
+    def _write_records(self, records: List[dict]):
+        self._file.write("".join(json.dumps(record) + "\n" for record in records))
+        self._file.flush()
+
+    def _close(self):
+        self._file.close()
+
+
+class CSVResultSink(ResultSink):
+    """One row per field of each card (see card_record_rows)"""
+
+    def _open(self):
+        self._file = open(self.filename, "w", newline="", encoding="utf-8")
+        self._writer_csv = csv.DictWriter(self._file, fieldnames=CARD_COLUMNS + FIELD_COLUMNS)
+        self._writer_csv.writeheader()
+
+    def _write_records(self, records: List[dict]):
+        for record in records:
+            self._writer_csv.writerows(card_record_rows(record))
+        self._file.flush()
+
+    def _close(self):
+        self._file.close()
+
+
+class ParquetResultSink(ResultSink):
+    """Same rows as CSVResultSink, in a Parquet file (requires pyarrow)
+
+    Rows are buffered into row groups of row_group_rows, so a crash loses the rows of the last row group
+    """
+
+    def __init__(self, filename: str, *, row_group_rows: int = DEFAULT_PARQUET_ROW_GROUP_ROWS, **kwargs):
+        self.row_group_rows = row_group_rows
+        super().__init__(filename, **kwargs)
+
+    def _open(self):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError(
+                "Parquet results require pyarrow: python3 -m pip install pyarrow (or the sim_csv_script[parquet] extra)"
+            )
+
+        self._pa = pa
+        self._schema = pa.schema(
+            [
+                ("card_log_id", pa.string()),
+                ("reader", pa.int64()),
+                ("mode", pa.string()),
+                ("status", pa.string()),
+                ("skipped", pa.string()),
+                ("error", pa.string()),
+                ("iccid", pa.string()),
+                ("imsi", pa.string()),
+                ("started", pa.string()),
+                ("seconds", pa.float64()),
+                ("verification", pa.string()),
+                ("verified", pa.bool_()),
+                ("field_name", pa.string()),
+                ("field_status", pa.string()),
+                ("before", pa.string()),
+                ("value", pa.string()),
+                ("after", pa.string()),
+                ("field_seconds", pa.float64()),
+            ]
+        )
+        self._parquet_writer = pq.ParquetWriter(self.filename, self._schema)
+        self._rows = []  # type: List[Dict]
+
+    def _write_records(self, records: List[dict]):
+        for record in records:
+            self._rows.extend(card_record_rows(record))
+        if len(self._rows) >= self.row_group_rows:
+            self._write_row_group()
+
+    def _write_row_group(self):
+        if not self._rows:
+            return
+        columns = {name: [row[name] for row in self._rows] for name in self._schema.names}
+        self._parquet_writer.write_table(self._pa.Table.from_pydict(columns, schema=self._schema))
+        self._rows = []
+
+    def _close(self):
+        try:
+            self._write_row_group()
+        finally:
+            self._parquet_writer.close()
+
+
+RESULT_SINKS = {
+    RESULT_FORMAT_CSV: CSVResultSink,
+    RESULT_FORMAT_JSONL: JsonLinesResultSink,
+    RESULT_FORMAT_PARQUET: ParquetResultSink,
+}
+
+
+def open_result_sink(filename: str) -> ResultSink:
+    """Opens the result sink for filename's extension (see RESULT_FORMATS).  The file is replaced if it exists
+
+    ValueError: if filename's extension isn't one of RESULT_FORMATS
+    ImportError: for Parquet files, if pyarrow isn't installed
+    """
+    return RESULT_SINKS[get_result_format(filename)](filename)
+
+
+@contextmanager
+def record_card(results: Optional[ResultSink], card_result: "CardResult", args, reader: Optional[int] = None):
+    """Writes the result record of card_result when the block exits, with the error the block raised (no-op if results is None)"""
+    if results is None:
+        yield
+        return
+
+    mode = "write" if args.write else "read"
+    started = time.time()
+    started_counter = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        results.write_card(
+            card_record(
+                card_result, mode=mode, started=started, seconds=time.perf_counter() - started_counter, error=e, reader=reader
+            )
+        )
+        raise
+    else:
+        results.write_card(
+            card_record(card_result, mode=mode, started=started, seconds=time.perf_counter() - started_counter, reader=reader)
+        )
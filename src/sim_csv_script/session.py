@@ -0,0 +1,228 @@
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pySim.commands import SimCardCommands
+from pySim.exceptions import SwMatchError
+
+log = logging.getLogger(__name__)
+
+HexStr = str
+
+MF_FID = "3f00"
+CURRENT_ADF_FID = "7fff"
+
+# Selection state is (DF path, EF FID or None).
+# DF paths start with the MF FID, or with "adf:{aid}" for applications.
+Selection = Tuple[Tuple[str, ...], Optional[str]]
+
+ADF_KEY_PREFIX = "adf:"
+
+
+def is_df_fid(fid: HexStr) -> bool:
+    """DF FIDs start with 7F or 5F (ETSI TS 102 221, chapter 8.3)"""
+    return fid[:2].lower() in ("7f", "5f")
+
+
+class SessionSimCardCommands(SimCardCommands):
+    """SimCardCommands that tracks the selected ADF/DF/EF of the current card session
+
+    SELECTs of files that are already selected are answered from the responses
+    recorded earlier in the session instead of being sent to the card.  For a path,
+    the longest prefix that is already in effect is skipped, e.g. selecting
+    ['3f00', '7f20', '6f46'] while EF 6f07 in DF 7f20 is selected only sends the
+    SELECT for '6f46'.
+
+    File control parameters (binary size, record size, record count) and existence
+    of each EF are also cached for the session, so they are only read from the card once.
+
+    The tracked selection is forgotten if a SELECT fails or raises, and on reset_card().
+    Call reset_session() whenever a new card is inserted.
+    """
+
+    def __init__(self, transport):
+        super().__init__(transport)
+        self.reset_session()
+
+    def reset_session(self):
+        self._selected = None  # type: Optional[Selection]
+        self._adf_key = None  # type: Optional[str]
+        self._select_responses = {}  # type: Dict[Selection, Tuple[HexStr, HexStr]]
+        self._ef_info = {}  # type: Dict[Selection, dict]
+        self.select_hits = 0
+        self.select_misses = 0
+        self.ef_info_hits = 0
+        self.ef_info_misses = 0
+
+    def invalidate_selection(self):
+        self._selected = None
+
+    ############################################################################
+
+    def _resolve(self, selected: Optional[Selection], fid: HexStr) -> Optional[Selection]:
+        """Returns selection after selecting fid from selected, or None if unknown"""
+        fid = fid.lower()
+        if fid == MF_FID:
+            return ((MF_FID,), None)
+        if selected is None:
+            return None
+
+        df_path, _ = selected
+        if fid == CURRENT_ADF_FID:
+            return ((self._adf_key,), None) if self._adf_key is not None else None
+        if is_df_fid(fid):
+            return (df_path + (fid,), None)
+        return (df_path, fid)
+
+    def _resolve_path(self, dir_list) -> Optional[Selection]:
+        if type(dir_list) is not list:
+            dir_list = [dir_list]
+        target = self._selected
+        for fid in dir_list:
+            target = self._resolve(target, fid)
+        return target
+
+    def _in_effect(self, target: Optional[Selection]) -> bool:
+        if self._selected is None or target is None:
+            return False
+        if target[1] is None:
+            # A DF stays the current DF while one of its EFs is selected
+            return self._selected[0] == target[0]
+        return self._selected == target
+
+    def _select_fids(self, fids, check_sw: bool) -> List[Tuple[HexStr, HexStr]]:
+        if type(fids) is not list:
+            fids = [fids]
+
+        targets = []
+        target = self._selected
+        for fid in fids:
+            target = self._resolve(target, fid)
+            targets.append(target)
+
+        # Skip the longest prefix of the path that is already in effect
+        skip = 0
+        for i in range(len(fids), 0, -1):
+            if self._in_effect(targets[i - 1]) and all(
+                target in self._select_responses for target in targets[:i]
+            ):
+                skip = i
+                break
+
+        rv = [self._select_responses[target] for target in targets[:skip]]
+        self.select_hits += skip
+
+        for fid, target in zip(fids[skip:], targets[skip:]):
+            self.select_misses += 1
+            try:
+                data, sw = self._tp.send_apdu(
+                    self.cla_byte + "a4" + self.sel_ctrl + "02" + fid
+                )
+            except Exception:
+                self._selected = None
+                raise
+
+            rv.append((data, sw))
+            if sw != "9000":
+                self._selected = None
+                if check_sw:
+                    raise SwMatchError(sw, "9000", self._tp.sw_interpreter)
+                return rv
+
+            self._selected = target
+            if target is not None:
+                self._select_responses[target] = (data, sw)
+
+        return rv
+
+    ############################################################################
+
+    def try_select_path(self, dir_list):
+        return self._select_fids(dir_list, check_sw=False)
+
+    def select_path(self, dir_list):
+        return [data for data, _ in self._select_fids(dir_list, check_sw=True)]
+
+    def select_file(self, fid: str):
+        return self._select_fids([fid], check_sw=True)[-1]
+
+    def select_adf(self, aid: str):
+        target = ((ADF_KEY_PREFIX + aid.lower(),), None)  # type: Selection
+
+        if self._in_effect(target) and target in self._select_responses:
+            self.select_hits += 1
+            return self._select_responses[target]
+
+        self.select_misses += 1
+        try:
+            rv = super().select_adf(aid)
+        except Exception:
+            self._selected = None
+            raise
+
+        self._selected = target
+        self._adf_key = target[0][0]
+        self._select_responses[target] = rv
+        return rv
+
+    def reset_card(self):
+        self.invalidate_selection()
+        return super().reset_card()
+
+    ############################################################################
+
+    def _get_ef_info(self, ef, name: str, read_from_card: Callable):
+        target = self._resolve_path(ef)
+        ef_info = self._ef_info.get(target, {}) if target is not None else {}
+        if name in ef_info:
+            self.ef_info_hits += 1
+            return ef_info[name]
+
+        self.ef_info_misses += 1
+        value = read_from_card(ef)
+        if self._selected is not None:
+            self._ef_info.setdefault(self._selected, {})[name] = value
+        return value
+
+    def binary_size(self, ef):
+        return self._get_ef_info(ef, "binary_size", super().binary_size)
+
+    def record_size(self, ef):
+        return self._get_ef_info(ef, "record_size", super().record_size)
+
+    def record_count(self, ef):
+        return self._get_ef_info(ef, "record_count", super().record_count)
+
+    def file_exists(self, ef) -> bool:
+        """Same as pySim's SimCard.file_exists(), but cached for the session"""
+        target = self._resolve_path(ef)
+        ef_info = self._ef_info.get(target, {}) if target is not None else {}
+        if "exists" in ef_info:
+            self.ef_info_hits += 1
+            return ef_info["exists"]
+
+        self.ef_info_misses += 1
+        exists = all(sw == "9000" for _, sw in self.try_select_path(ef))
+        if exists:
+            target = self._selected
+        if target is not None:
+            self._ef_info.setdefault(target, {})["exists"] = exists
+        return exists
+
+    ############################################################################
+
+    def session_stats(self) -> dict:
+        return {
+            "select_hits": self.select_hits,
+            "select_misses": self.select_misses,
+            "ef_info_hits": self.ef_info_hits,
+            "ef_info_misses": self.ef_info_misses,
+        }
+
+    def log_session_stats(self):
+        log.info(
+            "Selection cache: %d SELECTs skipped, %d SELECTs sent.  EF info cache: %d hits, %d misses",
+            self.select_hits,
+            self.select_misses,
+            self.ef_info_hits,
+            self.ef_info_misses,
+        )
@@ -0,0 +1,252 @@
+import re
+import threading
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+from pySim.utils import enc_iccid, enc_imsi, swap_nibbles
+
+from sim_csv_script.exceptions import InvalidTemplateError
+
+HexStr = str
+
+# A FieldValue template is hex with placeholders, that are expanded for each card, e.g.
+#   SPN,4420823CFDE6F1C26B30F90EC7DD01E4{counter|hex2}
+#   IMPI,{imsi|ascii}
+#
+# Placeholders are {SOURCE[SLICE]|ENCODING|...}:
+#   SOURCE is iccid or imsi (as read from the card), or counter (sequence number of the card in this run)
+#   SLICE is an optional Python slice of the source's digits, e.g. [-2:] for the last 2 digits
+#   ENCODINGs are applied from left to right, see TEMPLATE_ENCODINGS
+TEMPLATE_PLACEHOLDER_REGEX = re.compile(r"\{([^{}]*)\}")
+TEMPLATE_PLACEHOLDER_BODY_REGEX = re.compile(
+    r"(?P<source>[a-z]+)"
+    r"(?:\[(?P<start>-?[0-9]*)(?::(?P<stop>-?[0-9]*))?\])?"
+    r"(?P<encodings>(?:\|[a-z]+[0-9]*)*)"
+)
+TEMPLATE_ENCODING_REGEX = re.compile(r"([a-z]+)([0-9]*)")
+TEMPLATE_LITERAL_REGEX = re.compile(r"[0-9A-Fa-f]*")
+
+TEMPLATE_SOURCE_ICCID = "iccid"
+TEMPLATE_SOURCE_IMSI = "imsi"
+TEMPLATE_SOURCE_COUNTER = "counter"
+TEMPLATE_SOURCES = (TEMPLATE_SOURCE_ICCID, TEMPLATE_SOURCE_IMSI, TEMPLATE_SOURCE_COUNTER)
+
+DEFAULT_TEMPLATE_COUNTER_START = 0
+
+
+def is_template(field_value: str) -> bool:
+    """Returns True if field_value has placeholders.  Braces can't be in a hex FieldValue"""
+    return "{" in field_value or "}" in field_value
+
+
+class TemplateContext(NamedTuple):
+    """Values of the placeholders for one card"""
+
+    iccid: Optional[str]
+    imsi: Optional[str]
+    counter: int
+
+
+############################################################################
+
+
+def _encode_hex(value: str, width: Optional[int]) -> str:
+    number = int(value, 10)
+    encoded = format(number, "x")
+    if width is None:
+        # Whole bytes
+        width = len(encoded) + (len(encoded) & 1)
+    if len(encoded) > width:
+        raise ValueError(f"{number} doesn't fit in {width} hex digits")
+    return encoded.zfill(width)
+
+
+def _encode_dec(value: str, width: Optional[int]) -> str:
+    if width is not None and len(value) > width:
+        raise ValueError(f"{value} doesn't fit in {width} digits")
+    return value.zfill(width or 0)
+
+
+def _encode_swap(value: str, width: Optional[int]) -> str:
+    """BCD digits with the nibbles of each byte swapped, padded with f (as ICCIDs and phone numbers are stored)"""
+    if len(value) & 1:
+        value += "f"
+    return swap_nibbles(value)
+
+
+def _encode_ascii(value: str, width: Optional[int]) -> str:
+    return value.encode("ascii").hex()
+
+
+def _encode_iccid(value: str, width: Optional[int]) -> str:
+    """EF.ICCID encoding"""
+    return enc_iccid(value)
+
+
+def _encode_imsi(value: str, width: Optional[int]) -> str:
+    """EF.IMSI encoding, with the length byte"""
+    return enc_imsi(value)
+
+
+# ENCODING: (function(value, width), whether it takes a width), e.g. hex4 is 4 hex digits
+TEMPLATE_ENCODINGS = {
+    # Decimal number to hex digits (whole bytes, or exactly N digits)
+    "hex": (_encode_hex, True),
+    # Digits padded with zeros to N digits
+    "dec": (_encode_dec, True),
+    "swap": (_encode_swap, False),
+    "ascii": (_encode_ascii, False),
+    "iccid": (_encode_iccid, False),
+    "imsi": (_encode_imsi, False),
+}  # type: Dict[str, Tuple[Callable[[str, Optional[int]], str], bool]]
+
+
+class TemplatePlaceholder(NamedTuple):
+    text: str
+    source: str
+    # Slice of the source's value, or None for the whole value
+    slice: Optional[slice]
+    # (encoding function, width)
+    encodings: Tuple[Tuple[Callable[[str, Optional[int]], str], Optional[int]], ...]
+
+    def expand(self, context: TemplateContext) -> str:
+        """
+        ValueError: if the source can't be read from the card, or can't be encoded
+        """
+        if self.source == TEMPLATE_SOURCE_COUNTER:
+            value = str(context.counter)
+        else:
+            value = getattr(context, self.source)
+            if not value:
+                raise ValueError(f"{self.source.upper()} can't be read from the card")
+
+        if self.slice is not None:
+            value = value[self.slice]
+        for encode, width in self.encodings:
+            value = encode(value, width)
+        return value
+
+
+def _parse_slice(start: str, stop: Optional[str]) -> slice:
+    if stop is None:
+        # [i] is the single digit at i
+        index = int(start)
+        return slice(index, index + 1 or None)
+    return slice(int(start) if start else None, int(stop) if stop else None)
+
+
+def compile_placeholder(text: str) -> TemplatePlaceholder:
+    """
+    text: placeholder without the braces
+
+    InvalidTemplateError: if text isn't a valid placeholder
+    """
+    match = TEMPLATE_PLACEHOLDER_BODY_REGEX.fullmatch(text)
+    if match is None:
+        raise InvalidTemplateError(f"Invalid placeholder {{{text}}}, must be {{SOURCE[SLICE]|ENCODING}}")
+
+    source = match.group("source")
+    if source not in TEMPLATE_SOURCES:
+        raise InvalidTemplateError(f"Unknown placeholder source {source!r} in {{{text}}}, must be one of {TEMPLATE_SOURCES}")
+
+    placeholder_slice = None
+    if match.group("start") is not None:
+        if match.group("stop") is None and match.group("start") in ("", "-"):
+            raise InvalidTemplateError(f"Invalid slice in {{{text}}}")
+        try:
+            placeholder_slice = _parse_slice(match.group("start"), match.group("stop"))
+        except ValueError:
+            raise InvalidTemplateError(f"Invalid slice in {{{text}}}")
+
+    encodings = []
+    for encoding_text in match.group("encodings").split("|")[1:]:
+        name, width = TEMPLATE_ENCODING_REGEX.fullmatch(encoding_text).groups()
+        if name not in TEMPLATE_ENCODINGS:
+            raise InvalidTemplateError(
+                f"Unknown encoding {name!r} in {{{text}}}, must be one of {tuple(TEMPLATE_ENCODINGS)}"
+            )
+        encode, takes_width = TEMPLATE_ENCODINGS[name]
+        if width and not takes_width:
+            raise InvalidTemplateError(f"Encoding {name!r} in {{{text}}} doesn't take a width")
+        encodings.append((encode, int(width) if width else None))
+
+    return TemplatePlaceholder(text, source, placeholder_slice, tuple(encodings))
+
+
+class FieldTemplate:
+    """FieldValue with placeholders, compiled once at CSV load and expanded for each card"""
+
+    def __init__(self, field_name: str, template: str, parts: List[Union[HexStr, TemplatePlaceholder]]):
+        self.field_name = field_name
+        self.template = template
+        # Literal hex and placeholders, in order
+        self.parts = parts
+
+    def expand(self, context: TemplateContext) -> HexStr:
+        """Returns the FieldValue for the card.  It still has to be validated (see check_that_field_is_valid)
+
+        InvalidTemplateError: if a placeholder can't be expanded for the card
+        """
+        values = []
+        for part in self.parts:
+            if isinstance(part, str):
+                values.append(part)
+                continue
+            try:
+                values.append(part.expand(context))
+            except (ValueError, UnicodeError) as e:
+                raise InvalidTemplateError(f"Failed to expand {{{part.text}}} of field {self.field_name}: {e}")
+        return "".join(values)
+
+    def __repr__(self):
+        return f"FieldTemplate({self.field_name}, {self.template!r})"
+
+
+def compile_template(field_name: str, template: str) -> FieldTemplate:
+    """
+    InvalidTemplateError: if a placeholder is invalid, or the text between placeholders isn't hex
+    """
+    parts = []  # type: List[Union[HexStr, TemplatePlaceholder]]
+    position = 0
+    for match in TEMPLATE_PLACEHOLDER_REGEX.finditer(template):
+        parts.append(template[position:match.start()])
+        parts.append(compile_placeholder(match.group(1)))
+        position = match.end()
+    parts.append(template[position:])
+
+    for part in parts:
+        if isinstance(part, str) and not TEMPLATE_LITERAL_REGEX.fullmatch(part):
+            raise InvalidTemplateError(
+                f"Invalid text {part!r} between placeholders, must be hex digits (braces must be around a placeholder)"
+            )
+
+    return FieldTemplate(
+        field_name,
+        template,
+        [part.lower() if isinstance(part, str) else part for part in parts if part != ""],
+    )
+
+
+def compile_field_templates(fields: Iterable[Tuple[str, str]]) -> Dict[str, FieldTemplate]:
+    """Returns FieldName => FieldTemplate of the (FieldName, FieldValue) pairs whose value is a template
+
+    InvalidTemplateError: if a template is invalid
+    """
+    return {
+        field_name: compile_template(field_name, field_value)
+        for field_name, field_value in fields
+        if is_template(field_value)
+    }
+
+
+class SequenceCounter:
+    """Source of {counter}.  Shared between reader workers, so each card gets a different number"""
+
+    def __init__(self, start: int = DEFAULT_TEMPLATE_COUNTER_START):
+        self._next = start
+        self._lock = threading.Lock()
+
+    def next(self) -> int:
+        with self._lock:
+            number = self._next
+            self._next += 1
+            return number
@@ -0,0 +1,301 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+from pySim.transport import ApduTracer
+
+from sim_csv_script.logging_utils import get_card_log_id
+
+log = logging.getLogger(__name__)
+
+HexStr = str
+
+# Field name used for APDUs that don't belong to a single field (card detection, ADM pin, ...)
+CARD_FIELD = "(card)"
+
+# Phases
+PHASE_DETECT = "detect"
+PHASE_INITIAL_DATA = "initial_data"
+PHASE_ADM = "adm"
+PHASE_WIDTH_CHECK = "width_check"
+PHASE_READ = "read"
+PHASE_WRITE = "write"
+PHASE_VERIFY = "verify"
+PHASE_FINGERPRINT = "fingerprint"
+
+INS_NAMES = {
+    "a4": "SELECT",
+    "f2": "STATUS",
+    "b0": "READ BINARY",
+    "d6": "UPDATE BINARY",
+    "b2": "READ RECORD",
+    "dc": "UPDATE RECORD",
+    "20": "VERIFY CHV",
+    "c0": "GET RESPONSE",
+    "88": "AUTHENTICATE",
+    "cb": "RETRIEVE DATA",
+    "db": "SET DATA",
+}
+
+
+def apdu_command_name(pdu: HexStr) -> str:
+    ins = pdu[2:4].lower()
+    return INS_NAMES.get(ins, f"INS {ins}")
+
+
+############################################################################
+
+
+class CostTable:
+    """APDU count and time, keyed by (field, phase, command)"""
+
+    def __init__(self):
+        self._costs = {}  # type: Dict[Tuple[str, str, str], list]
+
+    def add(self, field_name: str, phase: str, command: str, seconds: float, count: int = 1):
+        cost = self._costs.setdefault((field_name, phase, command), [0, 0.0])
+        cost[0] += count
+        cost[1] += seconds
+
+    def merge(self, other: "CostTable"):
+        for (field_name, phase, command), (count, seconds) in other._costs.items():
+            self.add(field_name, phase, command, seconds, count)
+
+    @property
+    def apdus(self) -> int:
+        return sum(count for count, _ in self._costs.values())
+
+    @property
+    def seconds(self) -> float:
+        return sum(seconds for _, seconds in self._costs.values())
+
+    def commands(self) -> dict:
+        """Totals per command (e.g. {"SELECT": {"count": 10, "seconds": 0.1}})"""
+        totals = {}
+        for (_, _, command), (count, seconds) in self._costs.items():
+            total = totals.setdefault(command, {"count": 0, "seconds": 0.0})
+            total["count"] += count
+            total["seconds"] += seconds
+        return totals
+
+    def fields(self) -> dict:
+        """Totals per field, with a breakdown per phase and command"""
+        fields = {}
+        for (field_name, phase, command), (count, seconds) in self._costs.items():
+            field = fields.setdefault(field_name, {"apdus": 0, "seconds": 0.0, "phases": {}})
+            field["apdus"] += count
+            field["seconds"] += seconds
+            cost = field["phases"].setdefault(phase, {}).setdefault(
+                command, {"count": 0, "seconds": 0.0}
+            )
+            cost["count"] += count
+            cost["seconds"] += seconds
+        return fields
+
+    def to_dict(self) -> dict:
+        return {
+            "apdus": self.apdus,
+            "apdu_seconds": self.seconds,
+            "commands": self.commands(),
+            "fields": self.fields(),
+        }
+
+
+class CardTrace:
+    """APDU costs of a single card"""
+
+    def __init__(self, reader=None):
+        self.reader = reader
+        # Same as the card_log_id of the card's log records
+        self.card_log_id = get_card_log_id()
+        self.iccid = None
+        self.imsi = None
+        self.error = None
+        self.session_stats = None
+        self.adf_switches_saved = 0
+        self.verification = None
+        self.verified = False
+        self.costs = CostTable()
+        self.started = time.time()
+        self.wall_seconds = None
+
+    def to_dict(self) -> dict:
+        return {
+            "type": "card",
+            "reader": self.reader,
+            "card_log_id": self.card_log_id,
+            "iccid": self.iccid,
+            "imsi": self.imsi,
+            "ok": self.error is None,
+            "error": self.error,
+            "wall_seconds": self.wall_seconds,
+            "session": self.session_stats,
+            "adf_switches_saved": self.adf_switches_saved,
+            "verification": self.verification,
+            "verified": self.verified,
+            **self.costs.to_dict(),
+        }
+
+
+class RunTrace:
+    """APDU costs summed over all cards of a run"""
+
+    def __init__(self):
+        self.cards = 0
+        self.failed_cards = 0
+        self.wall_seconds = 0.0
+        self.adf_switches_saved = 0
+        self.costs = CostTable()
+
+    def add_card(self, card_trace: CardTrace):
+        self.cards += 1
+        if card_trace.error is not None:
+            self.failed_cards += 1
+        self.wall_seconds += card_trace.wall_seconds or 0.0
+        self.adf_switches_saved += card_trace.adf_switches_saved
+        self.costs.merge(card_trace.costs)
+
+    def to_dict(self) -> dict:
+        return {
+            "type": "run",
+            "cards": self.cards,
+            "failed_cards": self.failed_cards,
+            "card_wall_seconds": self.wall_seconds,
+            "apdus_per_card": self.costs.apdus / self.cards if self.cards else 0,
+            "adf_switches_saved": self.adf_switches_saved,
+            **self.costs.to_dict(),
+        }
+
+
+############################################################################
+
+
+class TraceSink:
+    """Writes one JSON line per card, and a run summary line on close()
+
+    Shared by all readers, so writes are serialized
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.run_trace = RunTrace()
+        self._lock = threading.Lock()
+        self._file = open(filename, "w")
+
+    def write_card(self, card_trace: CardTrace):
+        with self._lock:
+            self.run_trace.add_card(card_trace)
+            self._file.write(json.dumps(card_trace.to_dict()) + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            run_summary = self.run_trace.to_dict()
+            self._file.write(json.dumps(run_summary) + "\n")
+            self._file.close()
+
+        log.info(
+            "APDU trace: %d cards, %d APDUs, %.3f s in APDUs, %d application switches saved.  Written to '%s'",
+            run_summary["cards"],
+            run_summary["apdus"],
+            run_summary["apdu_seconds"],
+            run_summary["adf_switches_saved"],
+            self.filename,
+        )
+
+
+class ApduCostTracer(ApduTracer):
+    """pySim ApduTracer that counts and times every APDU, and attributes it to the current field and phase
+
+    One tracer per transport link (reader)
+    """
+
+    def __init__(self, sink: Optional[TraceSink] = None, reader=None):
+        self.sink = sink
+        self.reader = reader
+        self.card_trace = None  # type: Optional[CardTrace]
+        self.field_name = CARD_FIELD
+        self.phase = PHASE_DETECT
+        self._command_started = None
+
+    def trace_command(self, cmd):
+        self._command_started = time.perf_counter()
+
+    def trace_response(self, cmd, sw, resp):
+        if self.card_trace is None or self._command_started is None:
+            return
+        seconds = time.perf_counter() - self._command_started
+        self._command_started = None
+        self.card_trace.costs.add(self.field_name, self.phase, apdu_command_name(cmd), seconds)
+
+    def start_card(self):
+        self.card_trace = CardTrace(self.reader)
+        self.field_name = CARD_FIELD
+        self.phase = PHASE_DETECT
+
+    def finish_card(self, error: Optional[Exception] = None) -> CardTrace:
+        card_trace = self.card_trace
+        self.card_trace = None
+        card_trace.wall_seconds = time.time() - card_trace.started
+        if error is not None:
+            card_trace.error = f"({error.__class__.__name__}) {error}"
+
+        costs = card_trace.costs
+        if log.isEnabledFor(logging.INFO):
+            commands = ", ".join(
+                f"{command} {cost['count']}" for command, cost in sorted(costs.commands().items())
+            )
+            log.info("APDU trace: %d APDUs, %.3f s (%s)", costs.apdus, costs.seconds, commands)
+
+        if self.sink is not None:
+            self.sink.write_card(card_trace)
+        return card_trace
+
+    @contextmanager
+    def attribute(self, field_name: str, phase: str):
+        previous = (self.field_name, self.phase)
+        self.field_name, self.phase = field_name, phase
+        try:
+            yield
+        finally:
+            self.field_name, self.phase = previous
+
+
+def get_cost_tracer(scc) -> Optional[ApduCostTracer]:
+    """Returns the ApduCostTracer of the SimCardCommands' transport, or None if not tracing"""
+    tracer = getattr(scc._tp, "apdu_tracer", None)
+    if isinstance(tracer, ApduCostTracer):
+        return tracer
+    return None
+
+
+@contextmanager
+def trace_phase(card, field_name: Optional[str], phase: str):
+    """Attributes APDUs sent inside this block to field_name and phase (no-op if not tracing)"""
+    tracer = get_cost_tracer(card._scc)
+    if tracer is None:
+        yield
+        return
+    with tracer.attribute(field_name or CARD_FIELD, phase):
+        yield
+
+
+@contextmanager
+def trace_card(scc):
+    """Collects APDU costs of one card, and writes them to the tracer's sink (no-op if not tracing)"""
+    tracer = get_cost_tracer(scc)
+    if tracer is None:
+        yield None
+        return
+
+    tracer.start_card()
+    try:
+        yield tracer.card_trace
+    except Exception as e:
+        tracer.finish_card(e)
+        raise
+    else:
+        tracer.finish_card()
@@ -0,0 +1,250 @@
+import logging
+from typing import Iterable, Optional
+
+from pySim.exceptions import SwMatchError
+
+log = logging.getLogger(__name__)
+
+HexStr = str
+
+# Data bytes in short APDUs (Le = 00 means 256)
+SHORT_MAX_COMMAND_DATA = 255
+SHORT_MAX_RESPONSE_DATA = 256
+
+# Data bytes in extended length APDUs (Le = 0000 means 65536)
+EXTENDED_MAX_COMMAND_DATA = 65535
+EXTENDED_MAX_RESPONSE_DATA = 65536
+
+# READ BINARY / UPDATE BINARY offset is 15 bits (P1 bit 8 set means SFI)
+MAX_BINARY_OFFSET = 0x7FFF
+
+# ISO/IEC 7816-4 compact-TLV tag of the card capabilities in the historical bytes,
+# and the bit of its third byte that means extended Lc and Le fields are supported
+CARD_CAPABILITIES_TAG = 0x7
+EXTENDED_LENGTH_BIT = 0x40
+
+
+############################################################################
+
+
+def atr_historical_bytes(atr: bytes) -> bytes:
+    """Returns the historical bytes of an ATR (ISO/IEC 7816-3), or b'' if the ATR is too short"""
+    if len(atr) < 2:
+        return b""
+
+    num_historical_bytes = atr[1] & 0x0F
+    interface_bytes_present = atr[1] >> 4
+    i = 2
+    while interface_bytes_present:
+        num_interface_bytes = bin(interface_bytes_present).count("1")
+        i += num_interface_bytes
+        if i > len(atr):
+            return b""
+        # TDi is the last interface byte of the group, and tells which bytes of the next group are present
+        interface_bytes_present = atr[i - 1] >> 4 if interface_bytes_present & 0x8 else 0
+
+    return atr[i : i + num_historical_bytes]
+
+
+def atr_supports_extended_length(atr: Iterable[int]) -> bool:
+    """True if the card capabilities in the ATR's historical bytes advertise extended Lc and Le fields"""
+    historical_bytes = atr_historical_bytes(bytes(atr))
+    if not historical_bytes:
+        return False
+
+    category = historical_bytes[0]
+    if category == 0x80:
+        tlv_bytes = historical_bytes[1:]
+    elif category == 0x00:
+        # Followed by compact-TLV objects, and 3 status bytes at the end
+        tlv_bytes = historical_bytes[1:-3]
+    else:
+        return False
+
+    i = 0
+    while i < len(tlv_bytes):
+        tag, length = tlv_bytes[i] >> 4, tlv_bytes[i] & 0x0F
+        value = tlv_bytes[i + 1 : i + 1 + length]
+        if tag == CARD_CAPABILITIES_TAG and len(value) >= 3:
+            return bool(value[2] & EXTENDED_LENGTH_BIT)
+        i += 1 + length
+    return False
+
+
+############################################################################
+
+
+class TransferLimits:
+    """Largest data field of READ BINARY (response) and UPDATE BINARY (command) APDUs for one card
+
+    Lowered during the card session if the card rejects a length (6700), or returns less data than requested (6Cxx)
+    """
+
+    def __init__(
+        self,
+        max_command_data: int = SHORT_MAX_COMMAND_DATA,
+        max_response_data: int = SHORT_MAX_RESPONSE_DATA,
+    ):
+        self.max_command_data = max_command_data
+        self.max_response_data = max_response_data
+        self.fallbacks = 0
+
+    @property
+    def extended(self) -> bool:
+        return (
+            self.max_command_data > SHORT_MAX_COMMAND_DATA
+            or self.max_response_data > SHORT_MAX_RESPONSE_DATA
+        )
+
+    @staticmethod
+    def _lower(rejected_length: int, short_max: int) -> Optional[int]:
+        if rejected_length > short_max:
+            # Extended length is not supported after all
+            return short_max
+        if rejected_length > 1:
+            return rejected_length // 2
+        return None
+
+    def lower_command_data(self, rejected_length: int) -> bool:
+        """Returns False if the command data can't be made any smaller"""
+        new_max = self._lower(rejected_length, SHORT_MAX_COMMAND_DATA)
+        if new_max is None:
+            return False
+        log.warning("UPDATE BINARY of %d bytes rejected, retrying with %d bytes", rejected_length, new_max)
+        self.max_command_data = new_max
+        self.fallbacks += 1
+        return True
+
+    def lower_response_data(self, rejected_length: int) -> bool:
+        """Returns False if the response data can't be made any smaller"""
+        new_max = self._lower(rejected_length, SHORT_MAX_RESPONSE_DATA)
+        if new_max is None:
+            return False
+        log.warning("READ BINARY of %d bytes rejected, retrying with %d bytes", rejected_length, new_max)
+        self.max_response_data = new_max
+        self.fallbacks += 1
+        return True
+
+    def __repr__(self):
+        return (
+            f"TransferLimits(command={self.max_command_data}, response={self.max_response_data}, "
+            f"fallbacks={self.fallbacks})"
+        )
+
+
+def negotiate_transfer_limits(
+    atr: Iterable[int], *, extended: bool = False, max_apdu_data: Optional[int] = None
+) -> TransferLimits:
+    """
+    extended: use extended length APDUs if the ATR advertises them.  The reader must support them too,
+        which can't be detected, so this is opt-in
+    max_apdu_data: cap on the data bytes of a single APDU (for readers or cards with smaller buffers)
+    """
+    if extended and atr_supports_extended_length(atr):
+        limits = TransferLimits(EXTENDED_MAX_COMMAND_DATA, EXTENDED_MAX_RESPONSE_DATA)
+    else:
+        limits = TransferLimits()
+
+    if max_apdu_data is not None:
+        limits.max_command_data = min(limits.max_command_data, max_apdu_data)
+        limits.max_response_data = min(limits.max_response_data, max_apdu_data)
+
+    log.info(
+        "APDU data limits: %d bytes per UPDATE BINARY, %d bytes per READ BINARY%s",
+        limits.max_command_data,
+        limits.max_response_data,
+        " (extended length)" if limits.extended else "",
+    )
+    return limits
+
+
+############################################################################
+
+
+def read_binary_apdu(cla: HexStr, offset: int, length: int) -> HexStr:
+    if length > SHORT_MAX_RESPONSE_DATA:
+        return cla + "b0%04x00%04x" % (offset, length & 0xFFFF)
+    return cla + "b0%04x%02x" % (offset, length & 0xFF)
+
+
+def update_binary_apdu(cla: HexStr, offset: int, data: HexStr) -> HexStr:
+    length = len(data) // 2
+    if length > SHORT_MAX_COMMAND_DATA:
+        return cla + "d6%04x00%04x" % (offset, length) + data
+    return cla + "d6%04x%02x" % (offset, length) + data
+
+
+def _check_offset(offset: int):
+    if offset > MAX_BINARY_OFFSET:
+        raise ValueError(f"Offset {offset} is past the max READ/UPDATE BINARY offset {MAX_BINARY_OFFSET}")
+
+
+def read_binary_chunks(scc, offset: int, length: int, limits: TransferLimits) -> HexStr:
+    """READ BINARY of length bytes at offset of the currently selected EF, in as few APDUs as limits allow
+
+    SwMatchError: if the card returns an error
+    """
+    tp = scc._tp
+    data = []
+    end = offset + length
+    while offset < end:
+        _check_offset(offset)
+        chunk_len = min(limits.max_response_data, end - offset)
+        chunk, sw = tp.send_apdu(read_binary_apdu(scc.cla_byte, offset, chunk_len))
+        if sw == "6700" and limits.lower_response_data(chunk_len):
+            continue
+        if sw != "9000":
+            raise SwMatchError(sw, "9000", tp.sw_interpreter)
+
+        received = len(chunk) // 2
+        if received == 0:
+            raise ValueError(f"READ BINARY at offset {offset} returned no data")
+        if received < chunk_len:
+            # Card asked for a smaller Le (6Cxx), and pySim already resent the READ BINARY with it
+            log.warning("READ BINARY of %d bytes returned %d bytes, continuing with %d bytes", chunk_len, received, received)
+            limits.max_response_data = received
+            limits.fallbacks += 1
+
+        data.append(chunk)
+        offset += received
+    return "".join(data)
+
+
+def update_binary_chunks(scc, offset: int, data: HexStr, limits: TransferLimits) -> None:
+    """UPDATE BINARY of data at offset of the currently selected EF, in as few APDUs as limits allow
+
+    SwMatchError: if the card returns an error
+    """
+    length = len(data) // 2
+    tp = scc._tp
+    position = 0
+    while position < length:
+        _check_offset(offset + position)
+        chunk_len = min(limits.max_command_data, length - position)
+        chunk = data[position * 2 : (position + chunk_len) * 2]
+        _, sw = tp.send_apdu(update_binary_apdu(scc.cla_byte, offset + position, chunk))
+        if sw == "6700" and limits.lower_command_data(chunk_len):
+            continue
+        if sw != "9000":
+            raise SwMatchError(sw, "9000", tp.sw_interpreter)
+        position += chunk_len
+
+
+def read_binary(scc, ef, limits: TransferLimits, offset: int = 0, length: Optional[int] = None) -> HexStr:
+    """Selects ef, and reads length bytes at offset (to the end of the file if length is None)
+
+    Used instead of pySim's read_binary(), which doesn't handle a non-zero offset, and always reads 255 byte chunks
+    """
+    if length is None:
+        length = scc.binary_size(ef) - offset
+    scc.select_path(ef)
+    return read_binary_chunks(scc, offset, length, limits)
+
+
+def update_binary(scc, ef, data: HexStr, limits: TransferLimits, offset: int = 0) -> None:
+    """Selects ef, and writes data at offset
+
+    Used instead of pySim's update_binary(), which doesn't handle a non-zero offset, and always writes 255 byte chunks
+    """
+    scc.select_path(ef)
+    update_binary_chunks(scc, offset, data, limits)
@@ -0,0 +1,217 @@
+import re
+from typing import Dict, List, NamedTuple, Sequence
+
+from sim_csv_script.exceptions import InvalidTemplateError
+from sim_csv_script.fields import (
+    ALL_FieldName_to_EF,
+    FIELDS_THAT_USE_RECORDS,
+    parse_field_name,
+)
+from sim_csv_script.templates import compile_template, is_template
+
+# Whole FieldValue must be pairs of hex digits.  Unlike int(value, 16), this rejects
+# a 0x prefix, underscores, signs and surrounding whitespace, which can't be written to a card
+VALID_FIELD_VALUE_REGEX = re.compile(r"(?:[0-9A-Fa-f]{2})+")
+# All FieldValues joined with FIELD_VALUE_SEPARATOR, to check their characters with a single match
+FIELD_VALUE_SEPARATOR = ","
+HEX_OR_SEPARATOR_REGEX = re.compile(r"[0-9A-Fa-f,]*")
+HEX_REGEX = re.compile(r"[0-9A-Fa-f]+")
+WHITESPACE_REGEX = re.compile(r"\s")
+NON_HEX_CHARACTER_REGEX = re.compile(r"[^0-9A-Fa-f\s]")
+
+# Validation rules, in the order they are reported for a field
+RULE_INVALID_NAME = "invalid field name"
+RULE_DUPLICATE_NAME = "duplicate field name"
+RULE_FIELD_AND_RECORD = "field used together with its records"
+RULE_EMPTY_VALUE = "empty value"
+RULE_SPACES = "spaces in value"
+RULE_INVALID_HEX = "invalid hex characters"
+RULE_ODD_LENGTH = "odd number of hex characters"
+RULE_INVALID_TEMPLATE = "invalid template"
+
+# First line of the CSV file is the header
+FIRST_ROW_LINE_NUMBER = 2
+
+
+class FieldProblem(NamedTuple):
+    # Index of the row in the CSV file (0 is the first row after the header)
+    row: int
+    field_name: str
+    rule: str
+    message: str
+
+    @property
+    def line_number(self) -> int:
+        return self.row + FIRST_ROW_LINE_NUMBER
+
+    def __str__(self):
+        return f"Line {self.line_number} ({self.field_name}): {self.message}"
+
+
+def is_valid_hex(test_string: str) -> bool:
+    """
+    Returns True if test_string is only hex digits
+    Returns False if invalid (including a 0x prefix, underscores and spaces)
+    """
+    return HEX_REGEX.fullmatch(test_string) is not None
+
+
+def is_even_number_hex_characters(test_string: str) -> bool:
+    """
+    Returns True if string length is even
+    Returns False if string length is odd
+    """
+    return not (len(test_string) & 1)
+
+
+def has_spaces(test_string: str) -> bool:
+    """
+    Returns True if there are spaces
+    Returns False if there are no spaces
+    """
+    return WHITESPACE_REGEX.search(test_string) is not None
+
+
+############################################################################
+
+
+def find_value_problems(
+    row: int, field_name: str, field_value: str, allow_templates: bool = False
+) -> List[FieldProblem]:
+    """Returns the problems of one FieldValue.  Valid values only cost one regex match
+
+    allow_templates: FieldValue can be a template (see sim_csv_script.templates), which is checked instead.
+    Its expansion for each card is validated again
+    """
+    if VALID_FIELD_VALUE_REGEX.fullmatch(field_value):
+        return []
+
+    if allow_templates and is_template(field_value):
+        try:
+            compile_template(field_name, field_value)
+        except InvalidTemplateError as e:
+            return [FieldProblem(row, field_name, RULE_INVALID_TEMPLATE, str(e))]
+        return []
+
+    if field_value == "":
+        return [FieldProblem(row, field_name, RULE_EMPTY_VALUE, "FieldValue is empty")]
+
+    problems = []
+    if has_spaces(field_value):
+        problems.append(
+            FieldProblem(row, field_name, RULE_SPACES, "Field values can not contain spaces")
+        )
+
+    non_hex_characters = sorted(set(NON_HEX_CHARACTER_REGEX.findall(field_value)))
+    if non_hex_characters:
+        problems.append(
+            FieldProblem(
+                row,
+                field_name,
+                RULE_INVALID_HEX,
+                f"Invalid hex characters {''.join(non_hex_characters)!r}"
+                + (" (remove the 0x prefix)" if field_value[:2].lower() == "0x" else ""),
+            )
+        )
+    elif not is_even_number_hex_characters(WHITESPACE_REGEX.sub("", field_value)):
+        problems.append(
+            FieldProblem(
+                row,
+                field_name,
+                RULE_ODD_LENGTH,
+                "Odd number of hex characters.  If correct, add a '0' in front of the FieldValue",
+            )
+        )
+    return problems
+
+
+def all_field_values_valid(field_values: Sequence[str]) -> bool:
+    """Checks every FieldValue at once: the set of their lengths, and one regex match over all of them joined"""
+    if not field_values:
+        return True
+    if any(length == 0 or length & 1 for length in set(map(len, field_values))):
+        return False
+    joined_field_values = FIELD_VALUE_SEPARATOR.join(field_values)
+    # A separator inside a value is an invalid character anyway
+    if joined_field_values.count(FIELD_VALUE_SEPARATOR) != len(field_values) - 1:
+        return False
+    return HEX_OR_SEPARATOR_REGEX.fullmatch(joined_field_values) is not None
+
+
+def find_field_problems(
+    field_names: Sequence[str], field_values: Sequence[str], allow_templates: bool = False
+) -> List[FieldProblem]:
+    """Checks every rule of every field, and returns all problems found, by row
+
+    1. FieldName must match keys (case-sensitive) in Pysim's EF, EF_USIM_ADF_map, or EF_ISIM_ADF_map python dictionaries.
+       Fields that use records can also be FIELD.N (e.g. IMPU.2) to only use record N
+    2. There can't be FieldName duplicates, and a field can't be used together with its records (e.g. IMPU and IMPU.2)
+    3. FieldValues must not be empty, or have spaces
+    4. FieldValues must only have hex characters (no 0x prefix or underscores)
+    5. FieldValues must have even number of hex characters
+    6. If allow_templates is set, FieldValues can instead be valid templates
+
+    Valid fields are checked with set operations and one regex match over all values.
+    Only if something is invalid, each row is checked again to report its problems
+    """
+    field_names = list(field_names)
+    field_values = list(field_values)
+
+    # Names that aren't whole fields are records (FIELD.N) or invalid
+    invalid_field_names = set()
+    record_base_field_names = set()
+    for field_name in set(field_names).difference(ALL_FieldName_to_EF):
+        base_field_name, _ = parse_field_name(field_name)
+        if base_field_name in ALL_FieldName_to_EF:
+            record_base_field_names.add(base_field_name)
+        else:
+            invalid_field_names.add(field_name)
+
+    has_duplicates = len(set(field_names)) != len(field_names)
+    field_values_valid = all_field_values_valid(field_values)
+    overlapping_field_names = record_base_field_names.intersection(field_names)
+    if not (invalid_field_names or overlapping_field_names or has_duplicates or not field_values_valid):
+        return []
+
+    problems = []
+    first_row_of_field = {}  # type: Dict[str, int]
+    for row, (field_name, field_value) in enumerate(zip(field_names, field_values)):
+        if field_name in invalid_field_names:
+            problems.append(FieldProblem(row, field_name, RULE_INVALID_NAME, "Invalid Field Name"))
+
+        if field_name in first_row_of_field:
+            problems.append(
+                FieldProblem(
+                    row,
+                    field_name,
+                    RULE_DUPLICATE_NAME,
+                    f"Duplicate Field Name (first on line {first_row_of_field[field_name] + FIRST_ROW_LINE_NUMBER})",
+                )
+            )
+        else:
+            first_row_of_field[field_name] = row
+
+        if field_name in overlapping_field_names:
+            problems.append(
+                FieldProblem(
+                    row,
+                    field_name,
+                    RULE_FIELD_AND_RECORD,
+                    f"Fields can't be used together with their records ({field_name}.N)",
+                )
+            )
+
+        if not field_values_valid:
+            problems.extend(find_value_problems(row, field_name, field_value, allow_templates))
+
+    return problems
+
+
+def format_field_problems(problems: Sequence[FieldProblem]) -> str:
+    lines = [f"{len(problems)} problem(s) in fields:"]
+    lines.extend(f"  {problem}" for problem in problems)
+    if any(problem.rule == RULE_INVALID_NAME for problem in problems):
+        lines.append(
+            f"Valid field names are keys in EF, EF_USIM_ADF_map, and EF_ISIM_ADF_map, or FIELD.N for record N of {list(FIELDS_THAT_USE_RECORDS)}"
+        )
+    return "\n".join(lines)
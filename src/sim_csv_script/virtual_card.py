@@ -0,0 +1,570 @@
+import json
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from pySim.exceptions import NoCardError
+from pySim.transport import LinkBase
+from pySim.ts_31_102 import EF_USIM_ADF_map
+from pySim.ts_31_103 import EF_ISIM_ADF_map
+from pySim.utils import enc_iccid, enc_imsi, sanitize_pin_adm
+
+from sim_csv_script.exceptions import NoMoreCardsError
+from sim_csv_script.fields import ALL_FieldName_to_EF
+
+HexStr = str
+
+# (data, sw) as returned by a card
+Response = Tuple[HexStr, HexStr]
+
+MF_FID = "3f00"
+CURRENT_ADF_FID = "7fff"
+
+ADF_AIDS = {
+    "usim": "a0000000871002ff86ff0389ffffffff",
+    "isim": "a0000000871004ff86ff0389ffffffff",
+}
+
+ADF_FieldName_maps = {
+    "usim": EF_USIM_ADF_map,
+    "isim": EF_ISIM_ADF_map,
+}
+
+DEFAULT_ATR = "3b821f0000"
+
+# Historical bytes with card capabilities (compact-TLV tag 7) that advertise extended Lc and Le fields
+EXTENDED_LENGTH_ATR = "3b058073000040"
+
+# Key reference of ADM1, as used by check_pin_adm()
+ADM_KEY_REFERENCE = 0x0A
+
+DIR_RECORD_SIZE = 32
+
+
+############################################################################
+
+
+def _tlv(tag: HexStr, value: HexStr) -> HexStr:
+    return tag + "%02x" % (len(value) // 2) + value
+
+
+class VirtualFile:
+    """MF, DF, ADF, transparent EF or linear fixed EF on a VirtualCard"""
+
+    MF = "MF"
+    DF = "DF"
+    ADF = "ADF"
+    TRANSPARENT = "TRANSPARENT"
+    LINEAR_FIXED = "LINEAR_FIXED"
+
+    def __init__(
+        self,
+        fid: HexStr,
+        kind: str,
+        parent: Optional["VirtualFile"] = None,
+        *,
+        aid: Optional[HexStr] = None,
+        size: int = 0,
+        record_size: int = 0,
+        record_count: int = 0,
+        data: Optional[HexStr] = None,
+    ):
+        self.fid = fid.lower()
+        self.kind = kind
+        self.parent = parent
+        self.aid = aid
+        self.children = {}  # type: Dict[str, VirtualFile]
+        self.record_size = record_size
+        self.record_count = record_count
+
+        if kind == self.LINEAR_FIXED:
+            size = record_size * record_count
+
+        if data is None:
+            self.data = bytearray(b"\xff" * size)
+        else:
+            self.data = bytearray.fromhex(data)
+            if len(self.data) != size:
+                raise ValueError(
+                    f"Initial value of file {self.fid} is {len(self.data)} bytes, but file size is {size} bytes"
+                )
+
+    @property
+    def is_df(self) -> bool:
+        return self.kind in (self.MF, self.DF, self.ADF)
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    def add_child(self, child: "VirtualFile") -> "VirtualFile":
+        child.parent = self
+        self.children[child.fid] = child
+        return child
+
+    def fcp(self) -> HexStr:
+        """FCP template returned by SELECT (ETSI TS 102 221, chapter 11.1.1.3)"""
+        if self.is_df:
+            body = _tlv("82", "7821")
+            if self.kind == self.ADF:
+                body += _tlv("84", self.aid)
+            else:
+                body += _tlv("83", self.fid)
+        elif self.kind == self.LINEAR_FIXED:
+            body = _tlv("82", "4221%04x%02x" % (self.record_size, self.record_count))
+            body += _tlv("83", self.fid)
+            body += _tlv("80", "%04x" % self.size)
+        else:
+            body = _tlv("82", "4121")
+            body += _tlv("83", self.fid)
+            body += _tlv("80", "%04x" % self.size)
+        body += _tlv("8a", "05")
+        return _tlv("62", body)
+
+    def record_slice(self, rec_no: int) -> slice:
+        start = (rec_no - 1) * self.record_size
+        return slice(start, start + self.record_size)
+
+
+############################################################################
+
+
+def field_file_locations(field_name: str) -> List[Tuple[str, ...]]:
+    """Returns the locations where field_name's file is expected on the card
+
+    MF based fields have a single absolute path (e.g. ('3f00', '7f20', '6f46')),
+    and ADF based fields are placed in every ADF that lists them (e.g. ('isim', '6f04')),
+    since check_isim_field() and check_usim_field() look them up in each ADF.
+    """
+    ef = ALL_FieldName_to_EF[field_name]
+
+    if isinstance(ef, list):
+        return [tuple(fid.lower() for fid in ef)]
+
+    return [
+        (adf, ef.lower())
+        for adf, adf_map in ADF_FieldName_maps.items()
+        if field_name in adf_map
+    ]
+
+
+class VirtualCard:
+    """In-memory UICC with a configurable file system
+
+    Implements SELECT, STATUS, READ/UPDATE BINARY, READ/UPDATE RECORD and VERIFY
+    closely enough for pySim's SimCardCommands, so that every path in app.py can
+    run without a card reader.
+    """
+
+    def __init__(
+        self,
+        *,
+        iccid: str,
+        imsi: str,
+        pin_adm: str,
+        adfs: Iterable[str] = ("usim", "isim"),
+        atr: HexStr = DEFAULT_ATR,
+        adm_retries: int = 3,
+        extended_length: bool = False,
+        max_apdu_data: Optional[int] = None,
+    ):
+        """
+        extended_length: accept extended length APDUs (and advertise them in the ATR, unless atr is given)
+        max_apdu_data: READ BINARY / UPDATE BINARY with more data bytes than this are rejected with 6700
+        """
+        self.iccid = iccid
+        self.imsi = imsi
+        self.extended_length = extended_length
+        if extended_length and atr == DEFAULT_ATR:
+            atr = EXTENDED_LENGTH_ATR
+        self.atr = atr
+        self.max_apdu_data = max_apdu_data
+        self.adm_retries = adm_retries
+
+        # Same conventions as check_pin_adm()
+        if pin_adm.startswith("0x"):
+            self.pin_adm = sanitize_pin_adm(None, pin_adm_hex=pin_adm[2:])
+        else:
+            self.pin_adm = sanitize_pin_adm(pin_adm)
+        self.pin_adm = self.pin_adm.lower()
+
+        self.mf = VirtualFile(MF_FID, VirtualFile.MF)
+        self.adfs = {}  # type: Dict[str, VirtualFile]
+        for adf in adfs:
+            if adf not in ADF_AIDS:
+                raise ValueError(f"Unknown ADF '{adf}'. Valid ADFs are {list(ADF_AIDS)}")
+            self.adfs[adf] = VirtualFile(
+                CURRENT_ADF_FID, VirtualFile.ADF, self.mf, aid=ADF_AIDS[adf]
+            )
+
+        # EF.DIR with an application template for each ADF
+        dir_file = self.add_file(
+            (MF_FID, "2f00"),
+            record_size=DIR_RECORD_SIZE,
+            record_count=max(len(self.adfs), 1),
+        )
+        for rec_no, adf_file in enumerate(self.adfs.values(), start=1):
+            app_template = _tlv("61", _tlv("4f", adf_file.aid))
+            record = bytearray.fromhex(app_template.ljust(DIR_RECORD_SIZE * 2, "f"))
+            dir_file.data[dir_file.record_slice(rec_no)] = record
+
+        self.add_file((MF_FID, "2fe2"), data=enc_iccid(iccid))
+        self.add_file((MF_FID, "7f20", "6f07"), data=enc_imsi(imsi))
+        if "usim" in self.adfs:
+            self.add_file(("usim", "6f07"), data=enc_imsi(imsi))
+
+        self.reset_state()
+
+    def reset_state(self):
+        """Power cycle: MF is selected and ADM is no longer verified"""
+        self.current_df = self.mf
+        self.current_ef = None  # type: Optional[VirtualFile]
+        self.current_adf = None  # type: Optional[VirtualFile]
+        self.adm_verified = False
+
+    ############################################################################
+
+    def _resolve_parent(self, location: Tuple[str, ...]) -> VirtualFile:
+        root, *path = location
+        if root == MF_FID:
+            df = self.mf
+        elif root in self.adfs:
+            df = self.adfs[root]
+        else:
+            raise KeyError(f"Unknown location {location}")
+
+        # Create intermediate DFs (e.g. DF.TELECOM, DF.GSM) as needed
+        for fid in path[:-1]:
+            if fid not in df.children:
+                df.add_child(VirtualFile(fid, VirtualFile.DF))
+            df = df.children[fid]
+        return df
+
+    def add_file(
+        self,
+        location: Tuple[str, ...],
+        *,
+        size: Optional[int] = None,
+        record_size: int = 0,
+        record_count: int = 0,
+        data: Optional[HexStr] = None,
+    ) -> VirtualFile:
+        """Adds a transparent EF (size) or linear fixed EF (record_size and record_count)
+
+        location is an absolute path starting with '3f00', or an ADF name followed by FID (e.g. ('isim', '6f04'))
+        """
+        location = tuple(fid.lower() for fid in location)
+        parent = self._resolve_parent(location)
+
+        if record_size:
+            ef = VirtualFile(
+                location[-1],
+                VirtualFile.LINEAR_FIXED,
+                record_size=record_size,
+                record_count=record_count,
+                data=data,
+            )
+        else:
+            if size is None:
+                if data is None:
+                    raise ValueError(f"File {location} requires a size, record_size or value")
+                size = len(data) // 2
+            ef = VirtualFile(location[-1], VirtualFile.TRANSPARENT, size=size, data=data)
+
+        return parent.add_child(ef)
+
+    def add_field(self, field_name: str, **kwargs) -> List[VirtualFile]:
+        """Adds field_name's file at every location where app.py expects it"""
+        locations = [
+            location
+            for location in field_file_locations(field_name)
+            if location[0] == MF_FID or location[0] in self.adfs
+        ]
+        if not locations:
+            raise ValueError(f"[{field_name}]: Requires an ADF that is not on this card")
+        return [self.add_file(location, **kwargs) for location in locations]
+
+    def get_file(self, location: Tuple[str, ...]) -> VirtualFile:
+        location = tuple(fid.lower() for fid in location)
+        return self._resolve_parent(location).children[location[-1]]
+
+    def read_field(self, field_name: str) -> HexStr:
+        """Returns current contents of field_name's file (at its first location)"""
+        return self.get_file(field_file_locations(field_name)[0]).data.hex()
+
+    ############################################################################
+
+    def _select_by_fid(self, fid: HexStr) -> Optional[VirtualFile]:
+        df = self.current_df
+
+        if fid == MF_FID:
+            return self.mf
+        if fid == CURRENT_ADF_FID:
+            return self.current_adf
+        if fid in df.children:
+            return df.children[fid]
+        if fid == df.fid and df.kind != VirtualFile.ADF:
+            return df
+        if df.parent is not None:
+            if fid == df.parent.fid:
+                return df.parent
+            if fid in df.parent.children:
+                return df.parent.children[fid]
+        return None
+
+    def _select_by_aid(self, aid: HexStr) -> Optional[VirtualFile]:
+        for adf_file in self.adfs.values():
+            if adf_file.aid.startswith(aid):
+                return adf_file
+        return None
+
+    def _select(self, p1: int, p2: int, data: HexStr) -> Response:
+        if p1 == 0x00:
+            selected = self._select_by_fid(data)
+        elif p1 == 0x04:
+            selected = self._select_by_aid(data)
+        else:
+            return "", "6a86"
+
+        if selected is None:
+            return "", "6a82"
+
+        if selected.is_df:
+            self.current_df = selected
+            self.current_ef = None
+            if selected.kind == VirtualFile.ADF:
+                self.current_adf = selected
+        else:
+            self.current_df = selected.parent
+            self.current_ef = selected
+
+        if p2 == 0x0C:
+            return "", "9000"
+        return selected.fcp(), "9000"
+
+    def _check_current_ef(self, kind: str) -> Optional[HexStr]:
+        if self.current_ef is None:
+            return "6986"
+        if self.current_ef.kind != kind:
+            return "6981"
+        return None
+
+    def _read_binary(self, p1: int, p2: int, le: int) -> Response:
+        sw = self._check_current_ef(VirtualFile.TRANSPARENT)
+        if sw:
+            return "", sw
+
+        offset = (p1 << 8) | p2
+        ef = self.current_ef
+        if self.max_apdu_data is not None and le > self.max_apdu_data:
+            return "", "6700"
+        if offset >= ef.size:
+            return "", "6b00"
+        if offset + le > ef.size:
+            return "", "6c%02x" % (ef.size - offset)
+        return ef.data[offset : offset + le].hex(), "9000"
+
+    def _update_binary(self, p1: int, p2: int, data: HexStr) -> Response:
+        sw = self._check_current_ef(VirtualFile.TRANSPARENT)
+        if sw:
+            return "", sw
+        if not self.adm_verified:
+            return "", "6982"
+
+        offset = (p1 << 8) | p2
+        value = bytes.fromhex(data)
+        ef = self.current_ef
+        if self.max_apdu_data is not None and len(value) > self.max_apdu_data:
+            return "", "6700"
+        if offset >= ef.size:
+            return "", "6b00"
+        if offset + len(value) > ef.size:
+            return "", "6700"
+        ef.data[offset : offset + len(value)] = value
+        return "", "9000"
+
+    def _read_record(self, p1: int, p2: int, le: int) -> Response:
+        sw = self._check_current_ef(VirtualFile.LINEAR_FIXED)
+        if sw:
+            return "", sw
+        if p2 != 0x04:
+            return "", "6a86"
+
+        ef = self.current_ef
+        if not 1 <= p1 <= ef.record_count:
+            return "", "6a83"
+        if le != ef.record_size:
+            return "", "6c%02x" % ef.record_size
+        return ef.data[ef.record_slice(p1)].hex(), "9000"
+
+    def _update_record(self, p1: int, p2: int, data: HexStr) -> Response:
+        sw = self._check_current_ef(VirtualFile.LINEAR_FIXED)
+        if sw:
+            return "", sw
+        if not self.adm_verified:
+            return "", "6982"
+        if p2 != 0x04:
+            return "", "6a86"
+
+        ef = self.current_ef
+        if not 1 <= p1 <= ef.record_count:
+            return "", "6a83"
+        value = bytes.fromhex(data)
+        if len(value) != ef.record_size:
+            return "", "6700"
+        ef.data[ef.record_slice(p1)] = value
+        return "", "9000"
+
+    def _verify(self, p2: int, data: HexStr) -> Response:
+        if p2 != ADM_KEY_REFERENCE:
+            return "", "6a88"
+        if self.adm_retries == 0:
+            return "", "6983"
+        if data.lower() != self.pin_adm:
+            self.adm_retries -= 1
+            return "", "63c%x" % self.adm_retries
+        self.adm_verified = True
+        return "", "9000"
+
+    def process_apdu(self, pdu: HexStr) -> Response:
+        """Processes a command APDU in hex, and returns (data, sw) in hex"""
+        pdu = pdu.lower()
+        cla = pdu[0:2]
+        ins = pdu[2:4]
+        p1 = int(pdu[4:6], 16)
+        p2 = int(pdu[6:8], 16)
+        p3 = int(pdu[8:10], 16) if len(pdu) >= 10 else 0
+        data = pdu[10:]
+        le = p3 or 256
+
+        if p3 == 0 and len(pdu) > 10:
+            # Extended length: 00 followed by 2 byte Le (no data), or 2 byte Lc and data
+            if not self.extended_length:
+                return "", "6700"
+            if len(pdu) == 14:
+                le, data = int(pdu[10:14], 16) or 65536, ""
+            else:
+                data = pdu[14:]
+
+        # UICC only, so SIM class byte is rejected (set_commands_cla_byte_and_sel_ctrl() relies on this)
+        if cla not in ("00", "80"):
+            return "", "6e00"
+
+        if ins == "a4":
+            return self._select(p1, p2, data)
+        elif ins == "f2":
+            return self.current_df.fcp(), "9000"
+        elif ins == "b0":
+            return self._read_binary(p1, p2, le)
+        elif ins == "d6":
+            return self._update_binary(p1, p2, data)
+        elif ins == "b2":
+            return self._read_record(p1, p2, le)
+        elif ins == "dc":
+            return self._update_record(p1, p2, data)
+        elif ins == "20":
+            return self._verify(p2, data)
+        return "", "6d00"
+
+    ############################################################################
+
+    @classmethod
+    def from_spec(cls, spec: dict, index: int = 0) -> "VirtualCard":
+        """Creates a card from a spec dictionary (see README), where index is added to ICCID and IMSI"""
+
+        def add_index(number: str) -> str:
+            return str(int(number) + index).zfill(len(number))
+
+        card = cls(
+            iccid=add_index(spec["iccid"]),
+            imsi=add_index(spec["imsi"]),
+            pin_adm=spec["pin_adm"],
+            adfs=spec.get("adfs", ("usim", "isim")),
+            atr=spec.get("atr", DEFAULT_ATR),
+            extended_length=spec.get("extended_length", False),
+            max_apdu_data=spec.get("max_apdu_data"),
+        )
+
+        for field_name, file_spec in spec.get("fields", {}).items():
+            if field_name not in ALL_FieldName_to_EF:
+                raise ValueError(f"Invalid Field Name in virtual card spec: {field_name}")
+            card.add_field(
+                field_name,
+                size=file_spec.get("size"),
+                record_size=file_spec.get("record_size", 0),
+                record_count=file_spec.get("record_count", 0),
+                data=file_spec.get("value"),
+            )
+
+        return card
+
+
+############################################################################
+
+
+class VirtualCardLink(LinkBase):
+    """pySim transport link to VirtualCards, used instead of init_reader()
+
+    Each wait_for_card() inserts the next card from cards, and raises NoMoreCardsError once there are no more cards.
+    apdu_latency is seconds of delay for each APDU, or a function that returns the delay for a command APDU.
+    """
+
+    def __init__(
+        self,
+        cards: Iterable[VirtualCard],
+        *,
+        apdu_latency: Union[float, Callable[[HexStr], float]] = 0.0,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self._cards = iter(cards)  # type: Iterator[VirtualCard]
+        self._apdu_latency = apdu_latency
+        self.card = None  # type: Optional[VirtualCard]
+        self.apdu_count = 0
+
+    @classmethod
+    def from_spec(cls, spec: dict, **kwargs) -> "VirtualCardLink":
+        count = spec.get("count", 1)
+        cards = (VirtualCard.from_spec(spec, index) for index in range(count))
+        kwargs.setdefault("apdu_latency", spec.get("apdu_latency", 0.0))
+        return cls(cards, **kwargs)
+
+    @classmethod
+    def from_spec_file(cls, filename: str, **kwargs) -> "VirtualCardLink":
+        with open(filename, "r") as f:
+            spec = json.load(f)
+        return cls.from_spec(spec, **kwargs)
+
+    def _send_apdu_raw(self, pdu: HexStr) -> Response:
+        if self.card is None:
+            raise NoCardError()
+
+        latency = self._apdu_latency
+        if callable(latency):
+            latency = latency(pdu)
+        if latency:
+            time.sleep(latency)
+
+        self.apdu_count += 1
+        return self.card.process_apdu(pdu)
+
+    def wait_for_card(self, timeout: int = None, newcardonly: bool = False):
+        if newcardonly or self.card is None:
+            self.card = next(self._cards, None)
+            if self.card is None:
+                raise NoMoreCardsError("No more virtual cards")
+        self.connect()
+
+    def connect(self):
+        if self.card is None:
+            raise NoCardError()
+        self.card.reset_state()
+
+    def get_atr(self):
+        return list(bytes.fromhex(self.card.atr)) if self.card is not None else []
+
+    def disconnect(self):
+        pass
+
+    def reset_card(self):
+        self.connect()
+        return 1
@@ -0,0 +1,124 @@
+"""Fixtures that provision virtual cards (see sim_csv_script.virtual_card), so the tests don't need a card reader"""
+import sys
+from typing import List
+
+import pytest
+
+from sim_csv_script.app import CardInputs, get_plan_and_templates, process_card
+from sim_csv_script.cli import get_args
+from sim_csv_script.csv_utils import read_field_table
+from sim_csv_script.engine import CardResult
+from sim_csv_script.session import SessionSimCardCommands
+from sim_csv_script.templates import SequenceCounter
+from sim_csv_script.virtual_card import VirtualCard, VirtualCardLink
+
+PIN_ADM = "88888888"
+
+# Files of the virtual cards: a transparent EF in the MF, one in the USIM, and a record based EF
+FIELD_FILES = {
+    "SPN": {"size": 17},
+    "AD": {"size": 4},
+    "SMSP": {"record_size": 40, "record_count": 2},
+}
+
+# FieldValues that fill each file of FIELD_FILES
+FIELD_VALUES = {
+    "SPN": "4420823cfde6f1c26b30f90ec7dd01e488",
+    "AD": "0d34814f",
+    "SMSP": "4ca2a6a723e78ff5e8bac2281c4418fb807dadb9bdce9dedae550e4b807144395ed2193288366885"
+    "2228256f58dd0bbcf9917066fc78d9e7bb60f62583d06704c2f927ced914b4ea036199023d9aa190",
+}
+
+
+class ApduRecorder:
+    """apdu_latency of a VirtualCardLink, that records the instruction byte of each command APDU"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.instructions = []  # type: List[str]
+
+    def __call__(self, pdu: str) -> float:
+        self.instructions.append(pdu[2:4].lower())
+        return self.latency
+
+    def count(self, instruction: str) -> int:
+        return self.instructions.count(instruction)
+
+
+@pytest.fixture
+def make_card():
+    """Returns a function that creates the virtual card number index (ICCID and IMSI are incremented by index)"""
+
+    def make(
+        index: int = 0, *, fields: dict = FIELD_FILES, values: dict = None, pin_adm: str = PIN_ADM, **spec
+    ) -> VirtualCard:
+        """values: initial contents of the files, {FieldName: hex} (otherwise files are filled with ff)"""
+        if values:
+            fields = {
+                field_name: {**file_spec, "value": values[field_name]} if field_name in values else file_spec
+                for field_name, file_spec in fields.items()
+            }
+        spec = {
+            "iccid": "8988211000000000001",
+            "imsi": "001010000000001",
+            "pin_adm": pin_adm,
+            "fields": fields,
+            **spec,
+        }
+        return VirtualCard.from_spec(spec, index)
+
+    return make
+
+
+@pytest.fixture
+def field_values() -> dict:
+    return dict(FIELD_VALUES)
+
+
+@pytest.fixture
+def write_args() -> tuple:
+    """Command line arguments to write the cards made by make_card"""
+    return ("--write", "--pin-adm", PIN_ADM, "--skip-write-prompt")
+
+
+@pytest.fixture
+def csv_file(tmp_path):
+    """Returns a function that writes a CSV file with {FieldName: FieldValue}, and returns its name"""
+
+    def write(field_values: dict, name: str = "fields.csv") -> str:
+        path = tmp_path / name
+        path.write_text(
+            "FieldName,FieldValue\n" + "".join(f"{field_name},{field_value}\n" for field_name, field_value in field_values.items())
+        )
+        return str(path)
+
+    return write
+
+
+@pytest.fixture
+def parse_args(monkeypatch):
+    """Returns a function that parses command line arguments like sim_csv_script does"""
+
+    def parse(*argv: str):
+        monkeypatch.setattr(sys, "argv", ["sim_csv_script", *argv])
+        return get_args()
+
+    return parse
+
+
+@pytest.fixture
+def provision():
+    """Returns a function that inserts the next card of link, and runs process_card() on it with the CSV file of args"""
+
+    def run(args, link: VirtualCardLink, card_result: CardResult = None, **inputs):
+        plan, templates = get_plan_and_templates(read_field_table(args.CSV_FILE), args)
+        scc = SessionSimCardCommands(transport=link)
+        link.wait_for_card(newcardonly=True)
+        return process_card(link, scc, args, CardInputs(plan, templates, SequenceCounter(), **inputs), card_result)
+
+    return run
+
+
+@pytest.fixture
+def apdu_recorder():
+    return ApduRecorder()
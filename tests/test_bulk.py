@@ -0,0 +1,139 @@
+"""Per-card FieldValues from a bulk input file, looked up by ICCID or IMSI"""
+import os
+
+import pytest
+
+from sim_csv_script.bulk import BULK_FORMAT_LONG, BULK_FORMAT_WIDE, BULK_KEY_ICCID, BULK_KEY_IMSI, BulkInput
+from sim_csv_script.exceptions import BulkInputError
+from sim_csv_script.virtual_card import VirtualCardLink
+
+ICCID_1 = "8988211000000000001"
+ICCID_2 = "8988211000000000002"
+
+
+@pytest.fixture
+def bulk_file(tmp_path):
+    """Returns a function that writes a bulk input file with lines, and returns its name"""
+
+    def write(*lines: str) -> str:
+        path = tmp_path / "bulk.csv"
+        path.write_text("".join(line + "\n" for line in lines))
+        return str(path)
+
+    return write
+
+
+@pytest.fixture
+def open_bulk_input():
+    """Returns a function that opens a BulkInput, which is closed after the test"""
+    bulk_inputs = []
+
+    def open_(path: str, **kwargs) -> BulkInput:
+        bulk_input = BulkInput(path, **kwargs)
+        bulk_inputs.append(bulk_input)
+        return bulk_input
+
+    yield open_
+    for bulk_input in bulk_inputs:
+        bulk_input.close()
+
+
+def test_wide(bulk_file, open_bulk_input):
+    bulk_input = open_bulk_input(
+        bulk_file(
+            "ICCID,IMSI,SPN,AD",
+            f"{ICCID_1},001010000000001,4420,0d34814f",
+            # Empty cells are left out
+            f" {ICCID_2} ,001010000000002,4421,",
+        )
+    )
+
+    assert (bulk_input.format, bulk_input.key, len(bulk_input)) == (BULK_FORMAT_WIDE, BULK_KEY_ICCID, 2)
+    assert bulk_input.field_names == ["SPN", "AD"]
+    assert bulk_input.lookup(ICCID_1, None) == {"SPN": "4420", "AD": "0d34814f"}
+    assert bulk_input.lookup(ICCID_2, None) == {"SPN": "4421"}
+
+
+def test_long(bulk_file, open_bulk_input):
+    bulk_input = open_bulk_input(
+        bulk_file(
+            "IMSI,FieldName,FieldValue",
+            "001010000000001,SPN,4420",
+            "001010000000002,SPN,4421",
+            # Rows of a card don't have to be next to each other
+            "001010000000001,IMPU.2,00ff",
+        )
+    )
+
+    assert (bulk_input.format, bulk_input.key, len(bulk_input)) == (BULK_FORMAT_LONG, BULK_KEY_IMSI, 2)
+    assert bulk_input.lookup(ICCID_1, "001010000000001") == {"SPN": "4420", "IMPU.2": "00ff"}
+    assert bulk_input.lookup(ICCID_2, "001010000000002") == {"SPN": "4421"}
+
+
+def test_key(bulk_file, open_bulk_input):
+    bulk_input = open_bulk_input(
+        bulk_file("ICCID,IMSI,SPN", f"{ICCID_1},001010000000001,4420"), key=BULK_KEY_IMSI
+    )
+
+    assert bulk_input.lookup(None, "001010000000001") == {"SPN": "4420"}
+    with pytest.raises(BulkInputError, match="since its IMSI can't be read"):
+        bulk_input.lookup(ICCID_1, None)
+
+
+def test_card_not_found(bulk_file, open_bulk_input):
+    bulk_input = open_bulk_input(bulk_file("ICCID,SPN", f"{ICCID_1},4420"))
+
+    with pytest.raises(BulkInputError, match=f"ICCID {ICCID_2} is not in bulk input file"):
+        bulk_input.lookup(ICCID_2, None)
+
+
+@pytest.mark.parametrize(
+    "lines, message",
+    [
+        (["SPN,AD", "4420,00"], "has no IMSI column"),
+        (["ICCID,NOT_A_FIELD", f"{ICCID_1},00"], r"Invalid Field Names .* header: \['NOT_A_FIELD'\]"),
+        (["ICCID,SPN,SPN", f"{ICCID_1},00,00"], r"Duplicate Field Names .* header: \['SPN'\]"),
+        (["ICCID,SPN", f"{ICCID_1},00", f"{ICCID_1},01"], f"Duplicate ICCIDs .*{ICCID_1}"),
+        (["ICCID,SPN", f"{ICCID_1},00", f"{ICCID_2},0x01"], r"Line 3 \(SPN\): Invalid hex characters"),
+        (["ICCID,SPN", ",00"], r"Line 2 \(ICCID\): ICCID is empty"),
+        (["ICCID,FieldName,FieldValue", f"{ICCID_1},NOT_A_FIELD,00"], r"Line 2 \(NOT_A_FIELD\): Invalid Field Name"),
+    ],
+)
+def test_invalid_file(bulk_file, lines, message):
+    with pytest.raises(BulkInputError, match=message):
+        BulkInput(bulk_file(*lines))
+
+
+def test_duplicate_field_of_card(bulk_file, open_bulk_input):
+    bulk_input = open_bulk_input(
+        bulk_file("ICCID,FieldName,FieldValue", f"{ICCID_1},SPN,4420", f"{ICCID_1},SPN,4421")
+    )
+
+    with pytest.raises(BulkInputError, match="Duplicate Field Name SPN"):
+        bulk_input.lookup(ICCID_1, None)
+
+
+def test_close_removes_index(bulk_file):
+    bulk_input = BulkInput(bulk_file("ICCID,SPN", f"{ICCID_1},4420"))
+    index_path = bulk_input._index_path
+    assert os.path.exists(index_path)
+
+    bulk_input.close()
+
+    assert not os.path.exists(index_path)
+
+
+def test_write_cards(make_card, bulk_file, csv_file, parse_args, provision, field_values, write_args, open_bulk_input):
+    spn = field_values.pop("SPN")
+    args = parse_args(csv_file(field_values), *write_args)
+    bulk_input = open_bulk_input(
+        bulk_file("ICCID,SPN", f"{ICCID_1},{spn}", f"{ICCID_2},{spn[:-2]}00")
+    )
+    cards = [make_card(0), make_card(1)]
+    link = VirtualCardLink(cards)
+
+    for _ in cards:
+        provision(args, link, bulk_input=bulk_input)
+
+    assert [card.read_field("SPN") for card in cards] == [spn, spn[:-2] + "00"]
+    assert all(card.read_field("AD") == field_values["AD"] for card in cards)
@@ -0,0 +1,241 @@
+"""Provisioning of virtual cards, from the CSV file to the card's files"""
+import time
+
+import pytest
+from pySim.exceptions import NoCardError
+
+from sim_csv_script import app, engine
+from sim_csv_script.exceptions import InvalidADMPinError, InvalidFieldError
+from sim_csv_script.virtual_card import VirtualCardLink
+
+UPDATE_BINARY = "d6"
+UPDATE_RECORD = "dc"
+
+
+def test_write_card(make_card, csv_file, parse_args, provision, field_values, write_args):
+    card = make_card()
+    args = parse_args(csv_file(field_values), *write_args)
+
+    card_result = provision(args, VirtualCardLink([card]))
+
+    for field_name, field_value in field_values.items():
+        assert card.read_field(field_name) == field_value
+    assert (card_result.iccid, card_result.imsi) == ("8988211000000000001", "001010000000001")
+    assert sorted(result.field_name for result in card_result.fields) == sorted(field_values)
+    assert all(result.written and result.verified for result in card_result.fields)
+    assert card_result.verified
+
+
+def test_read_mode_doesnt_write(make_card, csv_file, parse_args, provision, field_values, apdu_recorder):
+    card = make_card()
+    args = parse_args(csv_file(field_values))
+
+    card_result = provision(args, VirtualCardLink([card], apdu_latency=apdu_recorder))
+
+    assert apdu_recorder.count(UPDATE_BINARY) == apdu_recorder.count(UPDATE_RECORD) == 0
+    for field_name, field_value in field_values.items():
+        assert card.read_field(field_name) == "ff" * (len(field_value) // 2)
+    assert all(result.changed and not result.written for result in card_result.fields)
+    assert not card_result.verified
+
+
+def test_skip_write_when_unchanged(make_card, csv_file, parse_args, provision, field_values, write_args, apdu_recorder):
+    card = make_card(values=field_values)
+    args = parse_args(csv_file(field_values), *write_args)
+
+    card_result = provision(args, VirtualCardLink([card], apdu_latency=apdu_recorder))
+
+    assert apdu_recorder.count(UPDATE_BINARY) == apdu_recorder.count(UPDATE_RECORD) == 0
+    assert not any(result.changed or result.written for result in card_result.fields)
+    assert not card_result.verified
+
+
+def test_width_check_fails_before_writing(make_card, csv_file, parse_args, provision, field_values, write_args, apdu_recorder):
+    card = make_card()
+    # One byte short of the file's size
+    field_values["SPN"] = field_values["SPN"][:-2]
+    args = parse_args(csv_file(field_values), *write_args)
+
+    with pytest.raises(ValueError, match=r"\[SPN\]: Hex Str Num Bytes 16 != Field Width 17"):
+        provision(args, VirtualCardLink([card], apdu_latency=apdu_recorder))
+
+    assert apdu_recorder.count(UPDATE_BINARY) == apdu_recorder.count(UPDATE_RECORD) == 0
+    assert card.read_field("AD") == "ffffffff"
+
+
+def test_invalid_adm_pin(make_card, csv_file, parse_args, provision, field_values, write_args, apdu_recorder):
+    card = make_card(pin_adm="12345678")
+    args = parse_args(csv_file(field_values), *write_args)
+
+    with pytest.raises(InvalidADMPinError):
+        provision(args, VirtualCardLink([card], apdu_latency=apdu_recorder))
+
+    assert apdu_recorder.count(UPDATE_BINARY) == apdu_recorder.count(UPDATE_RECORD) == 0
+    assert card.read_field("SPN") == "ff" * 17
+    # One of the card's ADM retries was used
+    assert card.adm_retries == 2
+
+
+def test_apdu_latency(make_card, csv_file, parse_args, provision, field_values, write_args, apdu_recorder):
+    apdu_recorder.latency = 0.002
+    args = parse_args(csv_file(field_values), *write_args)
+
+    started = time.perf_counter()
+    provision(args, VirtualCardLink([make_card()], apdu_latency=apdu_recorder))
+    seconds = time.perf_counter() - started
+
+    assert apdu_recorder.instructions
+    assert seconds >= apdu_recorder.latency * len(apdu_recorder.instructions)
+
+
+def test_run_multiple_cards(monkeypatch, tmp_path, make_card, csv_file, parse_args, field_values, write_args):
+    cards = [make_card(index) for index in range(3)]
+    monkeypatch.setattr(app.VirtualCardLink, "from_spec_file", lambda filename: VirtualCardLink(cards))
+    spec_file = tmp_path / "spec.json"
+    spec_file.write_text("{}")
+    args = parse_args(csv_file(field_values), *write_args, "--multiple", "--virtual-card", str(spec_file))
+
+    assert app.run(args) == 0
+
+    assert [card.iccid for card in cards] == ["8988211000000000001", "8988211000000000002", "8988211000000000003"]
+    for card in cards:
+        for field_name, field_value in field_values.items():
+            assert card.read_field(field_name) == field_value
+
+
+def test_run_card_removed(monkeypatch, tmp_path, make_card, csv_file, parse_args, field_values, write_args):
+    # A real reader raises NoCardError when the card is removed, which doesn't end the run like the last virtual card
+    link = VirtualCardLink([make_card()])
+
+    def connect():
+        raise NoCardError("Card removed")
+
+    monkeypatch.setattr(link, "connect", connect)
+    monkeypatch.setattr(app.VirtualCardLink, "from_spec_file", lambda filename: link)
+    spec_file = tmp_path / "spec.json"
+    spec_file.write_text("{}")
+    args = parse_args(csv_file(field_values), *write_args, "--multiple", "--virtual-card", str(spec_file))
+
+    with pytest.raises(NoCardError):
+        app.run(args)
+
+
+############################################################################
+
+
+@pytest.mark.parametrize(
+    "current, target, merge_gap, ranges",
+    [
+        ("00112233", "00112233", 0, []),
+        ("00112233", "ff112233", 0, [(0, 1)]),
+        ("00112233", "001122ff", 0, [(3, 1)]),
+        ("00112233", "ffff2233", 0, [(0, 2)]),
+        ("0011223344", "ff1122ff44", 0, [(0, 1), (3, 1)]),
+        # Two unchanged bytes apart: merged only if merge_gap allows it
+        ("0011223344", "ff1122ff44", 1, [(0, 1), (3, 1)]),
+        ("0011223344", "ff1122ff44", 2, [(0, 4)]),
+        ("0011223344", "ffffffffff", 0, [(0, 5)]),
+    ],
+)
+def test_diff_byte_ranges(current, target, merge_gap, ranges):
+    assert engine.diff_byte_ranges(current, target, merge_gap) == ranges
+
+
+def test_delta_write(make_card, csv_file, parse_args, provision, field_values, write_args, apdu_recorder):
+    spn = field_values["SPN"]
+    # Only the first and the last 2 bytes of SPN differ
+    card = make_card(values={**field_values, "SPN": "00" + spn[2:-4] + "0000"})
+    args = parse_args(csv_file(field_values), *write_args, "--delta-write", "--delta-merge-gap", "0")
+
+    card_result = provision(args, VirtualCardLink([card], apdu_latency=apdu_recorder))
+
+    assert card.read_field("SPN") == spn
+    (spn_result,) = [result for result in card_result.fields if result.written]
+    assert spn_result.field_name == "SPN"
+    assert spn_result.written_ranges == [(0, 1), (15, 2)]
+    assert spn_result.verified
+    assert apdu_recorder.count(UPDATE_BINARY) == 2
+
+
+@pytest.mark.parametrize(
+    "current, target, record_size, first_record, record_numbers",
+    [
+        ("0011" "2233", "0011" "2233", 2, 1, []),
+        ("0011" "2233", "ff11" "2233", 2, 1, [1]),
+        ("0011" "2233" "4455", "0011" "22ff" "44ff", 2, 1, [2, 3]),
+        # FIELD.N: the records start at record number first_record
+        ("2233", "22ff", 2, 2, [2]),
+    ],
+)
+def test_diff_records(current, target, record_size, first_record, record_numbers):
+    assert engine.diff_records(current, target, record_size, first_record) == record_numbers
+
+
+def test_write_changed_records(make_card, csv_file, parse_args, provision, field_values, write_args, apdu_recorder):
+    smsp = field_values["SMSP"]
+    # Record 1 already has its FieldValue
+    card = make_card(values={**field_values, "SMSP": smsp[:80] + "ff" * 40})
+    args = parse_args(csv_file(field_values), *write_args)
+
+    card_result = provision(args, VirtualCardLink([card], apdu_latency=apdu_recorder))
+
+    assert card.read_field("SMSP") == smsp
+    (smsp_result,) = [result for result in card_result.fields if result.written]
+    assert smsp_result.field_name == "SMSP"
+    assert smsp_result.written_records == [2]
+    assert apdu_recorder.count(UPDATE_RECORD) == 1
+
+
+def test_write_single_record(make_card, csv_file, parse_args, provision, field_values, write_args, apdu_recorder):
+    record_2 = field_values["SMSP"][80:]
+    card = make_card()
+    args = parse_args(csv_file({"SMSP.2": record_2}), *write_args)
+
+    card_result = provision(args, VirtualCardLink([card], apdu_latency=apdu_recorder))
+
+    assert card.read_field("SMSP") == "ff" * 40 + record_2
+    (result,) = card_result.fields
+    assert (result.field_name, result.written_records, result.verified) == ("SMSP.2", [2], True)
+    assert apdu_recorder.count(UPDATE_RECORD) == 1
+
+
+def test_record_number_beyond_the_records(make_card, csv_file, parse_args, provision, field_values, write_args):
+    args = parse_args(csv_file({"SMSP.3": field_values["SMSP"][80:]}), *write_args)
+
+    with pytest.raises(ValueError, match=r"\[SMSP.3\]: Invalid record number 3. Max record number = 2"):
+        provision(args, VirtualCardLink([make_card()]))
+
+
+############################################################################
+
+
+def test_skip_card_when_fingerprint_matches(make_card, csv_file, parse_args, provision, field_values, write_args, apdu_recorder):
+    # Only the fingerprint field is read, so the other fields aren't compared
+    card = make_card(values={"SPN": field_values["SPN"]})
+    args = parse_args(csv_file(field_values), *write_args, "--fingerprint-fields", "SPN")
+
+    card_result = provision(args, VirtualCardLink([card], apdu_latency=apdu_recorder))
+
+    assert card_result.skipped == "fingerprint matches"
+    assert card_result.fields == []
+    assert apdu_recorder.count(UPDATE_BINARY) == apdu_recorder.count(UPDATE_RECORD) == 0
+    assert card.read_field("AD") == "ff" * 4
+
+
+def test_write_card_when_fingerprint_differs(make_card, csv_file, parse_args, provision, field_values, write_args):
+    card = make_card(values={"SPN": field_values["SPN"]})
+    args = parse_args(csv_file(field_values), *write_args, "--fingerprint-fields", "SPN,AD")
+
+    card_result = provision(args, VirtualCardLink([card]))
+
+    assert card_result.skipped is None
+    assert sorted(result.field_name for result in card_result.fields if result.written) == ["AD", "SMSP"]
+    for field_name, field_value in field_values.items():
+        assert card.read_field(field_name) == field_value
+
+
+def test_fingerprint_field_not_in_plan(make_card, csv_file, parse_args, provision, field_values, write_args):
+    args = parse_args(csv_file({"AD": field_values["AD"]}), *write_args, "--fingerprint-fields", "SPN")
+
+    with pytest.raises(InvalidFieldError, match=r"Fingerprint fields \['SPN'\] are not fields of the card"):
+        provision(args, VirtualCardLink([make_card()]))
@@ -0,0 +1,54 @@
+"""FieldNames, and FIELD.N addressing of a single record"""
+import pytest
+
+from sim_csv_script.fields import is_valid_field_name, parse_field_name
+from sim_csv_script.plan import compile_field
+
+
+@pytest.mark.parametrize(
+    "field_name, parsed",
+    [
+        ("IMPU", ("IMPU", None)),
+        ("IMPU.1", ("IMPU", 1)),
+        ("IMPU.10", ("IMPU", 10)),
+        ("SMSP.2", ("SMSP", 2)),
+        # Records start at 1
+        ("IMPU.0", ("IMPU.0", None)),
+        ("IMPU.01", ("IMPU.01", None)),
+        ("IMPU.-1", ("IMPU.-1", None)),
+        ("IMPU.1.2", ("IMPU.1.2", None)),
+        ("IMPU.", ("IMPU.", None)),
+        # Only fields that use records have records
+        ("SPN.1", ("SPN.1", None)),
+        # Digits other than ASCII
+        ("IMPU.١", ("IMPU.١", None)),
+    ],
+)
+def test_parse_field_name(field_name, parsed):
+    assert parse_field_name(field_name) == parsed
+
+
+@pytest.mark.parametrize(
+    "field_name, valid",
+    [("IMPU", True), ("IMPU.3", True), ("SPN", True), ("SPN.1", False), ("IMPU.0", False), ("NOT_A_FIELD", False)],
+)
+def test_is_valid_field_name(field_name, valid):
+    assert is_valid_field_name(field_name) == valid
+
+
+def test_compile_record_field():
+    field = compile_field("SMSP.2", "AB" * 40)
+
+    assert field.field_name == "SMSP.2"
+    assert field.uses_records
+    assert field.record_number == field.first_record == 2
+    assert field.num_bytes == 40
+    assert field.value == "ab" * 40
+    assert field.ef == compile_field("SMSP").ef
+
+
+def test_compile_field():
+    field = compile_field("SMSP", "AB" * 80)
+
+    assert field.record_number is None
+    assert field.first_record == 1
@@ -0,0 +1,174 @@
+"""Journal of provisioned cards, to skip and resume the cards of earlier runs"""
+import pytest
+
+from sim_csv_script.engine import FieldResult
+from sim_csv_script.exceptions import WriteFieldError
+from sim_csv_script.journal import (
+    CARD_COMPLETED,
+    CARD_FAILED,
+    ProvisioningJournal,
+    journal_card,
+    plan_hash,
+    value_hash,
+)
+from sim_csv_script.plan import ProvisioningPlan, compile_field
+from sim_csv_script.virtual_card import VirtualCardLink
+
+ICCID = "8988211000000000001"
+IMSI = "001010000000001"
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = ProvisioningJournal(str(tmp_path / "journal.sqlite"))
+    yield journal
+    journal.close()
+
+
+def make_plan(**field_values) -> ProvisioningPlan:
+    return ProvisioningPlan(tuple(compile_field(field_name, value) for field_name, value in field_values.items()))
+
+
+def field_result(field, *, written: bool = False, verified: bool = False) -> FieldResult:
+    result = FieldResult(field.field_name, field.value)
+    result.written, result.verified = written, verified
+    return result
+
+
+def card_status(journal):
+    return [status for status, in journal._db.execute("SELECT status FROM cards ORDER BY id")]
+
+
+def test_plan_hash():
+    plan = make_plan(SPN="4420", AD="0d34814f")
+
+    assert plan_hash(plan) == plan_hash(make_plan(AD="0D34814F", SPN="4420"))
+    assert plan_hash(plan) != plan_hash(make_plan(SPN="4421", AD="0d34814f"))
+    assert plan_hash(plan) != plan_hash(make_plan(SPN="4420"))
+    assert value_hash("AB") == value_hash("ab")
+
+
+def test_unknown_card(journal):
+    state = journal.lookup(ICCID, plan_hash(make_plan(SPN="4420")))
+
+    assert not state.completed
+    assert state.done_fields == {}
+
+
+def test_completed_card(journal):
+    plan = make_plan(SPN="4420", AD="0d34814f")
+    card_id = journal.start_card(ICCID, IMSI, plan_hash(plan))
+    with journal_card(journal, card_id) as field_done:
+        for field in plan.fields:
+            field_done(field, field_result(field, written=True, verified=True))
+
+    assert card_status(journal) == [CARD_COMPLETED]
+    assert journal.lookup(ICCID, plan_hash(plan)).completed
+    # Another plan for the same card isn't completed, but the fields with the same values are done
+    other_plan = make_plan(SPN="4421", AD="0d34814f")
+    state = journal.lookup(ICCID, plan_hash(other_plan))
+    assert not state.completed
+    assert [field.field_name for field in other_plan.fields if state.field_done(field)] == ["AD"]
+    assert not journal.lookup("8988211000000000002", plan_hash(plan)).completed
+
+
+def test_resume_from_partial_fields(journal):
+    plan = make_plan(SPN="4420", AD="0d34814f", ACC="f532")
+    spn, ad, acc = plan.fields
+    card_id = journal.start_card(ICCID, IMSI, plan_hash(plan))
+    with pytest.raises(WriteFieldError):
+        with journal_card(journal, card_id) as field_done:
+            field_done(spn, field_result(spn))
+            field_done(ad, field_result(ad, written=True))
+            raise WriteFieldError("[ACC]: Failed to update binary")
+
+    assert card_status(journal) == [CARD_FAILED]
+    state = journal.lookup(ICCID, plan_hash(plan))
+    assert not state.completed
+    assert [state.field_done(field) for field in plan.fields] == [True, True, False]
+
+    # The resumed run only records the remaining field
+    card_id = journal.start_card(ICCID, IMSI, plan_hash(plan))
+    with journal_card(journal, card_id) as field_done:
+        field_done(acc, field_result(acc, written=True, verified=True))
+
+    state = journal.lookup(ICCID, plan_hash(plan))
+    assert state.completed
+    assert all(state.field_done(field) for field in plan.fields)
+
+
+def test_last_record_of_a_field_wins(journal):
+    old_plan = make_plan(SPN="4420")
+    new_plan = make_plan(SPN="4421")
+    for plan in (old_plan, new_plan):
+        card_id = journal.start_card(ICCID, IMSI, plan_hash(plan))
+        with journal_card(journal, card_id) as field_done:
+            field_done(plan.fields[0], field_result(plan.fields[0], written=True))
+
+    state = journal.lookup(ICCID, plan_hash(old_plan))
+    assert not state.completed
+    assert not state.field_done(old_plan.fields[0])
+    assert state.field_done(new_plan.fields[0])
+
+
+def test_finished_card_is_committed(tmp_path):
+    path = str(tmp_path / "journal.sqlite")
+    plan = make_plan(SPN="4420")
+    # The group is never full, so only finish_card() commits
+    journal = ProvisioningJournal(path, commit_records=1000, commit_seconds=1000)
+    other_journal = ProvisioningJournal(path)
+    try:
+        card_id = journal.start_card(ICCID, IMSI, plan_hash(plan))
+        spn = plan.fields[0]
+        journal.record_field(card_id, spn, field_result(spn, written=True))
+        assert other_journal.lookup(ICCID, plan_hash(plan)).done_fields == {}
+
+        journal.finish_card(card_id)
+        # Seen by another connection (e.g. after a crash) without closing the journal
+        state = other_journal.lookup(ICCID, plan_hash(plan))
+        assert state.completed
+        assert state.field_done(spn)
+    finally:
+        other_journal.close()
+        journal.close()
+
+
+def test_not_journaling(journal):
+    with journal_card(None, None) as field_done:
+        assert field_done is None
+    with journal_card(journal, None) as field_done:
+        assert field_done is None
+
+
+############################################################################
+
+
+def test_resume_card(make_card, csv_file, parse_args, provision, field_values, write_args, journal):
+    card = make_card()
+    args = parse_args(csv_file(field_values), *write_args, "--journal", journal.path)
+
+    def fail_updating_records(pdu: str) -> float:
+        if pdu[2:4].lower() == "dc":
+            raise IOError("Card removed")
+        return 0.0
+
+    # The first run fails at the record based field (SMSP), after writing the fields before it
+    with pytest.raises(WriteFieldError):
+        provision(args, VirtualCardLink([card], apdu_latency=fail_updating_records), journal=journal)
+    assert card.read_field("SMSP") == "ff" * 80
+    state = journal.lookup(ICCID, None)
+    done_field_names = sorted(state.done_fields)
+    assert "SMSP" not in done_field_names
+
+    # The second run only provisions the fields that the journal doesn't have as done
+    card_result = provision(args, VirtualCardLink([card]), journal=journal)
+    assert sorted(result.field_name for result in card_result.fields) == sorted(
+        set(field_values) - set(done_field_names)
+    )
+    for field_name, field_value in field_values.items():
+        assert card.read_field(field_name) == field_value
+
+    # The third run skips the completed card
+    card_result = provision(args, VirtualCardLink([card]), journal=journal)
+    assert card_result.skipped == "completed in journal"
+    assert card_status(journal) == [CARD_FAILED, CARD_COMPLETED]
@@ -0,0 +1,113 @@
+"""ADM pin index, built from a JSON file and looked up by IMSI (or ICCID)"""
+import io
+import json
+
+import pytest
+
+from sim_csv_script import cli, pin_store
+from sim_csv_script.exceptions import InvalidADMPinError
+from sim_csv_script.pin_store import PIN_ADM_KEY_ICCID, PinAdmStore, build_pin_adm_index, iter_json_object_items
+
+PINS = {"001010000000001": "11111111", "001010000000002": "22222222", "001010000000003": "33333333"}
+
+
+@pytest.fixture
+def pin_json(tmp_path):
+    """Returns a function that writes {key: ADM PIN} to a JSON file, and returns its name"""
+
+    def write(pins: dict) -> str:
+        path = tmp_path / "pins.json"
+        path.write_text(json.dumps(pins, indent=2))
+        return str(path)
+
+    return write
+
+
+@pytest.fixture
+def index_file(tmp_path) -> str:
+    return str(tmp_path / "pins.sqlite")
+
+
+@pytest.mark.parametrize(
+    "text, items",
+    [
+        ("{}", []),
+        (' { "a" : "1", "b": 2 ,"c":{"d": [1, "}"]}} ', [("a", "1"), ("b", 2), ("c", {"d": [1, "}"]})]),
+    ],
+)
+def test_iter_json_object_items(monkeypatch, text, items):
+    # Small chunks, so values are split between reads
+    monkeypatch.setattr(pin_store, "JSON_READ_CHUNK_SIZE", 3)
+    assert list(iter_json_object_items(io.StringIO(text))) == items
+
+
+@pytest.mark.parametrize("text", ["[]", '{"a": "1"', '{"a" "1"}', '{"a": "1",}'])
+def test_iter_json_object_items_invalid(text):
+    with pytest.raises(ValueError):
+        list(iter_json_object_items(io.StringIO(text)))
+
+
+def test_index_round_trip(monkeypatch, pin_json, index_file):
+    # Several batches, so duplicates of earlier batches are also checked
+    monkeypatch.setattr(pin_store, "INDEX_BATCH_PINS", 2)
+
+    assert build_pin_adm_index(pin_json(PINS), index_file) == len(PINS)
+
+    store = PinAdmStore(index_file)
+    try:
+        for imsi, pin_adm in PINS.items():
+            assert store.lookup(imsi, "8988211000000000001") == pin_adm
+        with pytest.raises(InvalidADMPinError, match="IMSI 001010000000004 is not found"):
+            store.lookup("001010000000004")
+        with pytest.raises(InvalidADMPinError, match="IMSI can't be read"):
+            store.lookup(None, "8988211000000000001")
+    finally:
+        store.close()
+
+
+def test_index_by_iccid(pin_json, index_file):
+    build_pin_adm_index(pin_json({"8988211000000000001": 12345678}), index_file, key=PIN_ADM_KEY_ICCID)
+
+    store = PinAdmStore(index_file)
+    try:
+        assert store.key == PIN_ADM_KEY_ICCID
+        assert store.lookup("001010000000001", "8988211000000000001") == "12345678"
+        with pytest.raises(InvalidADMPinError, match="ICCID can't be read"):
+            store.lookup("001010000000001")
+    finally:
+        store.close()
+
+
+def test_index_duplicates(monkeypatch, tmp_path, index_file):
+    monkeypatch.setattr(pin_store, "INDEX_BATCH_PINS", 2)
+    path = tmp_path / "pins.json"
+    path.write_text('{"1": "a", "2": "b", "3": "c", "1": "d"}')
+
+    with pytest.raises(ValueError, match=r"Duplicate IMSIs: \['1'\]"):
+        build_pin_adm_index(str(path), index_file)
+    # The index isn't left half built
+    assert not list(tmp_path.glob("pins.sqlite*"))
+
+
+def test_index_invalid_pin(pin_json, index_file):
+    with pytest.raises(ValueError, match="ADM pin of IMSI 001010000000001 must be a string"):
+        build_pin_adm_index(pin_json({"001010000000001": None}), index_file)
+
+
+def test_not_an_index(tmp_path, pin_json):
+    with pytest.raises(ValueError, match="is not an ADM pin index"):
+        PinAdmStore(pin_json(PINS))
+    with pytest.raises(ValueError, match="Failed to open"):
+        PinAdmStore(str(tmp_path / "missing.sqlite"))
+    assert not (tmp_path / "missing.sqlite").exists()
+
+
+def test_index_main(pin_json, index_file):
+    assert cli.index_main([pin_json(PINS), index_file, "--key", "imsi"]) == 0
+    store = PinAdmStore(index_file)
+    try:
+        assert store.lookup("001010000000002") == "22222222"
+    finally:
+        store.close()
+
+    assert cli.index_main([pin_json(["not", "an", "object"]), index_file]) == 1
@@ -0,0 +1,95 @@
+"""Result records of each card, and the files they are written to"""
+import csv
+import json
+
+import pytest
+
+from sim_csv_script.engine import CardResult
+from sim_csv_script.results import (
+    CARD_FAILED,
+    CARD_SUCCEEDED,
+    FIELD_COLUMNS,
+    FIELD_UNCHANGED,
+    FIELD_VERIFIED,
+    FIELD_WRITTEN,
+    ResultSink,
+    card_record,
+    open_result_sink,
+    record_card,
+)
+from sim_csv_script.virtual_card import VirtualCardLink
+
+
+def field_records(card_result: CardResult) -> dict:
+    record = card_record(card_result, mode="write", started=0.0, seconds=0.0)
+    return {field["field_name"]: field for field in record["fields"]}
+
+
+def test_after_is_the_value_read_back(make_card, csv_file, parse_args, provision, field_values, write_args):
+    card = make_card(values={"AD": field_values["AD"]})
+    args = parse_args(csv_file(field_values), *write_args)
+
+    fields = field_records(provision(args, VirtualCardLink([card])))
+
+    assert fields["SPN"]["status"] == FIELD_VERIFIED
+    assert fields["SPN"]["before"] == "ff" * 17
+    assert fields["SPN"]["after"] == card.read_field("SPN")
+    assert fields["AD"]["status"] == FIELD_UNCHANGED
+    assert fields["AD"]["after"] == fields["AD"]["before"] == field_values["AD"]
+
+
+@pytest.mark.parametrize("verify_args", [("--verify", "ranged", "--delta-write"), ("--verify", "deferred")])
+def test_after_with_partial_read_back(make_card, csv_file, parse_args, provision, field_values, write_args, verify_args):
+    args = parse_args(csv_file(field_values), *write_args, *verify_args)
+
+    fields = field_records(provision(args, VirtualCardLink([make_card()])))
+
+    for field_name, field_value in field_values.items():
+        assert fields[field_name]["status"] == FIELD_VERIFIED
+        assert fields[field_name]["after"] == field_value
+
+
+def test_after_is_empty_when_not_verified(make_card, csv_file, parse_args, provision, field_values, write_args):
+    args = parse_args(csv_file(field_values), *write_args, "--verify", "sampled", "--verify-sample-rate", "0")
+
+    fields = field_records(provision(args, VirtualCardLink([make_card()])))
+
+    for field_name in field_values:
+        assert fields[field_name]["status"] == FIELD_WRITTEN
+        assert fields[field_name]["after"] is None
+
+
+############################################################################
+
+
+def test_result_sink_is_abstract(tmp_path):
+    with pytest.raises(TypeError):
+        ResultSink(str(tmp_path / "results.txt"))
+
+
+@pytest.mark.parametrize("name", ["results.jsonl", "results.csv"])
+def test_result_files(tmp_path, make_card, csv_file, parse_args, provision, field_values, write_args, name):
+    args = parse_args(csv_file(field_values), *write_args)
+    filename = str(tmp_path / name)
+    results = open_result_sink(filename)
+    try:
+        card_result = CardResult()
+        with record_card(results, card_result, args):
+            provision(args, VirtualCardLink([make_card()]), card_result=card_result)
+        card_result = CardResult()
+        with pytest.raises(ValueError):
+            with record_card(results, card_result, args):
+                raise ValueError("Card removed")
+    finally:
+        results.close()
+
+    with open(filename, encoding="utf-8") as f:
+        if name.endswith(".jsonl"):
+            records = [json.loads(line) for line in f]
+            assert [record["status"] for record in records] == [CARD_SUCCEEDED, CARD_FAILED]
+            assert len(records[0]["fields"]) == len(field_values)
+            assert records[1]["error"] == "(ValueError) Card removed"
+        else:
+            rows = list(csv.DictReader(f))
+            assert [row["status"] for row in rows] == [CARD_SUCCEEDED] * len(field_values) + [CARD_FAILED]
+            assert set(FIELD_COLUMNS) <= set(rows[0])
@@ -0,0 +1,95 @@
+"""FieldValue templates, expanded for each card"""
+import pytest
+
+from sim_csv_script.exceptions import InvalidTemplateError
+from sim_csv_script.templates import (
+    SequenceCounter,
+    TemplateContext,
+    compile_field_templates,
+    compile_template,
+    is_template,
+)
+from sim_csv_script.virtual_card import VirtualCardLink
+
+CONTEXT = TemplateContext(iccid="8988211000000000012", imsi="001010000000012", counter=300)
+
+
+@pytest.mark.parametrize(
+    "template, value",
+    [
+        ("00{counter|hex}", "00012c"),
+        ("00{counter|hex4}", "00012c"),
+        ("{counter|dec6}", "000300"),
+        ("{imsi[-2:]}", "12"),
+        ("{imsi[-2:]|hex2}", "0c"),
+        ("{iccid[0]}0", "80"),
+        ("{imsi[:5]|swap}", "0001f1"),
+        ("{imsi|ascii}", "001010000000012".encode("ascii").hex()),
+        ("AB{counter|hex4}CD", "ab012ccd"),
+    ],
+)
+def test_expand(template, value):
+    assert compile_template("SPN", template).expand(CONTEXT) == value
+
+
+def test_expand_card_encodings():
+    from pySim.utils import enc_iccid, enc_imsi
+
+    assert compile_template("SPN", "{iccid|iccid}").expand(CONTEXT) == enc_iccid(CONTEXT.iccid)
+    assert compile_template("SPN", "{imsi|imsi}").expand(CONTEXT) == enc_imsi(CONTEXT.imsi)
+
+
+@pytest.mark.parametrize(
+    "template, message",
+    [
+        ("{nope}", "Unknown placeholder source 'nope'"),
+        ("{counter|nope}", "Unknown encoding 'nope'"),
+        ("{counter|swap2}", "Encoding 'swap' in {counter|swap2} doesn't take a width"),
+        ("{imsi[]}", "Invalid slice"),
+        ("{imsi[x]}", "Invalid placeholder"),
+        ("zz{counter}", "Invalid text 'zz' between placeholders"),
+        ("00}", "Invalid text '00}' between placeholders"),
+    ],
+)
+def test_invalid_template(template, message):
+    with pytest.raises(InvalidTemplateError, match=message):
+        compile_template("SPN", template)
+
+
+@pytest.mark.parametrize(
+    "template, context, message",
+    [
+        ("{counter|hex2}", CONTEXT, "300 doesn't fit in 2 hex digits"),
+        ("{imsi}", CONTEXT._replace(imsi=None), "IMSI can't be read from the card"),
+        ("{counter|dec2}", CONTEXT, "300 doesn't fit in 2 digits"),
+    ],
+)
+def test_expand_fails(template, context, message):
+    with pytest.raises(InvalidTemplateError, match=message):
+        compile_template("SPN", template).expand(context)
+
+
+def test_compile_field_templates():
+    templates = compile_field_templates([("SPN", "44{counter|hex2}"), ("AD", "0d34814f")])
+
+    assert list(templates) == ["SPN"]
+    assert is_template("44{counter}") and not is_template("4420")
+
+
+def test_sequence_counter():
+    counter = SequenceCounter(5)
+
+    assert [counter.next() for _ in range(3)] == [5, 6, 7]
+
+
+def test_write_cards(make_card, csv_file, parse_args, provision, field_values, write_args):
+    field_values["AD"] = "0d34{imsi[-2:]|hex2}{counter|hex2}"
+    args = parse_args(csv_file(field_values), *write_args)
+    cards = [make_card(0), make_card(1)]
+    link = VirtualCardLink(cards)
+
+    for _ in cards:
+        provision(args, link)
+
+    # IMSIs end with 01 and 02, and each card provisioned by provision() starts a new counter at 0
+    assert [card.read_field("AD") for card in cards] == ["0d340100", "0d340200"]
@@ -0,0 +1,86 @@
+"""Validation of the CSV file's fields, with every problem reported at once"""
+import pytest
+
+from sim_csv_script.validation import (
+    RULE_DUPLICATE_NAME,
+    RULE_EMPTY_VALUE,
+    RULE_FIELD_AND_RECORD,
+    RULE_INVALID_HEX,
+    RULE_INVALID_NAME,
+    RULE_INVALID_TEMPLATE,
+    RULE_ODD_LENGTH,
+    RULE_SPACES,
+    all_field_values_valid,
+    find_field_problems,
+    format_field_problems,
+)
+
+
+def rules(problems):
+    return [(problem.row, problem.field_name, problem.rule) for problem in problems]
+
+
+def test_valid_fields():
+    assert find_field_problems(["SPN", "IMPU.2", "AD"], ["4420", "ABCDEF", "0d34814f"]) == []
+
+
+@pytest.mark.parametrize(
+    "field_values, valid",
+    [
+        ([], True),
+        (["00", "abCD"], True),
+        (["0"], False),
+        ([""], False),
+        (["0x00"], False),
+        (["00,11"], False),
+        (["00 1"], False),
+        (["00", "1"], False),
+    ],
+)
+def test_all_field_values_valid(field_values, valid):
+    assert all_field_values_valid(field_values) == valid
+
+
+@pytest.mark.parametrize(
+    "field_value, rule",
+    [
+        ("", RULE_EMPTY_VALUE),
+        ("00 11", RULE_SPACES),
+        ("0x0011", RULE_INVALID_HEX),
+        ("00_11", RULE_INVALID_HEX),
+        ("001", RULE_ODD_LENGTH),
+    ],
+)
+def test_value_problem(field_value, rule):
+    assert rules(find_field_problems(["SPN"], [field_value])) == [(0, "SPN", rule)]
+
+
+def test_every_problem_is_reported():
+    field_names = ["SPN", "NOT_A_FIELD", "SPN", "IMPU", "IMPU.2", "AD"]
+    field_values = ["4420", "00", "0x44", "00", "00", "001"]
+
+    problems = find_field_problems(field_names, field_values)
+
+    assert rules(problems) == [
+        (1, "NOT_A_FIELD", RULE_INVALID_NAME),
+        (2, "SPN", RULE_DUPLICATE_NAME),
+        (2, "SPN", RULE_INVALID_HEX),
+        (3, "IMPU", RULE_FIELD_AND_RECORD),
+        (5, "AD", RULE_ODD_LENGTH),
+    ]
+    # Line 1 is the header
+    assert problems[0].line_number == 3
+    message = format_field_problems(problems)
+    assert message.startswith("5 problem(s) in fields:\n  Line 3 (NOT_A_FIELD): Invalid Field Name")
+    assert "Duplicate Field Name (first on line 2)" in message
+    assert "Valid field names are keys in EF" in message
+
+
+def test_templates():
+    field_names = ["SPN", "AD"]
+
+    assert rules(find_field_problems(field_names, ["44{counter|hex2}", "00"])) == [(0, "SPN", RULE_INVALID_HEX)]
+    assert find_field_problems(field_names, ["44{counter|hex2}", "00"], allow_templates=True) == []
+    assert rules(find_field_problems(field_names, ["44{counter|nope}", "00"], allow_templates=True)) == [
+        (0, "SPN", RULE_INVALID_TEMPLATE)
+    ]
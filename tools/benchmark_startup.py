@@ -0,0 +1,111 @@
+"""Startup time benchmark of sim_csv_script's command line
+
+Runs each command several times in a new interpreter, and reports the median time.
+Fails (return code 1) if a command imports one of the heavy modules that it doesn't need,
+or if its median time is more than --max-seconds.
+
+python3 tools/benchmark_startup.py [--runs 10] [--max-seconds 0.5]
+
+sim_csv_script must be installed (e.g. python3 -m pip install -e .), since the commands run "python -m sim_csv_script"
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+# Modules that only the card and CSV paths need
+HEAVY_MODULES = ("pandas", "numpy", "pySim.cards", "pySim.filesystem", "pySim.ts_51_011", "sim_csv_script.app")
+
+# Command line arguments, and whether they may import the heavy modules
+COMMANDS = (
+    (["--version"], False),
+    (["--help"], False),
+    (["--list-field-names"], True),
+)
+
+# Runs the command line with argv in the same way as "python -m sim_csv_script", then prints the heavy modules it imported
+IMPORT_CHECK = """
+import json, sys
+heavy_modules = json.loads(sys.argv[2])
+sys.argv = ["sim_csv_script"] + json.loads(sys.argv[1])
+from sim_csv_script.cli import get_args
+try:
+    get_args()
+except SystemExit:
+    pass
+sys.stderr.write(json.dumps(sorted(name for name in heavy_modules if name in sys.modules)))
+"""
+
+
+def time_command_python(runs: int) -> float:
+    """Interpreter startup alone, to compare against"""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def time_command(argv, runs: int) -> float:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-m", "sim_csv_script"] + argv,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def imported_heavy_modules(argv):
+    p = subprocess.run(
+        [sys.executable, "-c", IMPORT_CHECK, json.dumps(argv), json.dumps(HEAVY_MODULES)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+    return json.loads(p.stderr.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="Runs of each command (default 10)")
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        default=0.5,
+        help="Fail if the median time of a command that doesn't need the heavy modules is more than this (default 0.5)",
+    )
+    args = parser.parse_args()
+
+    baseline = time_command_python(args.runs)
+    print(f"{'python -c pass':<40} {baseline * 1000:8.1f} ms")
+
+    failed = False
+    for argv, may_import_heavy_modules in COMMANDS:
+        median = time_command(argv, args.runs)
+        heavy_modules = imported_heavy_modules(argv)
+
+        problems = []
+        if heavy_modules and not may_import_heavy_modules:
+            problems.append(f"imports {heavy_modules}")
+        if not may_import_heavy_modules and median > args.max_seconds:
+            problems.append(f"slower than {args.max_seconds} s")
+        failed = failed or bool(problems)
+
+        print(
+            f"{'sim_csv_script ' + ' '.join(argv):<40} {median * 1000:8.1f} ms"
+            + (f"  FAIL: {', '.join(problems)}" if problems else "")
+        )
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())